@@ -0,0 +1,128 @@
+"""
+Compares servers (e.g. the WSGI and ASGI deployments) under many concurrent slow downloads.
+
+Each client downloads the file at a limited rate, while a probe measures how fast
+the server still answers short requests.
+
+Usage (from the directory containing manage.py, with both servers running):
+    gunicorn image_thumbnail_api.wsgi --workers 2 --threads 8 --bind 127.0.0.1:8001
+    uvicorn image_thumbnail_api.asgi:application --workers 2 --port 8002
+    python -m benchmarks.concurrent_downloads --token <key> --path /media/1/images/ab/cd/photo.jpg \
+        --concurrency 500 --read-rate 65536 http://127.0.0.1:8001 http://127.0.0.1:8002
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+READ_SIZE = 16 * 1024
+
+
+class Download(NamedTuple):
+    status: int
+    first_byte: float  # seconds from connecting to the status line
+    total: float
+    size: int
+
+
+async def download(base_url: str, path: str, token: str, read_rate: int) -> Download:
+    """
+    Downloads the file over a new connection, reading at most read_rate bytes per second.
+    """
+    url = urlsplit(base_url)
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+            f"Authorization: Token {token}\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        first_byte = time.perf_counter() - start
+        while await reader.readline() not in (b"\r\n", b""):
+            pass
+        size = 0
+        while chunk := await reader.read(READ_SIZE):
+            size += len(chunk)
+            if read_rate:
+                await asyncio.sleep(len(chunk) / read_rate)
+        status = int(status_line.split()[1]) if status_line else 0
+        return Download(status, first_byte, time.perf_counter() - start, size)
+    finally:
+        writer.close()
+
+
+async def probe(base_url: str, path: str, token: str, stop: asyncio.Event) -> list[float]:
+    """
+    Requests the path every 100 ms until stopped, returns the latencies to the first byte.
+    """
+    latencies = []
+    while not stop.is_set():
+        try:
+            result = await download(base_url, path, token, 0)
+        except OSError:
+            pass
+        else:
+            latencies.append(result.first_byte)
+        await asyncio.sleep(0.1)
+    return latencies
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return f"{'-':>8}{'-':>8}"
+    quantiles = statistics.quantiles(values, n=100)
+    return f"{quantiles[49] * 1000:>8.0f}{quantiles[94] * 1000:>8.0f}"
+
+
+async def benchmark(base_url: str, args: argparse.Namespace) -> None:
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(base_url, args.probe_path or args.path, args.token, stop))
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[
+            download(base_url, args.path, args.token, args.read_rate)
+            for _ in range(args.concurrency)
+        ],
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    stop.set()
+    probe_latencies = await probe_task
+    downloads = [r for r in results if isinstance(r, Download) and r.status == 200]
+    print(
+        f"{base_url:<28}{len(downloads):>6}{len(results) - len(downloads):>7}"
+        f"{elapsed:>9.1f}"
+        f"{percentiles([d.first_byte for d in downloads])}"
+        f"{percentiles([d.total for d in downloads])}"
+        f"{percentiles(probe_latencies)}"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    print(
+        f"{args.concurrency} concurrent downloads at "
+        f"{args.read_rate or 'unlimited'} bytes/s, latencies p50/p95 (ms)"
+    )
+    print(
+        f"{'server':<28}{'ok':>6}{'failed':>7}{'time (s)':>9}"
+        f"{'first byte':>16}{'download':>16}{'probe':>16}"
+    )
+    for base_url in args.urls:
+        await benchmark(base_url, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("urls", nargs="+", help="Base urls of the servers to compare.")
+    parser.add_argument("--path", required=True, help="Media path to download.")
+    parser.add_argument("--probe-path", help="Media path requested by the probe.")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--read-rate", type=int, default=64 * 1024, help="Bytes per second per client, 0 for unlimited."
+    )
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,358 @@
+"""
+Load-tests the upload and access endpoints of a running server, tier by tier.
+
+For each tier, a benchmark user uploads a synthetic corpus of images (POST /images/),
+lists its images (GET /images/), and downloads the originals and thumbnails (ImageAccess)
+and the expiring links (ExpiringImageAccess) of the uploads, at the given concurrency.
+Throughput, p50/p95/p99 latencies and the peak RSS of the server processes are reported
+per tier and endpoint, and saved as JSON to be compared with later runs.
+
+Usage (from the directory containing manage.py, with the server using the same database):
+    python manage.py runserver --noreload 127.0.0.1:8000
+    python -m benchmarks.load_test --concurrency 8 --server-pid <pid> \
+        --output results.json [--baseline previous.json] http://127.0.0.1:8000
+"""
+import argparse
+import functools
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, urlopen
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_thumbnail_api.settings")
+django.setup()
+
+from rest_framework.authtoken.models import Token  # noqa: E402
+
+from benchmarks.thumbnail_engine import generate_image  # noqa: E402
+from users.models import Tier, User  # noqa: E402
+
+# File names and dimensions of the synthetic corpus, from small web images to camera photos
+CORPUS = {
+    "small.jpg": (640, 480),
+    "small.png": (480, 640),
+    "medium.jpg": (1920, 1080),
+    "medium.png": (1080, 1920),
+    "large.jpg": (4000, 3000),
+    "panorama.jpg": (6000, 1500),
+}
+
+
+class Sample(NamedTuple):
+    status: int
+    latency: float  # seconds
+    body: bytes
+
+
+def generate_corpus(corpus_dir: str) -> list[str]:
+    """
+    Writes the corpus images missing from the directory, returns their paths.
+    Existing images are reused, so that runs compare the same files.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = []
+    for file_name, size in CORPUS.items():
+        path = os.path.join(corpus_dir, file_name)
+        if not os.path.exists(path):
+            generate_image(path, size)
+        paths.append(path)
+    return paths
+
+
+def benchmark_token(tier: Tier) -> str:
+    """
+    Returns the token of the tier's benchmark user, creating the user if needed.
+    """
+    user, _ = User.objects.get_or_create(
+        username=f"benchmark-{tier.pk}", defaults={"tier": tier}
+    )
+    if user.tier_id != tier.pk:
+        user.tier = tier
+        user.save()
+    return Token.objects.get(user=user).key
+
+
+def multipart_body(fields: dict, file_path: str) -> tuple[bytes, str]:
+    """
+    Returns the body and content type of a form with the fields and the image as "original_image".
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode()
+        )
+    content_type = "image/png" if file_path.endswith(".png") else "image/jpeg"
+    parts.append(
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"original_image\"; "
+        f'filename="{os.path.basename(file_path)}"\r\nContent-Type: {content_type}\r\n\r\n'.encode()
+    )
+    with open(file_path, "rb") as f:
+        parts.append(f.read())
+    # trailing bytes, ignored by decoders, make every upload unique, so none is deduplicated
+    parts.append(boundary.encode())
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def send(
+    url: str, token: str | None, data: bytes | None = None, content_type: str | None = None
+) -> Sample:
+    headers = {}
+    if token is not None:
+        headers["Authorization"] = f"Token {token}"
+    if content_type is not None:
+        headers["Content-Type"] = content_type
+    start = time.perf_counter()
+    try:
+        with urlopen(Request(url, data=data, headers=headers)) as response:
+            body = response.read()
+            status = response.status
+    except HTTPError as e:
+        body = e.read()
+        status = e.code
+    except OSError:
+        body = b""
+        status = 0
+    return Sample(status, time.perf_counter() - start, body)
+
+
+def process_rss(pid: int) -> int:
+    """
+    Returns the resident set size of the process and its children, in bytes.
+    """
+    rss = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return rss
+    return rss + sum(process_rss(child) for child in children)
+
+
+class RSSMonitor:
+    """
+    Samples the RSS of the server processes in a thread, and keeps the peak.
+    """
+
+    def __init__(self, pids: list[int], interval: float = 0.05):
+        self.pids = pids
+        self.interval = interval
+        self.peak = 0
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+
+    def __sample(self) -> None:
+        while not self.__stop.is_set():
+            self.peak = max(self.peak, sum(process_rss(pid) for pid in self.pids))
+            self.__stop.wait(self.interval)
+
+    def __enter__(self) -> "RSSMonitor":
+        if self.pids:
+            self.__thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.__stop.set()
+        if self.pids:
+            self.__thread.join()
+
+
+def percentile(quantiles: list[float], n: int) -> float | None:
+    return round(quantiles[n - 1] * 1000, 2) if quantiles else None
+
+
+def run_phase(
+    requests: list[Callable[[], Sample]], concurrency: int, server_pids: list[int]
+) -> tuple[dict, list[Sample]]:
+    """
+    Sends the requests at the given concurrency, returns their statistics and samples.
+    """
+    with RSSMonitor(server_pids) as monitor:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            samples = list(executor.map(lambda request: request(), requests))
+        elapsed = time.perf_counter() - start
+    latencies = [sample.latency for sample in samples if 200 <= sample.status < 300]
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+    stats = {
+        "requests": len(samples),
+        "errors": len(samples) - len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": percentile(quantiles, 50),
+        "p95_ms": percentile(quantiles, 95),
+        "p99_ms": percentile(quantiles, 99),
+        "peak_rss_mb": round(monitor.peak / 2**20, 1) if server_pids else None,
+    }
+    return stats, samples
+
+
+def media_links(base_url: str, upload_samples: list[Sample]) -> tuple[list[str], list[str]]:
+    """
+    Returns the standard (original and thumbnail) and expiring links of the uploads.
+    """
+    links, expiring_links = [], []
+    for sample in upload_samples:
+        if not 200 <= sample.status < 300:
+            continue
+        for key, value in json.loads(sample.body).items():
+            if key.endswith("_expiring_link"):
+                expiring_links.append(server_url(base_url, value))
+            elif key == "original_image" or key.endswith("_thumbnail"):
+                links.append(server_url(base_url, value))
+    return links, expiring_links
+
+
+def server_url(base_url: str, link: str) -> str:
+    """
+    Returns the url of the link on the tested server (links may be absolute, with another host).
+    """
+    return urljoin(base_url, urlsplit(link)._replace(scheme="", netloc="").geturl())
+
+
+def benchmark_tier(base_url: str, tier: Tier, paths: list[str], args: argparse.Namespace) -> dict:
+    token = benchmark_token(tier)
+    images_url = urljoin(base_url, "/images/")
+    fields = {"live_time": args.live_time} if tier.ability_to_fetch_expiring_link else {}
+    uploads = [multipart_body(fields, path) for path in paths] * args.rounds
+    results = {}
+    results["upload"], upload_samples = run_phase(
+        [functools.partial(send, images_url, token, *body) for body in uploads],
+        args.concurrency,
+        args.server_pid,
+    )
+    results["list"], _ = run_phase(
+        [functools.partial(send, images_url, token) for _ in range(len(uploads))],
+        args.concurrency,
+        args.server_pid,
+    )
+    links, expiring_links = media_links(base_url, upload_samples)
+    if links:
+        results["access"], _ = run_phase(
+            [functools.partial(send, link, token) for link in links * args.downloads],
+            args.concurrency,
+            args.server_pid,
+        )
+    if expiring_links:
+        results["expiring_access"], _ = run_phase(
+            [functools.partial(send, link, None) for link in expiring_links * args.downloads],
+            args.concurrency,
+            args.server_pid,
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns the tier endpoints whose throughput dropped, or p95 latency grew,
+    by more than the tolerance compared to the baseline run.
+    """
+    regressions = []
+    for tier_name, endpoints in results["tiers"].items():
+        for endpoint, stats in endpoints.items():
+            previous = baseline["tiers"].get(tier_name, {}).get(endpoint)
+            if previous is None:
+                continue
+            if previous["throughput"] and stats["throughput"] is not None and (
+                stats["throughput"] < previous["throughput"] * (1 - tolerance)
+            ):
+                regressions.append(
+                    f"{tier_name} {endpoint}: throughput "
+                    f"{previous['throughput']} -> {stats['throughput']} req/s"
+                )
+            if previous["p95_ms"] and stats["p95_ms"] is not None and (
+                stats["p95_ms"] > previous["p95_ms"] * (1 + tolerance)
+            ):
+                regressions.append(
+                    f"{tier_name} {endpoint}: p95 {previous['p95_ms']} -> {stats['p95_ms']} ms"
+                )
+    return regressions
+
+
+def run(args: argparse.Namespace) -> None:
+    paths = generate_corpus(args.corpus_dir)
+    tiers = Tier.objects.order_by("pk")
+    if args.tiers:
+        tiers = tiers.filter(name__in=args.tiers)
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "base_url": args.base_url,
+        "concurrency": args.concurrency,
+        "corpus": {
+            file_name: {"size": list(size), "bytes": os.path.getsize(path)}
+            for (file_name, size), path in zip(CORPUS.items(), paths)
+        },
+        "tiers": {},
+    }
+    print(f"concurrency {args.concurrency}, latencies in ms, peak RSS in MB")
+    print(
+        f"{'tier':<16}{'endpoint':<17}{'requests':>9}{'errors':>7}{'req/s':>9}"
+        f"{'p50':>9}{'p95':>9}{'p99':>9}{'RSS':>8}"
+    )
+    for tier in tiers:
+        tier_results = benchmark_tier(args.base_url, tier, paths, args)
+        results["tiers"][tier.name] = tier_results
+        for endpoint, stats in tier_results.items():
+            print(
+                f"{tier.name:<16}{endpoint:<17}{stats['requests']:>9}{stats['errors']:>7}"
+                + "".join(
+                    f"{'-' if stats[key] is None else stats[key]:>{width}}"
+                    for key, width in (
+                        ("throughput", 9),
+                        ("p50_ms", 9),
+                        ("p95_ms", 9),
+                        ("p99_ms", 9),
+                        ("peak_rss_mb", 8),
+                    )
+                )
+            )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        print(f"{len(regressions)} regressions compared to {args.baseline}")
+        for regression in regressions:
+            print(f"  {regression}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("base_url", help="Base url of the server, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--tiers", nargs="+", help="Names of the tiers to test, all by default.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=2, help="Uploads of each corpus image per tier.")
+    parser.add_argument("--downloads", type=int, default=5, help="Downloads of each link.")
+    parser.add_argument("--live-time", type=int, default=3000, help="Seconds expiring links are valid.")
+    parser.add_argument(
+        "--corpus-dir", default=os.path.join(tempfile.gettempdir(), "image-benchmark-corpus"),
+        help="Directory the corpus is generated in, and reused from by later runs.",
+    )
+    parser.add_argument(
+        "--server-pid", type=int, nargs="*", default=[],
+        help="Processes of the server whose RSS is sampled (with their children).",
+    )
+    parser.add_argument("--output", help="File the results are saved to, as JSON.")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1,
+        help="Relative change of throughput or p95 latency reported as a regression.",
+    )
+    run(parser.parse_args())
@@ -0,0 +1,117 @@
+"""
+Compares the single-decode thumbnail engine with the previous approaches, on two tiers:
+"heights", whose sizes only bound the height (like the built-in tiers), and "mixed", where
+every other size also bounds the width. Thumbnails of the mixed tier are not nested,
+so they can not be rendered in place, one from the other, in order of height.
+Every strategy saves its thumbnails with save_thumbnail(), i.e. the encoder options of
+IMAGE_THUMBNAIL_ENCODERS, so only decoding and resizing differ.
+
+Usage (from the directory containing manage.py):
+    python -m benchmarks.thumbnail_engine --repeat 5 --heights 400 200
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from typing import Callable
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_thumbnail_api.settings")
+django.setup()
+
+from PIL import Image as PILImage  # noqa: E402
+
+from images.thumbnails import render_thumbnails, save_thumbnail, thumbnail_name  # noqa: E402
+from users.models import ThumbnailSize  # noqa: E402
+
+CORPUS = {
+    "large.jpg": (6000, 4000),
+    "large.png": (4000, 3000),
+}
+
+
+def generate_image(path: str, size: tuple[int, int]) -> None:
+    """
+    Writes a photo-like test image (smooth gradients with noise) of the given size.
+    """
+    width, height = size
+    gradient = PILImage.linear_gradient("L").resize(size)
+    noise = PILImage.effect_noise(size, 40)
+    image = PILImage.merge(
+        "RGB", (gradient, noise, gradient.transpose(PILImage.Transpose.ROTATE_180))
+    )
+    image.save(path)
+
+
+def render_per_size(original_image_path: str, sizes: list[ThumbnailSize]) -> None:
+    """
+    Previous approach for arbitrary tiers: one decode and one thumbnail() per size.
+    """
+    for size in sizes:
+        with PILImage.open(original_image_path) as image:
+            image.thumbnail((size.width or image.width, size.height))
+            save_thumbnail(image, thumbnail_name(original_image_path, size), size)
+
+
+def render_in_place(original_image_path: str, sizes: list[ThumbnailSize]) -> None:
+    """
+    Previous approach for built-in tiers: one image thumbnailed in place, size after size.
+    Only correct for sizes bounding the height alone.
+    """
+    with PILImage.open(original_image_path) as image:
+        for size in sorted(sizes, key=lambda size: size.height, reverse=True):
+            image.thumbnail((image.width, size.height))
+            save_thumbnail(image, thumbnail_name(original_image_path, size), size)
+
+
+STRATEGIES: dict[str, Callable] = {
+    "per_size": render_per_size,
+    "in_place": render_in_place,
+    "engine": render_thumbnails,
+}
+
+
+def tiers(heights: list[int]) -> dict[str, list[ThumbnailSize]]:
+    return {
+        "heights": [ThumbnailSize(height) for height in heights],
+        "mixed": [
+            ThumbnailSize(height, height // 2 if i % 2 == 0 else None)
+            for i, height in enumerate(heights)
+        ],
+    }
+
+
+def run(repeat: int, heights: list[int]) -> None:
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print(f"heights: {heights}, best and median of {repeat} runs (ms)")
+        print(f"{'image':<12}{'tier':<10}{'strategy':<12}{'best':>10}{'median':>10}")
+        for file_name, size in CORPUS.items():
+            path = os.path.join(temp_dir, file_name)
+            generate_image(path, size)
+            for tier_name, sizes in tiers(heights).items():
+                for strategy_name, strategy in STRATEGIES.items():
+                    if strategy is render_in_place and any(size.width for size in sizes):
+                        continue
+                    timings = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        strategy(path, sizes)
+                        timings.append((time.perf_counter() - start) * 1000)
+                    print(
+                        f"{file_name:<12}{tier_name:<10}{strategy_name:<12}"
+                        f"{min(timings):>10.1f}{statistics.median(timings):>10.1f}"
+                    )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--heights", type=int, nargs="+", default=[400, 200])
+    args = parser.parse_args()
+    run(args.repeat, args.heights)
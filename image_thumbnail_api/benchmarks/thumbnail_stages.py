@@ -0,0 +1,340 @@
+"""
+Measures each stage of thumbnail rendering: decoding, draft (reduced) vs full decoding,
+resampling filters and encoder settings, at each output size, with each image backend.
+
+Reports the CPU time (best and median of the runs), the peak of Python allocations
+(tracemalloc) and of the resident memory (which includes the pixel buffers of the
+image libraries, measured on Linux) of one more run, and the size of encoded thumbnails.
+The pyvips backend is compared with Pillow when pyvips (and libvips) are installed.
+
+Usage (from the directory containing manage.py):
+    python -m benchmarks.thumbnail_stages --repeat 5 --heights 800 400 200 \
+        [--groups draft encode] [--backends pillow pyvips] [--images photo.jpg ...]
+"""
+
+import argparse
+import ctypes
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Callable, Iterator, NamedTuple
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_thumbnail_api.settings")
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from PIL import Image as PILImage  # noqa: E402
+
+from benchmarks.thumbnail_engine import generate_image  # noqa: E402
+from images.thumbnails import REDUCING_GAP, thumbnail_size  # noqa: E402
+from users.models import ThumbnailSize, can_encode  # noqa: E402
+
+try:
+    import pyvips
+except (ImportError, OSError):  # the bindings, or libvips itself, are not installed
+    pyvips = None
+
+CORPUS = {
+    "photo.jpg": (4000, 3000),
+    "screenshot.png": (1920, 1080),
+}
+
+# Encoder settings compared with the configured ones (IMAGE_THUMBNAIL_ENCODERS), in Pillow's options
+ENCODER_CASES = {
+    "jpeg q75": ("jpeg", {"quality": 75}),
+    "jpeg q90": ("jpeg", {"quality": 90}),
+    "jpeg q82 baseline": ("jpeg", {"quality": 82}),
+    "png level 1": ("png", {"compress_level": 1}),
+    "png level 9": ("png", {"compress_level": 9}),
+    "webp q80 method 0": ("webp", {"quality": 80, "method": 0}),
+    "webp q80 method 6": ("webp", {"quality": 80, "method": 6}),
+}
+
+
+class PillowBackend:
+    name = "pillow"
+    filters = {
+        "nearest": PILImage.Resampling.NEAREST,
+        "box": PILImage.Resampling.BOX,
+        "bilinear": PILImage.Resampling.BILINEAR,
+        "hamming": PILImage.Resampling.HAMMING,
+        "bicubic": PILImage.Resampling.BICUBIC,
+        "lanczos": PILImage.Resampling.LANCZOS,
+    }
+
+    def decode(self, path: str, size: tuple[int, int] | None = None) -> PILImage.Image:
+        """
+        Decodes the image, JPEGs at a reduced scale still REDUCING_GAP times larger than size, if set.
+        """
+        with PILImage.open(path) as image:
+            if size is not None:
+                image.draft(
+                    image.mode,
+                    (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)),
+                )
+            image.load()
+            return image
+
+    def resize(
+        self, image: PILImage.Image, size: tuple[int, int], resample: str
+    ) -> PILImage.Image:
+        return image.resize(size, self.filters[resample], reducing_gap=REDUCING_GAP)
+
+    def can_encode(self, image_format: str) -> bool:
+        return can_encode(image_format)
+
+    def encode(self, image: PILImage.Image, image_format: str, options: dict) -> bytes:
+        if image_format == "jpeg" and image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, image_format.upper(), **options)
+        return output.getvalue()
+
+
+class VipsBackend:
+    name = "pyvips"
+    filters = {
+        "nearest": "nearest",
+        "bilinear": "linear",
+        "bicubic": "cubic",
+        "lanczos": "lanczos3",
+    }
+    # names of Pillow's encoder options in libvips, options without one are left out
+    options = {
+        ("jpeg", "quality"): "Q",
+        ("jpeg", "progressive"): "interlace",
+        ("jpeg", "optimize"): "optimize_coding",
+        ("png", "compress_level"): "compression",
+        ("webp", "quality"): "Q",
+        ("webp", "method"): "effort",
+        ("avif", "quality"): "Q",
+    }
+    suffixes = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "avif": ".avif"}
+
+    def decode(self, path: str, size: tuple[int, int] | None = None) -> "pyvips.Image":
+        """
+        Decodes the image into memory, JPEGs shrunk on load by the largest factor
+        that keeps them REDUCING_GAP times larger than size, if set.
+        """
+        if size is not None and path.lower().endswith((".jpg", ".jpeg")):
+            image = pyvips.Image.new_from_file(path)
+            shrink = 1
+            while (
+                shrink < 8
+                and min(
+                    image.width / (shrink * 2) / size[0],
+                    image.height / (shrink * 2) / size[1],
+                )
+                >= REDUCING_GAP
+            ):
+                shrink *= 2
+            return pyvips.Image.new_from_file(path, shrink=shrink).copy_memory()
+        return pyvips.Image.new_from_file(path).copy_memory()
+
+    def resize(
+        self, image: "pyvips.Image", size: tuple[int, int], resample: str
+    ) -> "pyvips.Image":
+        return image.resize(
+            size[0] / image.width,
+            vscale=size[1] / image.height,
+            kernel=self.filters[resample],
+        ).copy_memory()
+
+    def can_encode(self, image_format: str) -> bool:
+        try:
+            pyvips.Image.black(1, 1).write_to_buffer(self.suffixes[image_format])
+        except (KeyError, pyvips.Error):
+            return False
+        return True
+
+    def encode(self, image: "pyvips.Image", image_format: str, options: dict) -> bytes:
+        return image.write_to_buffer(
+            self.suffixes[image_format],
+            **{
+                self.options[image_format, key]: value
+                for key, value in options.items()
+                if (image_format, key) in self.options
+            },
+        )
+
+
+BACKENDS = {
+    "pillow": PillowBackend,
+    "pyvips": VipsBackend if pyvips is not None else None,
+}
+
+
+class Measurement(NamedTuple):
+    best_cpu: float  # ms
+    median_cpu: float
+    python_peak: int  # bytes
+    rss_peak: int | None  # bytes above the resident memory before the run
+    output_size: int | None
+
+
+def _memory_status(key: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{key}:"):
+                return int(line.split()[1]) * 1024
+    raise KeyError(key)
+
+
+def _reset_rss_peak() -> int | None:
+    """
+    Resets the peak resident memory of the process (Linux only), returns the current one.
+    Memory freed by earlier runs is first returned to the system, so it is counted again.
+    """
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):  # not glibc
+        pass
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _memory_status("VmRSS")
+    except (OSError, KeyError):
+        return None
+
+
+def measure(function: Callable, repeat: int) -> Measurement:
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        function()
+        timings.append((time.process_time() - start) * 1000)
+    rss = _reset_rss_peak()
+    tracemalloc.start()
+    try:
+        result = function()
+        python_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    rss_peak = _memory_status("VmHWM") - rss if rss is not None else None
+    return Measurement(
+        min(timings),
+        statistics.median(timings),
+        python_peak,
+        rss_peak,
+        len(result) if isinstance(result, bytes) else None,
+    )
+
+
+def cases(
+    backend,
+    path: str,
+    image_size: tuple[int, int],
+    heights: list[int],
+    groups: list[str],
+) -> Iterator[tuple]:
+    """
+    Yields the group, name, height and function of each case of the image.
+    """
+    dimensions = {
+        height: thumbnail_size(image_size, ThumbnailSize(height)) for height in heights
+    }
+    if "decode" in groups:
+        yield "decode", "full", None, lambda: backend.decode(path)
+    if "draft" in groups:
+        for height, size in dimensions.items():
+            yield "draft", "full decode", height, lambda size=size: backend.resize(
+                backend.decode(path), size, "bicubic"
+            )
+            yield "draft", "draft decode", height, lambda size=size: backend.resize(
+                backend.decode(path, size), size, "bicubic"
+            )
+    image = backend.decode(path) if {"filter", "encode"} & set(groups) else None
+    if "filter" in groups:
+        for height, size in dimensions.items():
+            for resample in backend.filters:
+                yield "filter", resample, height, lambda size=size, resample=resample: backend.resize(
+                    image, size, resample
+                )
+    if "encode" in groups:
+        encoder_cases = {
+            f"{image_format} configured": (image_format, options)
+            for image_format, options in settings.IMAGE_THUMBNAIL_ENCODERS.items()
+        }
+        encoder_cases.update(ENCODER_CASES)
+        for height, size in dimensions.items():
+            thumbnail = backend.resize(image, size, "bicubic")
+            for name, (image_format, options) in encoder_cases.items():
+                if backend.can_encode(image_format):
+                    yield "encode", name, height, lambda thumbnail=thumbnail, image_format=image_format, options=options: backend.encode(
+                        thumbnail, image_format, options
+                    )
+
+
+def run(args: argparse.Namespace) -> None:
+    backends = []
+    for name in args.backends:
+        backend_class = BACKENDS[name]
+        if backend_class is None:
+            print(f"{name} is not installed, skipped")
+        else:
+            backends.append(backend_class())
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = args.images or []
+        if not paths:
+            for file_name, size in CORPUS.items():
+                paths.append(os.path.join(temp_dir, file_name))
+                generate_image(paths[-1], size)
+        print(
+            f"CPU time best and median of {args.repeat} runs (ms), peak Python allocations (KB), "
+            f"peak resident memory growth (MB) and output size (KB) of one run"
+        )
+        print(
+            f"{'image':<18}{'backend':<9}{'group':<8}{'case':<24}{'height':>7}"
+            f"{'best':>9}{'median':>9}{'py KB':>9}{'RSS MB':>8}{'out KB':>9}"
+        )
+        for path in paths:
+            with PILImage.open(path) as image:
+                image_size = image.size
+            for backend in backends:
+                for group, name, height, function in cases(
+                    backend, path, image_size, args.heights, args.groups
+                ):
+                    measurement = measure(function, args.repeat)
+                    rss_peak = (
+                        f"{measurement.rss_peak / 2**20:.1f}"
+                        if measurement.rss_peak is not None
+                        else "-"
+                    )
+                    output_size = (
+                        f"{measurement.output_size / 1024:.1f}"
+                        if measurement.output_size is not None
+                        else "-"
+                    )
+                    print(
+                        f"{os.path.basename(path):<18}{backend.name:<9}{group:<8}{name:<24}"
+                        f"{height or '-':>7}{measurement.best_cpu:>9.1f}{measurement.median_cpu:>9.1f}"
+                        f"{measurement.python_peak / 1024:>9.1f}{rss_peak:>8}{output_size:>9}"
+                    )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--heights", type=int, nargs="+", default=[800, 400, 200])
+    parser.add_argument(
+        "--groups",
+        nargs="+",
+        choices=["decode", "draft", "filter", "encode"],
+        default=["decode", "draft", "filter", "encode"],
+    )
+    parser.add_argument(
+        "--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS)
+    )
+    parser.add_argument(
+        "--images", nargs="+", help="Images to measure, a synthetic corpus by default."
+    )
+    run(parser.parse_args())
@@ -2,6 +2,7 @@
 ASGI config for image_thumbnail_api project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Media files are served by async views and streamed without blocking the event loop.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -9,8 +10,16 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_thumbnail_api.settings")
+os.environ.setdefault("IMAGE_ASYNC_MEDIA_VIEWS", "1")
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from images.asgi import StreamingASGIHandler  # noqa: E402
+from images.expiry import start_server_expiry_sweeper  # noqa: E402
+
+application = StreamingASGIHandler()
+
+start_server_expiry_sweeper()
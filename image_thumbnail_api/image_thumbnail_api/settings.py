@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "images.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -132,6 +133,116 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Override the default user model
 AUTH_USER_MODEL = "users.User"
 
+# Token authentication
+# Authenticated tokens (with their user and tier) are kept in a per-process LRU of
+# TOKEN_CACHE_MAX_ENTRIES tokens, None as TOKEN_CACHE_TTL disables it. Changes to a token,
+# user or tier apply at once in the process making them, within TOKEN_CACHE_TTL seconds in others.
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX_ENTRIES = 10_000
+
 # Image files storage
 MEDIA_URL = "media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+# Images, expiring images and thumbnails are stored with IMAGE_STORAGE_BACKEND.
+# ContentAddressedStorage keeps each distinct content once, as a blob in IMAGE_BLOB_ROOT
+# (which should be on the same file system as MEDIA_ROOT) hard linked from every file
+# with that content. Unreferenced blobs are deleted by `python manage.py collect_image_blobs`.
+# IMAGE_STORAGE_OPTIONS are passed to the backend, e.g. to store files in an S3 bucket
+# (requires boto3):
+#   IMAGE_STORAGE_BACKEND = "images.storage.S3ImageStorage"
+#   IMAGE_STORAGE_OPTIONS = {"bucket_name": "images", "endpoint_url": "https://s3.example.com"}
+# Files of remote storages are served and rendered from local copies, streamed into
+# IMAGE_REMOTE_CACHE_DIR on their first use (the directory can be cleared at any time).
+IMAGE_STORAGE_BACKEND = "images.storage.ContentAddressedStorage"
+IMAGE_STORAGE_OPTIONS: dict = {}
+IMAGE_BLOB_ROOT = os.path.join(BASE_DIR, "blobs")
+IMAGE_REMOTE_CACHE_DIR = os.path.join(BASE_DIR, "remote-cache")
+# Files are stored in IMAGE_MEDIA_SHARD_LEVELS levels of directories named by the hash of
+# their names (e.g. "1/images/ab/cd/photo.jpg"), so no directory grows too large.
+# Files stored before (or with 0 levels) are moved by `python manage.py relocate_media_files`.
+IMAGE_MEDIA_SHARD_LEVELS = 2
+
+# Image delivery
+# None streams files from disk in chunks, "x-accel-redirect" (nginx) or "x-sendfile"
+# (apache, lighttpd) hand the transfer off to the front server.
+IMAGE_SENDFILE_BACKEND = None
+IMAGE_SENDFILE_URL = "/protected-media/"  # internal location that maps to MEDIA_ROOT
+IMAGE_STREAM_CHUNK_SIZE = 64 * 1024
+IMAGE_CACHE_MAX_AGE = 60 * 60  # upper bound of Cache-Control max-age, in seconds
+# The media views are async when served by image_thumbnail_api.asgi (which sets
+# IMAGE_ASYNC_MEDIA_VIEWS): downloads are streamed without holding a thread each.
+IMAGE_ASYNC_MEDIA_VIEWS = os.environ.get("IMAGE_ASYNC_MEDIA_VIEWS") == "1"
+# Stage timings, transferred bytes and cache lookups, exposed at /images/metrics/
+# in the Prometheus text format. The metrics are kept per process.
+IMAGE_METRICS_ENABLED = True
+
+# Thumbnail rendering
+# "sync" renders thumbnails during the upload request, "async" queues them for the
+# workers started with `python manage.py run_thumbnail_workers`, "lazy" renders each
+# thumbnail on its first request, into IMAGE_DERIVATIVE_CACHE_DIR.
+IMAGE_THUMBNAIL_RENDERING = "sync"
+IMAGE_DERIVATIVE_CACHE_DIR = os.path.join(BASE_DIR, "derivative-cache")
+IMAGE_THUMBNAIL_JOB_TIMEOUT = 10 * 60  # running jobs older than this are requeued, in seconds
+# Pillow save options of each thumbnail format (the quality of a thumbnail size overrides them).
+# The defaults favour encoding speed, as sync rendering happens during the upload request:
+# progressive and optimized JPEGs ("progressive": True, "optimize": True, ~7x slower) and
+# optimized PNGs ("optimize": True, ~15x slower than compress_level 1) are a few percent
+# smaller, and better suited to the "async" and "lazy" modes.
+# Tiers with output_formats also serve thumbnails converted to the first of those formats
+# the client's Accept header lists (if the local Pillow can encode it), cached like derivatives.
+IMAGE_THUMBNAIL_ENCODERS = {
+    "jpeg": {"quality": 82},
+    "png": {"compress_level": 1},
+    "webp": {"quality": 80, "method": 4},
+    "avif": {"quality": 60},
+}
+
+# Cache of hot files (e.g. thumbnails) served by ImageAccess, None to disable it.
+# The "local" backend is a per-process LRU bounded by MAX_BYTES, the "django" backend
+# stores files in the CACHES entry named by CACHE_ALIAS (e.g. memcached, shared by processes).
+# Cached files are revalidated against their mtime once they are older than TTL seconds.
+IMAGE_FILE_CACHE = None
+# IMAGE_FILE_CACHE = {
+#     "BACKEND": "local",
+#     "MAX_BYTES": 64 * 1024 * 1024,
+#     "MAX_ITEM_BYTES": 512 * 1024,
+#     "TTL": 60,
+# }
+
+# Upload validation
+# Uploads are checked from their header (format and dimensions) once received, before they
+# are stored or decoded. Images whose body turns out to be corrupt when their thumbnails
+# are rendered are deleted and rejected.
+# Images that would decode to more than IMAGE_MAX_PIXELS pixels, or are larger than
+# IMAGE_MAX_DIMENSION on either side, are rejected.
+IMAGE_MAX_PIXELS = 50_000_000
+IMAGE_MAX_DIMENSION = 20_000
+
+# Chunked uploads
+# Chunks are appended to a partial file in IMAGE_UPLOAD_DIR (which should be on the same
+# file system as IMAGE_BLOB_ROOT, so finished uploads are moved rather than copied).
+# Uploads idle for longer than IMAGE_UPLOAD_TIMEOUT seconds are deleted by the expiry sweeper.
+IMAGE_UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+IMAGE_UPLOAD_MAX_SIZE = 1024 * 1024 * 1024
+IMAGE_UPLOAD_TIMEOUT = 24 * 60 * 60
+
+# Batch uploads
+# Thumbnails of batch uploads are rendered by a pool of IMAGE_BATCH_PROCESSES processes
+# (None for one per CPU), spawned for each batch.
+# Archives are extracted one member at a time, up to IMAGE_BATCH_MAX_ARCHIVE_SIZE bytes in all.
+IMAGE_BATCH_MAX_FILES = 100
+IMAGE_BATCH_MAX_ARCHIVE_SIZE = 4 * 1024 * 1024 * 1024
+IMAGE_BATCH_PROCESSES = None
+
+# Image listing
+IMAGE_LIST_PAGE_SIZE = 100
+IMAGE_LIST_MAX_PAGE_SIZE = 1000
+
+# Expiring images
+# Expired images are deleted by `python manage.py sweep_expiring_images` (e.g. from cron),
+# or every IMAGE_EXPIRY_SWEEP_INTERVAL seconds by a thread in each server process (started
+# by the WSGI and ASGI applications, never by other management commands), if it is set.
+IMAGE_EXPIRY_SWEEP_INTERVAL = None
+# "signed" expiring links are HMAC-signed links to the uploaded image, verified without
+# a database query, "copy" links point to a copy of the image stored as an ExpiringImage.
+IMAGE_EXPIRING_LINKS = "signed"
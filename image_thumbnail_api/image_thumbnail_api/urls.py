@@ -18,21 +18,42 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf.urls.static import static
 
-from images.views import ImageAccess, ExpiringImageAccess
+from images.views import (
+    ExpiringImageAccess,
+    ImageAccess,
+    SignedImageAccess,
+    async_expiring_image_access,
+    async_image_access,
+    async_signed_image_access,
+)
+
+if settings.IMAGE_ASYNC_MEDIA_VIEWS:
+    image_access = async_image_access
+    expiring_image_access = async_expiring_image_access
+    signed_image_access = async_signed_image_access
+else:
+    image_access = ImageAccess.as_view()
+    expiring_image_access = ExpiringImageAccess.as_view()
+    signed_image_access = SignedImageAccess.as_view()
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("images/", include("images.urls")),
     path(
-        "media/<int:user_pk>/images/<str:file_name>",
-        ImageAccess.as_view(),
+        "media/<int:user_pk>/images/<path:file_name>",
+        image_access,
         name="image-access",
     ),
     path(
-        "media/expiring-images/<str:file_name>",
-        ExpiringImageAccess.as_view(),
+        "media/expiring-images/<path:file_name>",
+        expiring_image_access,
         name="expiring-image-access",
     ),
+    path(
+        "media/signed/<int:user_pk>/<path:file_name>",
+        signed_image_access,
+        name="signed-image-access",
+    ),
 ]
 
 if settings.DEBUG:
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_thumbnail_api.settings")
 
 application = get_wsgi_application()
+
+from images.expiry import start_server_expiry_sweeper  # noqa: E402
+
+start_server_expiry_sweeper()
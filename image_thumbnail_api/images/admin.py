@@ -1,6 +1,9 @@
 from django.contrib import admin
 
-from .models import Image, ExpiringImage
+from .models import Image, ExpiringImage, ImageUpload, Thumbnail, ThumbnailJob
 
 admin.site.register(Image)
 admin.site.register(ExpiringImage)
+admin.site.register(Thumbnail)
+admin.site.register(ThumbnailJob)
+admin.site.register(ImageUpload)
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ImagesConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "images"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .metrics import time_query
+
+        def time_queries(sender, connection, **kwargs):
+            if time_query not in connection.execute_wrappers:
+                connection.execute_wrappers.append(time_query)
+
+        connection_created.connect(time_queries, weak=False)
@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from io import BytesIO
+from typing import Iterator
+
+import django
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+
+from .derivatives import hash_chunks
+from .metrics import count_bytes, timed
+from .models import Image
+from .validation import validate_image_header
+
+
+def _spool(f) -> tempfile.SpooledTemporaryFile:
+    """
+    Copies an archive member to a file kept in memory, or on disk if it is large.
+    Stops one byte past IMAGE_UPLOAD_MAX_SIZE, so oversized members can be rejected
+    without extracting them.
+    """
+    spooled_file = tempfile.SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+    )
+    remaining_bytes = settings.IMAGE_UPLOAD_MAX_SIZE + 1
+    while remaining_bytes > 0:
+        chunk = f.read(min(settings.IMAGE_STREAM_CHUNK_SIZE, remaining_bytes))
+        if not chunk:
+            break
+        spooled_file.write(chunk)
+        remaining_bytes -= len(chunk)
+    spooled_file.seek(0)
+    return spooled_file
+
+
+def _skipped_member(name: str, size: int) -> File:
+    """
+    Stands for an archive member larger than IMAGE_UPLOAD_MAX_SIZE, which is not extracted.
+    """
+    return UploadedFile(BytesIO(), name=name, size=size)
+
+
+def iter_archive(archive) -> Iterator[File]:
+    """
+    Yields the regular files of a zip or tar (optionally compressed) archive, one at a time.
+    Members larger than IMAGE_UPLOAD_MAX_SIZE are yielded without their content (and rejected
+    by store_image), based on the sizes recorded in the archive, which also bound how much
+    is read from each member.
+    Raises ValueError if the file is not an archive, or once its members add up
+    to more than IMAGE_BATCH_MAX_ARCHIVE_SIZE bytes.
+    """
+    remaining_bytes = settings.IMAGE_BATCH_MAX_ARCHIVE_SIZE
+
+    def member_file(name: str, size: int, open_member) -> File:
+        nonlocal remaining_bytes
+        if size > settings.IMAGE_UPLOAD_MAX_SIZE:
+            return _skipped_member(name, size)
+        if size > remaining_bytes:
+            raise ValueError(
+                f"Archives are limited to {settings.IMAGE_BATCH_MAX_ARCHIVE_SIZE} bytes once extracted"
+            )
+        remaining_bytes -= size
+        with open_member() as f:
+            return File(_spool(f), name=name)
+
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zip_file:
+            for zip_info in zip_file.infolist():
+                if not zip_info.is_dir():
+                    yield member_file(
+                        os.path.basename(zip_info.filename),
+                        zip_info.file_size,
+                        lambda: zip_file.open(zip_info),
+                    )
+        return
+    archive.seek(0)
+    try:
+        tar_file = tarfile.open(fileobj=archive, mode="r:*")
+    except tarfile.TarError:
+        raise ValueError("Archive must be a zip or tar file")
+    with tar_file:
+        for tar_info in tar_file:
+            if tar_info.isfile():
+                yield member_file(
+                    os.path.basename(tar_info.name),
+                    tar_info.size,
+                    lambda: tar_file.extractfile(tar_info),
+                )
+
+
+def store_image(user, f: File) -> Image:
+    """
+    Validates the uploaded file and stores it as an image of the user.
+    Raises ValueError if it is not a supported image.
+    """
+    count_bytes("in", f.size)
+    if f.size > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise ValueError("Image is too large")
+    with timed("validate"):
+        validate_image_header(f, f.name or "")
+    image_instance = Image(user=user, content_hash=hash_chunks(f.chunks()))
+    image_instance.original_image.save(f.name, f)
+    return image_instance
+
+
+def get_batch_executor(jobs: int) -> Executor:
+    """
+    Returns a pool of up to IMAGE_BATCH_PROCESSES processes rendering the thumbnails
+    of one batch upload, to be shut down by the caller.
+    The processes are spawned rather than forked from the (possibly threaded) server
+    process, and set up Django before their first job.
+    """
+    return ProcessPoolExecutor(
+        min(settings.IMAGE_BATCH_PROCESSES or os.cpu_count() or 1, jobs),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=django.setup,
+    )
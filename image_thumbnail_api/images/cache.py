@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .delivery import file_etag, guess_content_type
+from .metrics import count_cache_request
+
+
+class CachedFile(NamedTuple):
+    """
+    Contents and response headers of a file kept in memory.
+    """
+
+    content: bytes
+    content_type: str
+    etag: str
+    last_modified: int
+    file_path: str
+    mtime_ns: int
+    checked_at: float  # when the mtime of the file was last compared, as a timestamp
+
+
+def read_cached_file(file_path: str) -> CachedFile:
+    stat_result = os.stat(file_path)
+    with open(file_path, "rb") as f:
+        content = f.read()
+    return CachedFile(
+        content=content,
+        content_type=guess_content_type(file_path),
+        etag=file_etag(stat_result),
+        last_modified=int(stat_result.st_mtime),
+        file_path=file_path,
+        mtime_ns=stat_result.st_mtime_ns,
+        checked_at=time.time(),
+    )
+
+
+class FileCache:
+    """
+    Base class of the caches of hot files.
+    Entries are looked up by request (so hits touch neither the database nor the filesystem),
+    and revalidated against the mtime of their file once they are older than the TTL.
+    """
+
+    def __init__(self, max_item_bytes: int, ttl: float):
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key: str) -> CachedFile | None:
+        raise NotImplementedError
+
+    def _set(self, key: str, cached_file: CachedFile) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def get(self, key: str) -> CachedFile | None:
+        cached_file = self._get(key)
+        if cached_file is not None and time.time() - cached_file.checked_at > self.ttl:
+            try:
+                mtime_ns = os.stat(cached_file.file_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime_ns = None
+            if mtime_ns == cached_file.mtime_ns:
+                cached_file = cached_file._replace(checked_at=time.time())
+                self._set(key, cached_file)
+            else:
+                self.delete(key)
+                cached_file = None
+        if cached_file is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        count_cache_request("file", cached_file is not None)
+        return cached_file
+
+    def load(self, key: str, file_path: str) -> CachedFile | None:
+        """
+        Reads the file into the cache, unless it is too large to be cached.
+        """
+        if os.path.getsize(file_path) > self.max_item_bytes:
+            return None
+        cached_file = read_cached_file(file_path)
+        self._set(key, cached_file)
+        return cached_file
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class LocalFileCache(FileCache):
+    """
+    Per-process LRU cache, bounded by the total size of the cached files.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int, ttl: float):
+        super().__init__(max_item_bytes, ttl)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.__entries: OrderedDict[str, CachedFile] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def _get(self, key: str) -> CachedFile | None:
+        with self.__lock:
+            cached_file = self.__entries.get(key)
+            if cached_file is not None:
+                self.__entries.move_to_end(key)
+            return cached_file
+
+    def _set(self, key: str, cached_file: CachedFile) -> None:
+        with self.__lock:
+            previous_file = self.__entries.pop(key, None)
+            if previous_file is not None:
+                self.size -= len(previous_file.content)
+            self.__entries[key] = cached_file
+            self.size += len(cached_file.content)
+            while self.size > self.max_bytes:
+                _, evicted_file = self.__entries.popitem(last=False)
+                self.size -= len(evicted_file.content)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self.__lock:
+            cached_file = self.__entries.pop(key, None)
+            if cached_file is not None:
+                self.size -= len(cached_file.content)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {**super().stats(), "items": len(self.__entries), "bytes": self.size}
+
+
+class DjangoFileCache(FileCache):
+    """
+    Cache stored in one of the Django cache backends (e.g. memcached or redis),
+    shared by all processes. Evictions are left to the backend.
+    """
+
+    def __init__(self, cache_alias: str, max_item_bytes: int, ttl: float):
+        super().__init__(max_item_bytes, ttl)
+        self.cache = caches[cache_alias]
+
+    def _get(self, key: str) -> CachedFile | None:
+        value = self.cache.get(f"image-file:{key}")
+        if value is None:
+            return None
+        return CachedFile(*value)
+
+    def _set(self, key: str, cached_file: CachedFile) -> None:
+        self.cache.set(f"image-file:{key}", tuple(cached_file), timeout=None)
+
+    def delete(self, key: str) -> None:
+        self.cache.delete(f"image-file:{key}")
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+
+_file_cache: FileCache | None = None
+
+
+def get_file_cache() -> FileCache | None:
+    """
+    Returns the cache of hot files configured in IMAGE_FILE_CACHE, or None if it is disabled.
+    """
+    global _file_cache
+    options = settings.IMAGE_FILE_CACHE
+    if options is None:
+        return None
+    if _file_cache is None:
+        if options["BACKEND"] == "local":
+            _file_cache = LocalFileCache(
+                options["MAX_BYTES"], options["MAX_ITEM_BYTES"], options["TTL"]
+            )
+        elif options["BACKEND"] == "django":
+            _file_cache = DjangoFileCache(
+                options["CACHE_ALIAS"], options["MAX_ITEM_BYTES"], options["TTL"]
+            )
+        else:
+            raise ValueError(f"Unknown IMAGE_FILE_CACHE backend: {options['BACKEND']}")
+    return _file_cache
+
+
+@receiver(setting_changed)
+def reset_file_cache(sender, setting=None, **kwargs):
+    """
+    Rebuild the cache of hot files when its settings change
+    """
+    global _file_cache
+    if setting == "IMAGE_FILE_CACHE":
+        _file_cache = None
@@ -0,0 +1,304 @@
+import asyncio
+import mimetypes
+import os
+import re
+from typing import AsyncIterator, Iterator
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.request import Request
+
+from .metrics import count_bytes
+
+
+def guess_content_type(file_path: str) -> str:
+    """
+    Returns the content type of the file based on its extension.
+    """
+    content_type, _ = mimetypes.guess_type(file_path)
+    return content_type or "application/octet-stream"
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    """
+    Returns a strong ETag built from the file modification time and size.
+    """
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+class FileContentNegotiation(BaseContentNegotiation):
+    """
+    Content negotiation of views serving files: the Accept header is about the file
+    (see negotiate_format), so it never makes the request fail with 406 Not Acceptable,
+    and error responses use the first renderer.
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+def negotiate_format(accept_header: str, image_formats: list[str]) -> str | None:
+    """
+    Returns the first of the image formats (e.g. "webp") the Accept header explicitly
+    accepts, or None. Wildcards are ignored, since clients send them for any image.
+    """
+    accepted_types = {}
+    for media_range in accept_header.split(","):
+        media_type, *parameters = media_range.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted_types[media_type.strip().lower()] = quality
+    for image_format in image_formats:
+        if accepted_types.get(f"image/{image_format}", 0) > 0:
+            return image_format
+    return None
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range_header(range_header: str, file_size: int) -> tuple[int, int] | None:
+    """
+    Returns the first and last byte positions of a single byte range.
+    Returns None if the header should be ignored (malformed, e.g. "bytes=5-3", or multiple ranges),
+    raises ValueError if the range can not be satisfied.
+    """
+    match = RANGE_RE.match(range_header.replace(" ", ""))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if file_size == 0:
+        raise ValueError("Range not satisfiable")
+    if not first:  # suffix range, e.g. "bytes=-500"
+        suffix_length = int(last)
+        if suffix_length == 0:
+            raise ValueError("Empty suffix range")
+        return max(file_size - suffix_length, 0), file_size - 1
+    first_byte = int(first)
+    if last and int(last) < first_byte:
+        return None  # invalid byte-range-spec, the header is ignored (RFC 7233 section 2.1)
+    last_byte = min(int(last), file_size - 1) if last else file_size - 1
+    if first_byte >= file_size:
+        raise ValueError("Range not satisfiable")
+    return first_byte, last_byte
+
+
+def if_range_matches(request: Request, etag: str, last_modified: int) -> bool:
+    """
+    Returns True if the Range header should be honoured according to If-Range.
+    """
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _read_file_range(file_path: str, first_byte: int, length: int) -> Iterator[bytes]:
+    """
+    Yields the requested part of the file in chunks.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(first_byte)
+        while length > 0:
+            chunk = f.read(min(settings.IMAGE_STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _range_response(
+    request: Request, file_path: str, content_type: str, file_size: int
+) -> HttpResponseBase | None:
+    """
+    Returns a 206 Partial Content (or 416) response if a byte range was requested.
+    """
+    range_header = request.META.get("HTTP_RANGE")
+    if not range_header:
+        return None
+    try:
+        byte_range = parse_range_header(range_header, file_size)
+    except ValueError:
+        error_response = HttpResponse(status=416)
+        error_response["Content-Range"] = f"bytes */{file_size}"
+        return error_response
+    if byte_range is None:
+        return None
+    first_byte, last_byte = byte_range
+    length = last_byte - first_byte + 1
+    response = StreamingHttpResponse(
+        _read_file_range(file_path, first_byte, length),
+        status=206,
+        content_type=content_type,
+    )
+    response["Content-Length"] = str(length)
+    response["Content-Range"] = f"bytes {first_byte}-{last_byte}/{file_size}"
+    return response
+
+
+def _sendfile_response(file_path: str, content_type: str) -> HttpResponse | None:
+    """
+    Hands the transfer off to the front server, if a sendfile backend is configured.
+    """
+    backend = settings.IMAGE_SENDFILE_BACKEND
+    if backend is None:
+        return None
+    relative_path = os.path.relpath(file_path, settings.MEDIA_ROOT)
+    if backend == "x-accel-redirect" and relative_path.startswith(os.pardir):
+        return None  # only MEDIA_ROOT is exposed to nginx
+    response = HttpResponse(content_type=content_type)
+    if backend == "x-accel-redirect":
+        response["X-Accel-Redirect"] = (
+            f"{settings.IMAGE_SENDFILE_URL.rstrip('/')}/{relative_path}"
+        )
+    elif backend == "x-sendfile":
+        response["X-Sendfile"] = file_path
+    else:
+        raise ValueError(f"Unknown IMAGE_SENDFILE_BACKEND: {backend}")
+    return response
+
+
+def send_file(request: Request, file_path: str, **cache_control) -> HttpResponseBase:
+    """
+    Returns a response that delivers the file without loading it into memory.
+    The file is either streamed from disk in chunks (and sent with os.sendfile
+    when the WSGI server provides a file wrapper), or handed off to the front server.
+    Conditional requests matching the file's ETag/Last-Modified are answered with
+    304 Not Modified without opening the file, and single byte ranges are answered
+    with 206 Partial Content.
+    Keyword arguments are passed to the Cache-Control header.
+    """
+    stat_result = os.stat(file_path)
+    etag = file_etag(stat_result)
+    last_modified = int(stat_result.st_mtime)
+    response: HttpResponseBase | None = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if response is None:
+        content_type = guess_content_type(file_path)
+        response = _sendfile_response(file_path, content_type)
+    if response is None and if_range_matches(request, etag, last_modified):
+        response = _range_response(
+            request, file_path, content_type, stat_result.st_size
+        )
+    if response is None:
+        file_response = FileResponse(open(file_path, "rb"), content_type=content_type)
+        file_response.block_size = settings.IMAGE_STREAM_CHUNK_SIZE
+        response = file_response
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    _count_sent_bytes(response)
+    return response
+
+
+def send_content(
+    request: Request,
+    content: bytes,
+    content_type: str,
+    etag: str,
+    last_modified: int,
+    **cache_control,
+) -> HttpResponseBase:
+    """
+    Returns a response that delivers file contents already held in memory,
+    with the same conditional request and byte range handling as send_file.
+    """
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    range_header = request.META.get("HTTP_RANGE")
+    if (
+        response is None
+        and range_header
+        and if_range_matches(request, etag, last_modified)
+    ):
+        try:
+            byte_range = parse_range_header(range_header, len(content))
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{len(content)}"
+        else:
+            if byte_range is not None:
+                first_byte, last_byte = byte_range
+                response = HttpResponse(
+                    content[first_byte : last_byte + 1],
+                    status=206,
+                    content_type=content_type,
+                )
+                response["Content-Range"] = (
+                    f"bytes {first_byte}-{last_byte}/{len(content)}"
+                )
+    if response is None:
+        response = HttpResponse(content, content_type=content_type)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    _count_sent_bytes(response)
+    return response
+
+
+def _count_sent_bytes(response: HttpResponseBase) -> None:
+    """
+    Counts the bytes of the image in the response body. Transfers handed off to the
+    front server have no body, and are not counted.
+    """
+    if response.status_code not in (200, 206):
+        return
+    if isinstance(response, HttpResponse):
+        count_bytes("out", len(response.content))
+    else:  # streaming
+        count_bytes("out", int(response.get("Content-Length", "0")))
+
+
+async def _read_streaming_content(
+    response: StreamingHttpResponse,
+) -> AsyncIterator[bytes]:
+    """
+    Yields the chunks of the streaming response, reading each one in a worker thread.
+    """
+    chunks = iter(response.streaming_content)
+
+    def read_chunk() -> bytes | None:
+        return next(chunks, None)
+
+    while True:
+        chunk = await asyncio.to_thread(read_chunk)
+        if chunk is None:
+            break
+        yield chunk
+
+
+def stream_async(response: HttpResponseBase) -> HttpResponseBase:
+    """
+    Lets ASGI servers stream the response without blocking the event loop on disk reads:
+    streaming responses get an async_streaming_content iterator, which
+    images.asgi.StreamingASGIHandler sends instead of iterating the response itself.
+    Other servers (and the test client) still iterate the response as usual.
+    """
+    if isinstance(response, StreamingHttpResponse):
+        setattr(
+            response, "async_streaming_content", _read_streaming_content(response)
+        )
+    return response
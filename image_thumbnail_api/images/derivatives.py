@@ -0,0 +1,90 @@
+import fcntl
+import hashlib
+import json
+import os
+from typing import Iterable
+
+from django.conf import settings
+
+from users.models import ThumbnailSize
+from .metrics import count_cache_request
+from .thumbnails import encoder_options, render_thumbnail_files, thumbnail_name
+
+
+def hash_chunks(chunks: Iterable[bytes]) -> str:
+    """
+    Returns the SHA-256 hex digest of the content, e.g. of UploadedFile.chunks().
+    """
+    sha256 = hashlib.sha256()
+    for chunk in chunks:
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def compute_content_hash(file_path: str) -> str:
+    """
+    Returns the SHA-256 hex digest of the file, read in chunks.
+    """
+    with open(file_path, "rb") as f:
+        return hash_chunks(
+            iter(lambda: f.read(settings.IMAGE_STREAM_CHUNK_SIZE), b"")
+        )
+
+
+def derivative_path(content_hash: str, size: ThumbnailSize, file_extension: str) -> str:
+    """
+    Returns the path of the derivative in the cache. Derivatives are keyed by the hash
+    of their source, their size and a digest of their encoder options (so changed options
+    or qualities are rendered again), and sharded by the first bytes of the hash,
+    e.g. "ab/cd/abcd..._1a2b3c4d_200px_thumbnail.jpg".
+    """
+    image_format, options = encoder_options(f"thumbnail{file_extension}", size)
+    options_digest = hashlib.sha256(
+        json.dumps([image_format, options], sort_keys=True).encode()
+    ).hexdigest()[:8]
+    return os.path.join(
+        settings.IMAGE_DERIVATIVE_CACHE_DIR,
+        content_hash[:2],
+        content_hash[2:4],
+        thumbnail_name(f"{content_hash}_{options_digest}{file_extension}", size),
+    )
+
+
+def get_or_render_derivative(original_image_path: str, content_hash: str, size: ThumbnailSize) -> str:
+    """
+    Returns the path of the derivative of the image, rendering it on the first request.
+    Concurrent first requests (from any thread or process) wait for a single render,
+    holding a lock file that is removed once the derivative exists.
+    """
+    file_extension = os.path.splitext(original_image_path)[1]
+    path = derivative_path(content_hash, size, file_extension)
+    if os.path.exists(path):
+        count_cache_request("derivative", True)
+        return path
+    count_cache_request("derivative", False)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock_path = f"{path}.lock"
+    while not os.path.exists(path):  # written atomically by save_thumbnail
+        with open(lock_path, "wb") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not _holds_lock(lock_path, lock_file):
+                    continue  # removed by the render we waited for
+                try:
+                    if not os.path.exists(path):
+                        render_thumbnail_files(original_image_path, {size: path})
+                finally:
+                    os.remove(lock_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return path
+
+
+def _holds_lock(lock_path: str, lock_file) -> bool:
+    """
+    Returns True if the locked file is still the lock file at the path.
+    """
+    try:
+        return os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
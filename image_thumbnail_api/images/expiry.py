@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.files.storage import Storage
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import ExpiringImage
+from .uploads import delete_stale_uploads
+
+logger = logging.getLogger(__name__)
+
+
+class SweepResult(NamedTuple):
+    deleted_images: int
+    reclaimed_bytes: int
+
+
+def sweep_expired_images(batch_size: int = 500, dry_run: bool = False) -> SweepResult:
+    """
+    Deletes expired images and their files in batches, returns how many images
+    were deleted and how many bytes were reclaimed (or would be, in a dry run).
+    Files sharing their content with other files (e.g. copied expiring images linked
+    to the blob of their original) reclaim nothing.
+    """
+    now = timezone.now()
+    deleted_images = 0
+    reclaimed_bytes = 0
+    last_pk = 0
+    while True:
+        batch = list(
+            ExpiringImage.objects.filter(expires_at__lte=now, pk__gt=last_pk).order_by(
+                "pk"
+            )[:batch_size]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for image in batch:
+            storage = image.image.storage
+            if image.image.name and storage.exists(image.image.name):
+                reclaimed_bytes += _reclaimable_size(storage, image.image.name)
+                if not dry_run:
+                    storage.delete(image.image.name)
+        if not dry_run:
+            ExpiringImage.objects.filter(pk__in=[image.pk for image in batch]).delete()
+        deleted_images += len(batch)
+    return SweepResult(deleted_images, reclaimed_bytes)
+
+
+def _reclaimable_size(storage: Storage, name: str) -> int:
+    if hasattr(storage, "reclaimable_size"):
+        return storage.reclaimable_size(name)
+    return storage.size(name)
+
+
+def start_expiry_sweeper(interval: float) -> threading.Thread:
+    """
+    Starts a daemon thread sweeping expired images (and stale uploads) every interval seconds.
+    """
+
+    def sweep_periodically():
+        while True:
+            try:
+                result = sweep_expired_images()
+                if result.deleted_images:
+                    logger.info(
+                        "Deleted %d expired images, reclaimed %d bytes",
+                        result.deleted_images,
+                        result.reclaimed_bytes,
+                    )
+                delete_stale_uploads(settings.IMAGE_UPLOAD_TIMEOUT)
+            except Exception:
+                logger.exception("Sweeping expired images failed")
+            finally:
+                close_old_connections()
+            time.sleep(interval)
+
+    thread = threading.Thread(
+        target=sweep_periodically, name="expiry-sweeper", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+_server_sweeper: threading.Thread | None = None
+
+
+def start_server_expiry_sweeper() -> threading.Thread | None:
+    """
+    Starts the sweeper in a server process, if IMAGE_EXPIRY_SWEEP_INTERVAL is set.
+    Called by the WSGI and ASGI applications only (runserver loads the WSGI one in the
+    process serving requests), so other management commands (migrate, shell, workers)
+    and the runserver reloader never sweep.
+    """
+    global _server_sweeper
+    if settings.IMAGE_EXPIRY_SWEEP_INTERVAL is None:
+        return None
+    if _server_sweeper is None:
+        _server_sweeper = start_expiry_sweeper(settings.IMAGE_EXPIRY_SWEEP_INTERVAL)
+    return _server_sweeper
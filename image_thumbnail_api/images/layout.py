@@ -0,0 +1,29 @@
+import hashlib
+import os
+
+from django.conf import settings
+
+
+def shard_directories(file_name: str) -> str:
+    """
+    Returns the directories the file is stored in, below its user's (or the expiring images')
+    directory: IMAGE_MEDIA_SHARD_LEVELS levels named by the first bytes of the SHA-256
+    of the file name, e.g. "ab/cd". Returns an empty string if sharding is disabled.
+    """
+    digest = hashlib.sha256(file_name.encode()).hexdigest()
+    return "/".join(
+        digest[2 * level : 2 * level + 2]
+        for level in range(settings.IMAGE_MEDIA_SHARD_LEVELS)
+    )
+
+
+def sharded_name(directory: str, file_name: str) -> str:
+    """
+    Returns the name of the file in the sharded layout of the directory,
+    e.g. "1/images/ab/cd/photo.jpg".
+    """
+    file_name = os.path.basename(file_name)
+    shards = shard_directories(file_name)
+    if not shards:
+        return f"{directory}/{file_name}"
+    return f"{directory}/{shards}/{file_name}"
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from images.storage import get_image_storage
+
+
+class Command(BaseCommand):
+    help = "Deletes the blobs of the content-addressed image storage that no file refers to."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted.",
+        )
+
+    def handle(self, *args, **options):
+        storage = get_image_storage()
+        if not hasattr(storage, "collect_garbage"):
+            raise CommandError("The image storage does not keep blobs")
+        result = storage.collect_garbage(options["dry_run"])
+        prefix = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(
+            f"{prefix} {result.deleted_blobs} unreferenced blobs, "
+            f"reclaiming {result.reclaimed_bytes} bytes"
+        )
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from images.relocation import relocate_media_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves image, thumbnail and expiring image files stored before the sharded media "
+        "layout into it. Safe to run while serving, and to interrupt and run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of images moved per query.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to wait between batches, to limit the load on the storage.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be moved.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.IMAGE_MEDIA_SHARD_LEVELS:
+            raise CommandError("The sharded media layout is disabled")
+        result = relocate_media_files(
+            options["batch_size"], options["dry_run"], options["pause"]
+        )
+        prefix = "Would move" if options["dry_run"] else "Moved"
+        self.stdout.write(
+            f"{prefix} {result.moved_images} images and "
+            f"{result.moved_expiring_images} expiring images, "
+            f"skipped {result.skipped_images} images"
+        )
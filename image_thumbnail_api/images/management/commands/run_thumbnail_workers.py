@@ -0,0 +1,45 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from images.workers import requeue_stale_jobs, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Renders queued thumbnails in a pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before polling an empty queue again.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty.",
+        )
+
+    def handle(self, *args, **options):
+        requeued = requeue_stale_jobs(settings.IMAGE_THUMBNAIL_JOB_TIMEOUT)
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} stale jobs")
+        with ProcessPoolExecutor(max_workers=options["processes"]) as executor:
+            while True:
+                processed = run_pending_jobs(executor, options["processes"] * 2)
+                if processed:
+                    self.stdout.write(f"Processed {processed} jobs")
+                    continue
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from images.expiry import sweep_expired_images
+from images.uploads import delete_stale_uploads
+
+
+class Command(BaseCommand):
+    help = "Deletes expired expiring images and their files, and stale chunked uploads."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of images deleted per query.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted.",
+        )
+
+    def handle(self, *args, **options):
+        result = sweep_expired_images(options["batch_size"], options["dry_run"])
+        prefix = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(
+            f"{prefix} {result.deleted_images} expired images, "
+            f"reclaiming {result.reclaimed_bytes} bytes"
+        )
+        if not options["dry_run"]:
+            deleted_uploads = delete_stale_uploads(settings.IMAGE_UPLOAD_TIMEOUT)
+            self.stdout.write(f"Deleted {deleted_uploads} stale uploads")
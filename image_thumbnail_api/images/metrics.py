@@ -0,0 +1,250 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject
+
+# Upper bounds of the stage duration buckets, in seconds
+DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+STAGE_DURATION = "image_stage_duration_seconds"
+TRANSFERRED_BYTES = "image_transferred_bytes_total"
+CACHE_REQUESTS = "image_cache_requests_total"
+
+DESCRIPTIONS = {
+    STAGE_DURATION: ("histogram", "Time spent in each image processing stage."),
+    TRANSFERRED_BYTES: ("counter", "Bytes of images received and sent."),
+    CACHE_REQUESTS: ("counter", "Lookups in the file and derivative caches."),
+}
+
+
+# Samples recorded during the current request, labelled with the user's tier once it is known
+_request_samples: ContextVar[list | None] = ContextVar("request_samples", default=None)
+
+
+class Registry:
+    """
+    Histograms and counters of this process, keyed by metric name and labels.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.histograms: dict[tuple, list] = {}  # bucket counts, then count and sum
+        self.counters: dict[tuple, float] = {}
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        with self.__lock:
+            histogram = self.histograms.setdefault(
+                (name, labels), [0] * (len(DURATION_BUCKETS) + 2)
+            )
+            bucket = bisect_left(DURATION_BUCKETS, value)
+            if bucket < len(DURATION_BUCKETS):
+                histogram[bucket] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def increment(self, name: str, labels: tuple, value: float) -> None:
+        with self.__lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.__lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        for name, (metric_type, description) in DESCRIPTIONS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (metric_name, labels), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for upper_bound, bucket_count in zip(DURATION_BUCKETS, histogram):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{name}_bucket{{{_labels(labels, le=upper_bound)}}} {cumulative}"
+                    )
+                lines.append(
+                    f'{name}_bucket{{{_labels(labels, le="+Inf")}}} {histogram[-2]}'
+                )
+                lines.append(f"{name}_count{{{_labels(labels)}}} {histogram[-2]}")
+                lines.append(f"{name}_sum{{{_labels(labels)}}} {histogram[-1]}")
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{{{_labels(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: tuple, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in pairs)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+def _record(kind: str, name: str, labels: tuple, value: float) -> None:
+    request_samples = _request_samples.get()
+    if request_samples is not None:
+        request_samples.append((kind, name, labels, value))
+    elif kind == "observe":
+        registry.observe(name, labels + (("tier", "none"),), value)
+    else:
+        registry.increment(name, labels + (("tier", "none"),), value)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Records the duration of the block in the histogram of the stage.
+    """
+    if not settings.IMAGE_METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(
+            "observe", STAGE_DURATION, (("stage", stage),), time.perf_counter() - start
+        )
+
+
+@contextmanager
+def collect_samples() -> Iterator[list]:
+    """
+    Collects the samples recorded in the block instead of recording them,
+    e.g. in a worker process, to be recorded in the parent with record_samples.
+    """
+    samples: list = []
+    token = _request_samples.set(samples)
+    try:
+        yield samples
+    finally:
+        _request_samples.reset(token)
+
+
+def record_samples(samples: list) -> None:
+    """
+    Records the samples collected by collect_samples.
+    """
+    for kind, name, labels, value in samples:
+        _record(kind, name, labels, value)
+
+
+def count_bytes(direction: str, size: int) -> None:
+    """
+    Counts bytes of images received ("in") or sent ("out").
+    """
+    if settings.IMAGE_METRICS_ENABLED and size:
+        _record("increment", TRANSFERRED_BYTES, (("direction", direction),), size)
+
+
+def count_cache_request(cache: str, hit: bool) -> None:
+    """
+    Counts a lookup in the cache ("file" or "derivative").
+    """
+    if settings.IMAGE_METRICS_ENABLED:
+        labels = (("cache", cache), ("result", "hit" if hit else "miss"))
+        _record("increment", CACHE_REQUESTS, labels, 1)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper recording the duration of queries in the "db" stage.
+    """
+    with timed("db"):
+        return execute(sql, params, many, context)
+
+
+def request_tier(request: HttpRequest) -> str:
+    """
+    Returns the name of the tier of the user authenticated by the API view, or "anonymous".
+    Users authenticated by sessions (e.g. in the admin) are not loaded just for the label.
+    """
+    user = getattr(request, "user", None)
+    if user is None or isinstance(user, SimpleLazyObject) or not user.is_authenticated:
+        return "anonymous"
+    tier = user.tier  # loaded with the user by TierTokenAuthentication
+    return tier.name if tier is not None else "none"
+
+
+class MetricsMiddleware:
+    """
+    Collects the samples recorded while handling a request, and labels them with
+    the tier of the authenticated user (which is only known once the view has run).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request: HttpRequest):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not settings.IMAGE_METRICS_ENABLED:
+            return self.get_response(request)
+        request_samples: list = []
+        token = _request_samples.set(request_samples)
+        try:
+            return self.get_response(request)
+        finally:
+            _request_samples.reset(token)
+            self.__flush(request, request_samples)
+
+    async def __acall__(self, request: HttpRequest):
+        if not settings.IMAGE_METRICS_ENABLED:
+            return await self.get_response(request)
+        request_samples: list = []
+        token = _request_samples.set(request_samples)
+        try:
+            return await self.get_response(request)
+        finally:
+            _request_samples.reset(token)
+            self.__flush(request, request_samples)
+
+    def __flush(self, request: HttpRequest, request_samples: list) -> None:
+        if not request_samples:
+            return
+        tier = (("tier", request_tier(request)),)
+        for kind, name, labels, value in request_samples:
+            if kind == "observe":
+                registry.observe(name, labels + tier, value)
+            else:
+                registry.increment(name, labels + tier, value)
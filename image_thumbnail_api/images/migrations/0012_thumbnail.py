@@ -0,0 +1,42 @@
+# Generated by Django 4.0.5 on 2026-10-18 17:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0011_image_content_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Thumbnail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "thumbnail",
+                    models.FileField(max_length=255, unique=True, upload_to=""),
+                ),
+                ("height", models.IntegerField()),
+                ("width", models.IntegerField(blank=True, null=True)),
+                (
+                    "image",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="thumbnails",
+                        to="images.image",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.0.5 on 2026-10-18 17:52
+
+import os
+import re
+
+from django.conf import settings
+from django.db import migrations
+
+THUMBNAIL_NAME_RE = re.compile(
+    r"^(?P<root>.+)_(?:(?P<width>\d+)x)?(?P<height>\d+)px_thumbnail\.\w+$"
+)
+
+
+def backfill_thumbnails(apps, schema_editor):
+    """
+    Record the thumbnail files already rendered next to the images
+    """
+    Image = apps.get_model("images", "Image")
+    Thumbnail = apps.get_model("images", "Thumbnail")
+    images_by_directory = {}
+    for image in Image.objects.only("pk", "original_image").iterator():
+        directory, file_name = os.path.split(image.original_image.name)
+        file_root = os.path.splitext(file_name)[0]
+        images_by_directory.setdefault(directory, {})[file_root] = image.pk
+    for directory, images in images_by_directory.items():
+        try:
+            file_names = os.listdir(os.path.join(settings.MEDIA_ROOT, directory))
+        except FileNotFoundError:
+            continue
+        thumbnails = []
+        for file_name in file_names:
+            match = THUMBNAIL_NAME_RE.match(file_name)
+            if match is None or match["root"] not in images:
+                continue
+            thumbnails.append(
+                Thumbnail(
+                    image_id=images[match["root"]],
+                    thumbnail=f"{directory}/{file_name}",
+                    height=int(match["height"]),
+                    width=int(match["width"]) if match["width"] else None,
+                )
+            )
+        Thumbnail.objects.bulk_create(
+            thumbnails, batch_size=1000, ignore_conflicts=True
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0012_thumbnail"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_thumbnails, migrations.RunPython.noop),
+    ]
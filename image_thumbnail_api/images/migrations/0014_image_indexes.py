@@ -0,0 +1,34 @@
+# Generated by Django 4.0.5 on 2026-10-18 17:51
+
+from django.db import migrations, models
+import images.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0013_backfill_thumbnails"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="expiringimage",
+            name="image",
+            field=models.ImageField(
+                unique=True, upload_to=images.models.expiring_image_upload_location
+            ),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="original_image",
+            field=models.ImageField(
+                unique=True, upload_to=images.models.image_upload_location
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="image",
+            index=models.Index(
+                fields=["user", "created_at"], name="images_imag_user_id_b07e21_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.0.5 on 2026-10-18 17:58
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_expires_at(apps, schema_editor):
+    ExpiringImage = apps.get_model("images", "ExpiringImage")
+    for image in ExpiringImage.objects.only("created_at", "live_time").iterator():
+        created_at = image.created_at or timezone.now()
+        image.expires_at = created_at + timedelta(seconds=image.live_time)
+        image.save(update_fields=["expires_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0014_image_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="expiringimage",
+            name="expires_at",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="expiringimage",
+            name="expires_at",
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
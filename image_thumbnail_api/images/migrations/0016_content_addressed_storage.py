@@ -0,0 +1,48 @@
+# Generated by Django 4.0.5 on 2026-10-18 17:58
+
+from django.db import migrations, models
+import images.models
+import images.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0015_expiringimage_expires_at"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="expiringimage",
+            name="image",
+            field=models.ImageField(
+                storage=images.storage.get_image_storage,
+                unique=True,
+                upload_to=images.models.expiring_image_upload_location,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="content_hash",
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="original_image",
+            field=models.ImageField(
+                storage=images.storage.get_image_storage,
+                unique=True,
+                upload_to=images.models.image_upload_location,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="thumbnail",
+            name="thumbnail",
+            field=models.FileField(
+                max_length=255,
+                storage=images.storage.get_image_storage,
+                unique=True,
+                upload_to="",
+            ),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.0.5 on 2026-10-18 18:14
+
+from django.db import migrations, models
+import images.models
+import images.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0017_imageupload"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MovedFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("old_name", models.CharField(max_length=255, unique=True)),
+                ("new_name", models.CharField(max_length=255)),
+                ("moved_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="expiringimage",
+            name="image",
+            field=models.ImageField(
+                max_length=255,
+                storage=images.storage.get_image_storage,
+                unique=True,
+                upload_to=images.models.expiring_image_upload_location,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="original_image",
+            field=models.ImageField(
+                max_length=255,
+                storage=images.storage.get_image_storage,
+                unique=True,
+                upload_to=images.models.image_upload_location,
+            ),
+        ),
+    ]
@@ -1,20 +1,27 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+from users.models import ThumbnailSize
+from .layout import sharded_name
+from .storage import get_image_storage
 
 
 def image_upload_location(instance, filename, **kwargs):
     """
-    Location for the image file
+    Location for the image file, sharded below the user's directory
     """
-    file_path = f"{instance.user.id}/images/{filename}"
-    return file_path
+    return sharded_name(f"{instance.user.id}/images", filename)
 
 
 def expiring_image_upload_location(instance, filename, **kwargs):
     """
-    Location for the expiring image file
+    Location for the expiring image file, sharded below the expiring images' directory
     """
-    file_path = f"expiring-images/{filename}"
-    return file_path
+    return sharded_name("expiring-images", filename)
 
 
 class ExpiringImage(models.Model):
@@ -23,13 +30,24 @@ class ExpiringImage(models.Model):
     """
 
     user = models.ForeignKey("users.User", on_delete=models.CASCADE)
-    image = models.ImageField(upload_to=expiring_image_upload_location)
+    image = models.ImageField(
+        upload_to=expiring_image_upload_location,
+        storage=get_image_storage,
+        unique=True,
+        max_length=255,
+    )
     live_time = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True, null=True)
+    expires_at = models.DateTimeField(db_index=True)
 
     def __str__(self):
         return self.image.url
 
+    def save(self, *args, **kwargs):
+        if self.expires_at is None:
+            self.expires_at = timezone.now() + timedelta(seconds=int(self.live_time))
+        super().save(*args, **kwargs)
+
 
 class Image(models.Model):
     """
@@ -37,8 +55,103 @@ class Image(models.Model):
     """
 
     user = models.ForeignKey("users.User", on_delete=models.CASCADE)
-    original_image = models.ImageField(upload_to=image_upload_location)
+    original_image = models.ImageField(
+        upload_to=image_upload_location,
+        storage=get_image_storage,
+        unique=True,
+        max_length=255,
+    )
+    content_hash = models.CharField(
+        max_length=64, blank=True, db_index=True
+    )  # SHA-256 of the file
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "created_at"])]
+
     def __str__(self):
         return self.original_image.url
+
+
+class Thumbnail(models.Model):
+    """
+    This model is used to store the thumbnails rendered next to an image.
+    """
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="thumbnails")
+    thumbnail = models.FileField(
+        max_length=255, storage=get_image_storage, unique=True
+    )
+    height = models.IntegerField()
+    width = models.IntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return self.thumbnail.url
+
+
+class ThumbnailJob(models.Model):
+    """
+    This model is used to queue thumbnail generation, when thumbnails are rendered by background workers.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    image = models.ForeignKey(
+        Image, on_delete=models.CASCADE, related_name="thumbnail_jobs"
+    )
+    sizes = models.JSONField()  # thumbnail sizes in the form stored in Tier.thumbnail_sizes
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True
+    )
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.image} ({self.status})"
+
+    def get_thumbnail_sizes(self) -> list[ThumbnailSize]:
+        return [ThumbnailSize.from_json(item) for item in self.sizes]
+
+
+class ImageUpload(models.Model):
+    """
+    This model is used to track chunked uploads, whose chunks are appended to a partial file
+    until the upload is finalized into an Image.
+    """
+
+    user = models.ForeignKey("users.User", on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()  # announced size of the file, in bytes
+    offset = models.BigIntegerField(default=0)  # bytes received so far
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.file_name} ({self.offset}/{self.size})"
+
+    @property
+    def partial_file_path(self) -> str:
+        return os.path.join(settings.IMAGE_UPLOAD_DIR, f"{self.pk}.part")
+
+
+class MovedFile(models.Model):
+    """
+    This model is used to keep the links to files moved into the sharded media layout working.
+    """
+
+    old_name = models.CharField(max_length=255, unique=True)
+    new_name = models.CharField(max_length=255)
+    moved_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.old_name} -> {self.new_name}"
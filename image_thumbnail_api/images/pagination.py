@@ -0,0 +1,72 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CreatedAtCursorPagination(BasePagination):
+    """
+    Keyset pagination on (created_at, pk), so every page costs the same however deep it is.
+    The body stays a plain list, the next page is linked in the Link header.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def __encode_cursor(self, created_at: datetime, pk: int) -> str:
+        position = f"{created_at.isoformat()}|{pk}"
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def __decode_cursor(self, cursor: str) -> tuple[datetime, int]:
+        try:
+            position = base64.urlsafe_b64decode(cursor.encode()).decode()
+            created_at, pk = position.split("|")
+            return datetime.fromisoformat(created_at), int(pk)
+        except ValueError:
+            raise NotFound("Invalid cursor")
+
+    def get_page_size(self, request: Request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.IMAGE_LIST_PAGE_SIZE
+        return min(max(page_size, 1), settings.IMAGE_LIST_MAX_PAGE_SIZE)
+
+    def paginate_queryset(
+        self, queryset: QuerySet, request: Request, view=None
+    ) -> list:
+        self.request = request
+        cursor = request.query_params.get(self.cursor_query_param)
+        queryset = queryset.order_by("created_at", "pk")
+        if cursor:
+            created_at, pk = self.__decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+            )
+        page_size = self.get_page_size(request)
+        page = list(queryset[: page_size + 1])
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_cursor = self.__encode_cursor(page[-1].created_at, page[-1].pk)
+        return page
+
+    def get_next_link(self) -> str | None:
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor
+        )
+
+    def get_paginated_response(self, data) -> Response:
+        headers = {}
+        next_link = self.get_next_link()
+        if next_link is not None:
+            headers["Link"] = f'<{next_link}>; rel="next"'
+        return Response(data, headers=headers)
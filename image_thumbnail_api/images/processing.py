@@ -0,0 +1,146 @@
+import os
+from typing import Sequence, cast
+
+from django.conf import settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from users.models import ThumbnailSize, Tier, User
+from .metrics import timed
+from .models import ExpiringImage, Image, ThumbnailJob
+from .signing import signed_image_url
+from .thumbnails import (
+    deduplicate_thumbnails,
+    record_thumbnails,
+    render_stored_thumbnails,
+    reuse_thumbnails,
+    thumbnail_urls,
+)
+
+
+def queue_thumbnails(
+    image_instance: Image, sizes: Sequence[ThumbnailSize]
+) -> ThumbnailJob | None:
+    """
+    Queues the thumbnails of the image that were not already rendered for the same content.
+    Returns the job, or None if every thumbnail was reused.
+    """
+    sizes = reuse_thumbnails(image_instance, sizes)
+    if not sizes:
+        return None
+    return ThumbnailJob.objects.create(
+        image=image_instance, sizes=[size.to_json() for size in sizes]
+    )
+
+
+def thumbnail_processing(image_instance: Image, sizes: Sequence[ThumbnailSize]) -> dict:
+    """
+    Renders thumbnails of the image, queues them for the background workers
+    in async mode, or leaves them to be rendered on their first request in lazy mode.
+    Thumbnails already rendered for the same content are reused.
+    Returns thumbnail urls (and the job url in async mode).
+    """
+    data = thumbnail_urls(image_instance, sizes)
+    if settings.IMAGE_THUMBNAIL_RENDERING == "lazy":
+        return data
+    if settings.IMAGE_THUMBNAIL_RENDERING == "async":
+        job = queue_thumbnails(image_instance, sizes)
+        if job is not None:
+            data["thumbnail_job"] = reverse("thumbnail-job", args=[job.pk])
+        return data
+    sizes = reuse_thumbnails(image_instance, sizes)
+    if sizes:
+        render_stored_thumbnails(image_instance.original_image.name, sizes)
+        deduplicate_thumbnails(image_instance, sizes)
+        record_thumbnails(image_instance, sizes)
+    return data
+
+
+def expiring_link_processing(image_instance: Image, live_time: int) -> str:
+    """
+    Returns a link to the image that expires after live_time seconds.
+    Signed links are computed, copied links store a copy of the image.
+    """
+    if settings.IMAGE_EXPIRING_LINKS == "signed":
+        return signed_image_url(image_instance, live_time)
+    expiring_image = ExpiringImage.objects.create(
+        user=image_instance.user, live_time=live_time
+    )
+    with timed("copy"):
+        expiring_image.image.save(
+            os.path.basename(image_instance.original_image.name),
+            image_instance.original_image,
+        )
+    return expiring_image.image.url
+
+
+def user_tier(request: Request) -> Tier | None:
+    """
+    Returns the tier of the user authenticated by TierTokenAuthentication.
+    """
+    return cast(User, request.user).tier
+
+
+def get_live_time(request: Request) -> int | None:
+    """
+    Returns the requested live time of the expiring link in seconds, or None if the user's
+    tier has none. Raises ValueError if it is missing, not a number or out of bounds.
+    Called before the image is stored, so invalid requests leave nothing behind.
+    """
+    tier = user_tier(request)
+    if tier is None or not tier.ability_to_fetch_expiring_link:
+        return None
+    try:
+        live_time = int(request.data["live_time"])
+    except KeyError:
+        raise ValueError("No live_time field")
+    except (TypeError, ValueError):
+        raise ValueError("Live time must be a whole number of seconds")
+    if live_time < 300 or live_time > 3000:
+        raise ValueError("Live time must be between 300 and 3000 seconds")
+    return live_time
+
+
+def link_processing(image_instance: Image, live_time: int | None) -> dict:
+    """
+    Returns the original and expiring links to the image the user's tier gives access to.
+    """
+    data = {}
+    tier = image_instance.user.tier
+    if tier is not None and tier.presence_of_original_file_link:
+        data["original_image"] = image_instance.original_image.url
+    if live_time is not None:
+        data[f"{live_time}s_expiring_link"] = expiring_link_processing(
+            image_instance, live_time
+        )
+    return data
+
+
+def discard_image(image_instance: Image) -> None:
+    """
+    Deletes a stored image that could not be processed, with its file.
+    """
+    image_instance.original_image.delete(save=False)
+    image_instance.delete()
+
+
+def tier_processing(request: Request, image_instance: Image, live_time: int | None) -> Response:
+    """
+    Processes the uploaded image according to the user's tier, with the live time
+    of its expiring link returned by get_live_time().
+    Returns 201, or 202 if thumbnails are still being generated, or 400 (and deletes
+    the image) if it can not be decoded.
+    """
+    tier = image_instance.user.tier
+    try:
+        data = thumbnail_processing(image_instance, tier.get_thumbnail_sizes() if tier else ())
+    except ValueError as e:
+        discard_image(image_instance)
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    data.update(link_processing(image_instance, live_time))
+    data["success"] = "Image uploaded successfully"
+    if "thumbnail_job" in data:
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+    return Response(data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,215 @@
+import os
+import time
+from typing import Callable, NamedTuple
+
+from django.conf import settings
+from django.core.files.storage import Storage
+from django.db import transaction
+from django.utils import timezone
+
+from .layout import sharded_name
+from .models import ExpiringImage, Image, MovedFile, Thumbnail, ThumbnailJob
+from .storage import get_image_storage
+
+# Names of the files stored before the sharded layout, directly in the user's
+# (or the expiring images') directory.
+LEGACY_IMAGE_NAME = r"^[0-9]+/images/[^/]+$"
+LEGACY_EXPIRING_IMAGE_NAME = r"^expiring-images/[^/]+$"
+
+MAX_NAME_LENGTH = 255
+MAX_NAME_ATTEMPTS = 10
+
+
+class RelocationResult(NamedTuple):
+    moved_images: int
+    moved_expiring_images: int
+    skipped_images: int
+
+
+def moved_name(name: str) -> str | None:
+    """
+    Returns the name the file was moved to by relocate_media_files, or None.
+    """
+    return (
+        MovedFile.objects.filter(old_name=name)
+        .values_list("new_name", flat=True)
+        .first()
+    )
+
+
+def _plan_moves(
+    storage: Storage, name: str, thumbnail_names: list[str]
+) -> dict[str, str] | None:
+    """
+    Returns the new names of the image and its thumbnails, keyed by their old names.
+    Thumbnails keep their names relative to the image, so they can still be derived from it.
+    Returns None if no free names were found.
+    """
+    directory, file_name = name.rsplit("/", 1)
+    file_root = os.path.splitext(name)[0]
+    new_name = sharded_name(directory, file_name)
+    for _ in range(MAX_NAME_ATTEMPTS):
+        new_root = os.path.splitext(new_name)[0]
+        moves = {name: new_name}
+        for thumbnail_name in thumbnail_names:
+            moves[thumbnail_name] = new_root + thumbnail_name[len(file_root) :]
+        if all(
+            len(new) <= MAX_NAME_LENGTH and not storage.exists(new)
+            for new in moves.values()
+        ):
+            return moves
+        new_name = storage.get_alternative_name(
+            *os.path.splitext(sharded_name(directory, file_name))
+        )
+    return None
+
+
+def _copy_file(storage: Storage, name: str, new_name: str) -> None:
+    """
+    Stores the file under the new name too: as a link on storages that have them,
+    otherwise as a copy. Raises FileExistsError if the new name was taken meanwhile.
+    """
+    if hasattr(storage, "link"):
+        storage.link(name, new_name)
+        return
+    with storage.open(name) as f:
+        saved_name = storage.save(new_name, f, max_length=MAX_NAME_LENGTH)
+    if saved_name != new_name:
+        storage.delete(saved_name)
+        raise FileExistsError(new_name)
+
+
+def _move_files(
+    storage: Storage, moves: dict[str, str], update: Callable[[], bool]
+) -> bool:
+    """
+    Moves the files without making them unavailable: the files are copied under their
+    new names, update() switches the database rows to them, and only then the old files
+    are deleted. update() returns False if the rows changed meanwhile, in which case
+    nothing is moved. Every move is recorded in MovedFile, so old links keep working.
+    """
+    copied_names = []
+    try:
+        for name, new_name in moves.items():
+            if storage.exists(name):
+                _copy_file(storage, name, new_name)
+                copied_names.append(new_name)
+        with transaction.atomic():
+            if not update():
+                raise FileExistsError
+            MovedFile.objects.bulk_create(
+                [
+                    MovedFile(old_name=name, new_name=new_name)
+                    for name, new_name in moves.items()
+                ],
+                ignore_conflicts=True,
+            )
+    except FileExistsError:
+        for new_name in copied_names:
+            storage.delete(new_name)
+        return False
+    for name in moves:
+        storage.delete(name)
+    return True
+
+
+def _relocate_image(storage: Storage, image: Image) -> bool:
+    thumbnails = list(image.thumbnails.all())
+    name = image.original_image.name
+    moves = _plan_moves(
+        storage, name, [thumbnail.thumbnail.name for thumbnail in thumbnails]
+    )
+    if moves is None:
+        return False
+    new_name = moves[name]
+    new_thumbnail_names = [moves[thumbnail.thumbnail.name] for thumbnail in thumbnails]
+
+    def update() -> bool:
+        if not Image.objects.filter(pk=image.pk, original_image=name).update(
+            original_image=new_name
+        ):
+            return False
+        for thumbnail, new_thumbnail_name in zip(thumbnails, new_thumbnail_names):
+            Thumbnail.objects.filter(pk=thumbnail.pk).update(
+                thumbnail=new_thumbnail_name
+            )
+        return True
+
+    return _move_files(storage, moves, update)
+
+
+def _relocate_expiring_image(storage: Storage, image: ExpiringImage) -> bool:
+    name = image.image.name
+    moves = _plan_moves(storage, name, [])
+    if moves is None:
+        return False
+    new_name = moves[name]
+
+    def update() -> bool:
+        return bool(
+            ExpiringImage.objects.filter(pk=image.pk, image=name).update(
+                image=new_name
+            )
+        )
+
+    return _move_files(storage, moves, update)
+
+
+def relocate_media_files(
+    batch_size: int = 100, dry_run: bool = False, pause: float = 0
+) -> RelocationResult:
+    """
+    Moves the files of images (with their thumbnails) and live expiring images stored
+    before the sharded layout into it, in batches, pausing between batches.
+    Images are served during the move, and it can be interrupted and run again at any time:
+    only files still in the old layout are moved. Images whose thumbnails are being rendered
+    are skipped, to be moved by a later run.
+    """
+    if not settings.IMAGE_MEDIA_SHARD_LEVELS:
+        return RelocationResult(0, 0, 0)
+    storage = get_image_storage()
+    moved_images = moved_expiring_images = skipped_images = 0
+    last_pk = 0
+    while True:
+        batch = list(
+            Image.objects.filter(
+                original_image__regex=LEGACY_IMAGE_NAME, pk__gt=last_pk
+            )
+            .prefetch_related("thumbnails")
+            .order_by("pk")[:batch_size]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        busy_image_pks = set(
+            ThumbnailJob.objects.filter(
+                image__in=batch, status__in=[ThumbnailJob.PENDING, ThumbnailJob.RUNNING]
+            ).values_list("image_id", flat=True)
+        )
+        for image in batch:
+            if image.pk in busy_image_pks:
+                skipped_images += 1
+            elif dry_run or _relocate_image(storage, image):
+                moved_images += 1
+            else:
+                skipped_images += 1
+        time.sleep(pause)
+    last_pk = 0
+    while True:
+        expiring_batch = list(
+            ExpiringImage.objects.filter(
+                image__regex=LEGACY_EXPIRING_IMAGE_NAME,
+                expires_at__gt=timezone.now(),
+                pk__gt=last_pk,
+            ).order_by("pk")[:batch_size]
+        )
+        if not expiring_batch:
+            break
+        last_pk = expiring_batch[-1].pk
+        for expiring_image in expiring_batch:
+            if dry_run or _relocate_expiring_image(storage, expiring_image):
+                moved_expiring_images += 1
+            else:
+                skipped_images += 1
+        time.sleep(pause)
+    return RelocationResult(moved_images, moved_expiring_images, skipped_images)
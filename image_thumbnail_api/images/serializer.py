@@ -1,9 +1,56 @@
+from django.conf import settings
 from rest_framework import serializers
 
-from images.models import Image
+from images.models import Image, ThumbnailJob
+from images.thumbnails import thumbnail_urls
+from users.models import ThumbnailSize
 
 
 class ImageSerializer(serializers.ModelSerializer):
+    # a plain file field: the image header is checked by validate_image_header instead of
+    # opening the image with Pillow, and stored names are made unique by the storage
+    original_image = serializers.FileField()
+
     class Meta:
         model = Image
         fields = ("pk", "original_image", "created_at")
+
+
+class ImageListSerializer(serializers.ModelSerializer):
+    """
+    Serializes only the requested fields of the listed images.
+    Thumbnails are read from the prefetched thumbnails of each image (or, in lazy
+    rendering mode, built from the thumbnail_sizes in the context), to avoid a query per image.
+    """
+
+    default_fields = ("pk", "original_image", "created_at")
+
+    thumbnails = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Image
+        fields = ("pk", "original_image", "created_at", "thumbnails")
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field_name in set(self.fields) - set(fields or self.default_fields):
+            self.fields.pop(field_name)
+
+    def get_thumbnails(self, image: Image) -> dict:
+        if settings.IMAGE_THUMBNAIL_RENDERING == "lazy":
+            return thumbnail_urls(image, self.context["thumbnail_sizes"])
+        return {
+            f"{ThumbnailSize(thumbnail.height, thumbnail.width).label}_thumbnail": thumbnail.thumbnail.url
+            for thumbnail in image.thumbnails.all()
+        }
+
+
+class ThumbnailJobSerializer(serializers.ModelSerializer):
+    thumbnails = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ThumbnailJob
+        fields = ("pk", "status", "thumbnails", "error", "created_at", "updated_at")
+
+    def get_thumbnails(self, job: ThumbnailJob) -> dict:
+        return thumbnail_urls(job.image, job.get_thumbnail_sizes())
@@ -0,0 +1,455 @@
+import errno
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, NamedTuple
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.encoding import filepath_to_uri
+from django.utils.module_loading import import_string
+
+from .metrics import timed
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+class GarbageCollectionResult(NamedTuple):
+    deleted_blobs: int
+    reclaimed_bytes: int
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that keeps every distinct content once.
+    Files keep their usual names (and paths, and urls), but each of them is a hard link
+    to a blob named by the SHA-256 of its content, in directories sharded by the first
+    bytes of the hash (e.g. "ab/cd/abcd..."). The link count of a blob is its reference count:
+    deleting a file only drops a reference, and blobs left without any are deleted by
+    collect_garbage(). If hard links are not supported, files are stored as plain copies.
+    """
+
+    def __init__(self, blob_location: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.blob_location = os.path.abspath(blob_location or settings.IMAGE_BLOB_ROOT)
+
+    def blob_path(self, content_hash: str) -> str:
+        return os.path.join(
+            self.blob_location, content_hash[:2], content_hash[2:4], content_hash
+        )
+
+    def __hash_file(self, path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in _FileChunks(f).chunks():
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def __write_temporary_file(self, content) -> tuple[str, str]:
+        """
+        Writes the content next to the blobs while hashing it, returns its path and hash.
+        """
+        os.makedirs(self.blob_location, exist_ok=True)
+        sha256 = hashlib.sha256()
+        file_descriptor, temporary_path = tempfile.mkstemp(
+            dir=self.blob_location, suffix=".tmp"
+        )
+        with os.fdopen(file_descriptor, "wb") as f:
+            for chunk in content.chunks():
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                sha256.update(chunk)
+                f.write(chunk)
+        if self.file_permissions_mode is not None:
+            os.chmod(temporary_path, self.file_permissions_mode)
+        return temporary_path, sha256.hexdigest()
+
+    def __link(self, source: str, destination: str) -> None:
+        try:
+            os.link(source, destination)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            with open(destination, "xb") as f, open(source, "rb") as source_file:
+                shutil.copyfileobj(source_file, f)
+
+    def __store(self, temporary_path: str, content_hash: str, path: str) -> None:
+        """
+        Links the file to the blob of its content, storing the content as a new blob if needed.
+        """
+        blob_path = self.blob_path(content_hash)
+        try:
+            self.__link(blob_path, path)
+        except FileNotFoundError:  # new content, or its blob was just collected
+            self.__link(temporary_path, path)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                self.__link(temporary_path, blob_path)
+            except FileExistsError:  # stored concurrently, this file stays unshared
+                pass
+
+    def _save(self, name: str, content) -> str:
+        with timed("write"):
+            return self.__save(name, content)
+
+    def __save(self, name: str, content) -> str:
+        if hasattr(content, "temporary_file_path"):
+            # files already on disk (e.g. finished chunked uploads) are moved, not copied
+            temporary_path = content.temporary_file_path()
+            content_hash = getattr(content, "content_hash", None) or self.__hash_file(
+                temporary_path
+            )
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+        else:
+            temporary_path, content_hash = self.__write_temporary_file(content)
+        try:
+            while True:
+                path = self.path(name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    self.__store(temporary_path, content_hash, path)
+                    break
+                except FileExistsError:  # name taken since get_available_name()
+                    name = self.get_available_name(name)
+        finally:
+            os.remove(temporary_path)
+        return str(name).replace("\\", "/")
+
+    def deduplicate(self, name: str) -> None:
+        """
+        Replaces a file written directly to the file system (e.g. a rendered thumbnail)
+        with a link to the blob of its content, or makes it the blob of its content.
+        """
+        path = self.path(name)
+        blob_path = self.blob_path(self.__hash_file(path))
+        replacement_path = f"{path}.{os.getpid()}.link"
+        try:
+            self.__link(blob_path, replacement_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                self.__link(path, blob_path)
+            except FileExistsError:  # stored concurrently, this file stays unshared
+                pass
+            return
+        os.replace(replacement_path, path)
+
+    def link(self, source_name: str, name: str) -> None:
+        """
+        Stores the content of an existing file under another, free, name without copying it.
+        """
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__link(self.path(source_name), path)
+
+    def reclaimable_size(self, name: str) -> int:
+        """
+        Returns the bytes deleting the file frees (once unreferenced blobs are collected):
+        its size if no other file shares its content, otherwise 0.
+        """
+        stat_result = os.stat(self.path(name))
+        return stat_result.st_size if stat_result.st_nlink <= 2 else 0  # the file and its blob
+
+    def collect_garbage(self, dry_run: bool = False) -> GarbageCollectionResult:
+        """
+        Deletes the blobs no file refers to anymore.
+        """
+        deleted_blobs = 0
+        reclaimed_bytes = 0
+        for directory, _, file_names in os.walk(self.blob_location):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    continue
+                blob_path = os.path.join(directory, file_name)
+                stat_result = os.stat(blob_path)
+                if stat_result.st_nlink > 1:
+                    continue
+                if not dry_run:
+                    os.remove(blob_path)
+                deleted_blobs += 1
+                reclaimed_bytes += stat_result.st_size
+        return GarbageCollectionResult(deleted_blobs, reclaimed_bytes)
+
+
+class LocalFile(File):
+    """
+    File already written to the local disk (e.g. a finished chunked upload),
+    moved into the storage instead of copied when it is saved.
+    """
+
+    def __init__(self, path: str, content_hash: str | None = None):
+        super().__init__(open(path, "rb"), name=os.path.basename(path))
+        self.path = path
+        self.content_hash = content_hash  # saves hashing the file again, if known
+
+    def temporary_file_path(self) -> str:
+        return self.path
+
+
+class _FileChunks:
+    """
+    Minimal File-like wrapper giving chunks() of an open file.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def chunks(self):
+        return iter(lambda: self.f.read(settings.IMAGE_STREAM_CHUNK_SIZE), b"")
+
+
+class S3File(File):
+    """
+    Object of an S3 bucket, streamed from the current position with ranged GET requests.
+    Seeking only moves the position: the next read starts a new request from there.
+    """
+
+    def __init__(self, storage: "S3ImageStorage", name: str):
+        super().__init__(None, name=name)
+        self.storage = storage
+        self.mode = "rb"
+        self.__name = name
+        self.__position = 0
+        self.__size: int | None = None
+        self.__body: Any = None  # botocore's StreamingBody
+
+    @property
+    def size(self) -> int:
+        if self.__size is None:
+            self.__size = self.storage.size(self.__name)
+        return self.__size
+
+    def read(self, size: int = -1) -> bytes:
+        if self.__body is None:
+            try:
+                self.__body = self.storage.client.get_object(
+                    Bucket=self.storage.bucket_name,
+                    Key=self.storage.key(self.__name),
+                    Range=f"bytes={self.__position}-",
+                )["Body"]
+            except ClientError as e:
+                error_code = e.response["Error"]["Code"]
+                if error_code == "InvalidRange":  # at or past the end of the object
+                    return b""
+                if error_code in ("NoSuchKey", "404"):
+                    raise FileNotFoundError(self.name)
+                raise
+        data = self.__body.read(None if size < 0 else size)
+        self.__position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset != self.__position:
+            self.close()
+            self.__position = offset
+        return self.__position
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seekable(self) -> bool:
+        return True
+
+    def open(self, mode: str | None = None) -> "S3File":
+        self.seek(0)
+        return self
+
+    def readable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self.__body is None
+
+    def close(self) -> None:
+        if self.__body is not None:
+            self.__body.close()
+            self.__body = None
+
+
+class S3ImageStorage(Storage):
+    """
+    Storage in an S3-compatible bucket (AWS, MinIO, ...), using the optional boto3 package.
+    Files are written with multipart uploads above multipart_threshold bytes, and read
+    as streams. Urls point to the media views of the API, like for the local storages.
+    Credentials are found by boto3 (environment variables, configuration files or roles).
+    """
+
+    def __init__(
+        self,
+        bucket_name: str | None = None,
+        location: str = "",
+        endpoint_url: str | None = None,
+        region_name: str | None = None,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        multipart_chunksize: int = 8 * 1024 * 1024,
+    ):
+        if boto3 is None:
+            raise ImproperlyConfigured("S3ImageStorage requires the boto3 package")
+        self.bucket_name = bucket_name
+        self.location = location.strip("/")
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=region_name
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+        )
+
+    def key(self, name: str) -> str:
+        name = name.replace("\\", "/").lstrip("/")
+        return f"{self.location}/{name}" if self.location else name
+
+    def __head(self, name: str) -> dict | None:
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=self.key(name))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def _open(self, name: str, mode: str = "rb") -> S3File:
+        if "w" in mode or "a" in mode or "+" in mode:
+            raise ValueError("S3 files can only be opened for reading")
+        return S3File(self, name)
+
+    def _save(self, name: str, content) -> str:
+        with timed("write"):
+            return self.__save(name, content)
+
+    def __save(self, name: str, content) -> str:
+        if hasattr(content, "seek"):
+            content.seek(0)
+        content_type, _ = mimetypes.guess_type(name)
+        self.client.upload_fileobj(
+            content,
+            self.bucket_name,
+            self.key(name),
+            ExtraArgs={"ContentType": content_type or "application/octet-stream"},
+            Config=self.transfer_config,
+        )
+        if hasattr(content, "temporary_file_path"):  # moved, like on the local storages
+            try:
+                os.remove(content.temporary_file_path())
+            except FileNotFoundError:
+                pass
+        return name
+
+    def delete(self, name: str) -> None:
+        self.client.delete_object(Bucket=self.bucket_name, Key=self.key(name))
+
+    def exists(self, name: str) -> bool:
+        return self.__head(name) is not None
+
+    def size(self, name: str) -> int:
+        head = self.__head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["ContentLength"]
+
+    def get_modified_time(self, name: str):
+        head = self.__head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["LastModified"]
+
+    def listdir(self, path: str) -> tuple[list[str], list[str]]:
+        prefix = self.key(path).rstrip("/")
+        prefix = f"{prefix}/" if prefix else ""
+        directories, files = [], []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket_name, Prefix=prefix, Delimiter="/"
+        ):
+            for common_prefix in page.get("CommonPrefixes", []):
+                directories.append(common_prefix["Prefix"][len(prefix) :].rstrip("/"))
+            for item in page.get("Contents", []):
+                files.append(item["Key"][len(prefix) :])
+        return directories, files
+
+    def url(self, name: str | None) -> str:
+        return urljoin(settings.MEDIA_URL, filepath_to_uri(name or ""))
+
+
+def is_local(storage: Storage) -> bool:
+    """
+    Returns True if the files of the storage are on the local file system.
+    """
+    try:
+        storage.path("")
+    except NotImplementedError:
+        return False
+    return True
+
+
+def local_file_path(storage: Storage, name: str) -> str:
+    """
+    Returns a path of the stored file on the local disk: its own path on local storages,
+    or a copy streamed into IMAGE_REMOTE_CACHE_DIR on its first use for remote storages
+    (stored files are never modified, so copies stay valid). The copy keeps the modification
+    time of the stored file, so every node computes the same ETag.
+    The path does not exist if the file does not.
+    """
+    if is_local(storage):
+        return storage.path(name)
+    path = os.path.join(settings.IMAGE_REMOTE_CACHE_DIR, name)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with storage.open(name) as source, open(temporary_path, "wb") as f:
+            shutil.copyfileobj(source, f, settings.IMAGE_STREAM_CHUNK_SIZE)
+        modified_time = storage.get_modified_time(name).timestamp()
+        os.utime(temporary_path, (modified_time, modified_time))
+        os.replace(temporary_path, path)
+    except FileNotFoundError:
+        pass
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return path
+
+
+_image_storage: Storage | None = None
+
+
+def get_image_storage() -> Storage:
+    """
+    Returns the storage of image files, configured with IMAGE_STORAGE_BACKEND
+    and IMAGE_STORAGE_OPTIONS.
+    """
+    global _image_storage
+    if _image_storage is None:
+        _image_storage = import_string(settings.IMAGE_STORAGE_BACKEND)(
+            **settings.IMAGE_STORAGE_OPTIONS
+        )
+    return _image_storage
+
+
+@receiver(setting_changed)
+def reset_image_storage(sender, setting=None, **kwargs):
+    """
+    Rebuilds the image storage when its settings change.
+    """
+    global _image_storage
+    if setting in ("IMAGE_STORAGE_BACKEND", "IMAGE_STORAGE_OPTIONS"):
+        _image_storage = None
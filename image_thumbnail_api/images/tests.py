@@ -1,11 +1,79 @@
+import asyncio
+import hashlib
+import importlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage, Storage
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 from django.core.files.uploadedfile import SimpleUploadedFile
 
-from images.models import Image
-from users.models import User, Tier
+from images.asgi import StreamingASGIHandler
+from images.models import (
+    Image,
+    ExpiringImage,
+    ImageUpload,
+    MovedFile,
+    Thumbnail,
+    ThumbnailJob,
+)
+from images.batch import _spool, get_batch_executor
+from images.cache import LocalFileCache, get_file_cache
+from images.delivery import negotiate_format
+from images.derivatives import get_or_render_derivative
+from images.expiry import start_server_expiry_sweeper, sweep_expired_images
+from images.metrics import CACHE_REQUESTS, TRANSFERRED_BYTES, registry
+from images.signing import signed_image_url
+from images.storage import (
+    get_image_storage,
+    ContentAddressedStorage,
+    S3ImageStorage,
+    boto3,
+    is_local,
+    local_file_path,
+)
+from images.validation import read_image_header, validate_image_header
+from images.thumbnails import (
+    record_thumbnails,
+    render_stored_thumbnails,
+    render_thumbnail_files,
+    render_thumbnails,
+    thumbnail_name,
+)
+from images.views import async_expiring_image_access, async_image_access, async_media_view
+from images.workers import render_job, run_pending_jobs
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+from PIL import Image as PILImage
+from users.authentication import get_token_cache
+from users.models import User, Tier, ThumbnailSize, can_encode
 
 
 class ImageTests(APITestCase):
@@ -15,6 +83,7 @@ class ImageTests(APITestCase):
         """
         tier = Tier.objects.create(
             name="Premium",
+            thumbnail_sizes=[400, 200],
             presence_of_original_file_link=True,
             ability_to_fetch_expiring_link=False,
         )
@@ -46,6 +115,104 @@ class ImageTests(APITestCase):
         )  # 2 images from setUp that are owned by test user
         self.assertEqual(len(response.data), 2)
 
+    def test_upload_with_invalid_live_time(self):
+        """
+        Test that invalid live times are rejected before the image is stored
+        """
+        Tier.objects.update(ability_to_fetch_expiring_link=True)
+        token = Token.objects.get(user__username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        for live_time, error in (
+            ("abc", "Live time must be a whole number of seconds"),
+            ("5000", "Live time must be between 300 and 3000 seconds"),
+        ):
+            image = SimpleUploadedFile(
+                name="test_image.jpg",
+                content=open("images/test_images/test.jpg", "rb").read(),
+                content_type="image/jpg",
+            )
+            response = self.client.post(
+                reverse("image-view"),
+                {"original_image": image, "live_time": live_time},
+                format="multipart",
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data["error"], error)
+        self.assertEqual(Image.objects.count(), 2)
+
+    def test_upload_with_unencodable_thumbnail_format(self):
+        """
+        Test that an upload whose thumbnails can not be encoded is rejected and deleted
+        """
+        Tier.objects.update(thumbnail_sizes=[{"height": 100, "format": "webp"}])
+        token = Token.objects.get(user__username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        with mock.patch.dict(PILImage.SAVE, clear=True):  # no encoder at all
+            response = self.client.post(
+                reverse("image-view"), {"original_image": image}, format="multipart"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "Thumbnail could not be encoded as webp")
+        self.assertEqual(Image.objects.count(), 2)
+
+    def test_upload_with_corrupt_body(self):
+        """
+        Test that an image with a valid header but a corrupt body is rejected and deleted
+        """
+        token = Token.objects.get(user__username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        content = open("images/test_images/test.jpg", "rb").read()
+        image = SimpleUploadedFile(
+            name="test_image.jpg", content=content[:1000], content_type="image/jpg"
+        )
+        response = self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "Image could not be decoded")
+        self.assertEqual(Image.objects.count(), 2)
+
+    def test_get_images_page_by_page(self):
+        """
+        Test that images are listed in pages linked with a cursor
+        """
+        token = Token.objects.get(user__username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        first_page = self.client.get(reverse("image-view"), {"page_size": 1})
+        self.assertEqual(len(first_page.data), 1)
+        next_link = first_page["Link"].split(";")[0].strip("<>")
+        second_page = self.client.get(next_link)
+        self.assertEqual(len(second_page.data), 1)
+        self.assertNotIn("Link", second_page)
+        self.assertEqual(
+            [first_page.data[0]["pk"], second_page.data[0]["pk"]],
+            list(Image.objects.order_by("created_at").values_list("pk", flat=True)),
+        )
+
+    def test_get_images_with_selected_fields(self):
+        """
+        Test that only the requested fields are listed, and thumbnails can be included
+        """
+        token = Token.objects.get(user__username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        image = Image.objects.first()
+        render_thumbnails(image.original_image.path, [ThumbnailSize(100)])
+        record_thumbnails(image, [ThumbnailSize(100)])
+        with self.assertNumQueries(3):  # token with user and tier, images, thumbnails
+            response = self.client.get(
+                reverse("image-view"), {"fields": "pk,thumbnails"}
+            )
+        self.assertEqual(set(response.data[0]), {"pk", "thumbnails"})
+        thumbnails = {item["pk"]: item["thumbnails"] for item in response.data}
+        self.assertEqual(list(thumbnails[image.pk]), ["100px_thumbnail"])
+        response = self.client.get(reverse("image-view"), {"fields": "pk,size"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_one_image(self):
         """
         Test that one image is returned
@@ -79,6 +246,85 @@ class ImageTests(APITestCase):
             f"{Image.objects.last().original_image.url}",
         )
 
+    def test_upload_image_with_custom_tier(self):
+        """
+        Test that thumbnails are rendered for every size of an arbitrary tier
+        """
+        user = User.objects.get(username="test")
+        user.tier = Tier.objects.create(
+            name="Custom",
+            thumbnail_sizes=[100, {"height": 300, "format": "png"}],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        user.save()
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        response = self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            set(response.data), {"100px_thumbnail", "300px_thumbnail", "success"}
+        )
+        self.assertTrue(
+            response.data["300px_thumbnail"].endswith("_300px_thumbnail.png")
+        )
+        self.assertTrue(os.path.exists(f".{response.data['300px_thumbnail']}"))
+
+    def test_get_thumbnail(self):
+        """
+        Test that uploaded thumbnails are recorded and can be accessed
+        """
+        token = Token.objects.get(user__username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        response = self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+        self.assertEqual(
+            Thumbnail.objects.filter(image=Image.objects.last()).count(), 2
+        )
+        with self.assertNumQueries(2):  # image and thumbnail lookups, the token is cached
+            response = self.client.get(response.data["200px_thumbnail"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_unknown_file(self):
+        """
+        Test that files which are neither images nor thumbnails are not found
+        """
+        token = Token.objects.get(user__username="test")
+        user = User.objects.get(username="test")
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        response = self.client.get(f"/media/{user.pk}/images/unknown.jpg")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_backfill_thumbnails(self):
+        """
+        Test that thumbnail files rendered before thumbnails were recorded are backfilled
+        """
+        image = Image.objects.first()
+        render_thumbnails(image.original_image.path, [ThumbnailSize(100)])
+        migration = importlib.import_module(
+            "images.migrations.0013_backfill_thumbnails"
+        )
+        migration.backfill_thumbnails(apps, None)
+        thumbnail = Thumbnail.objects.get(image=image)
+        self.assertEqual(thumbnail.height, 100)
+        self.assertEqual(
+            thumbnail.thumbnail.name,
+            os.path.splitext(image.original_image.name)[0] + "_100px_thumbnail.jpg",
+        )
+
     def test_upload_image_without_data(self):
         """
         Test that image is not uploaded if original_image is not provided
@@ -125,3 +371,1799 @@ class ImageTests(APITestCase):
         )  # sending bmp file
         self.assertEqual(Image.objects.count(), 2)
         self.assertEqual(response.data["error"], "Image format not supported")
+
+
+class ImageDeliveryTests(APITestCase):
+    def setUp(self):
+        """
+        Create a basic user with one image
+        """
+        tier = Tier.objects.create(
+            name="Basic",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=tier
+        )
+        self.image = Image.objects.create(
+            original_image=SimpleUploadedFile(
+                name="test_image.jpg",
+                content=open("images/test_images/test.jpg", "rb").read(),
+                content_type="image/jpg",
+            ),
+            user=self.user,
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+    def test_image_is_streamed(self):
+        """
+        Test that the image is streamed from disk with its real content type
+        """
+        response = self.client.get(self.image.original_image.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        with open(self.image.original_image.path, "rb") as f:
+            self.assertEqual(b"".join(response.streaming_content), f.read())
+
+    @override_settings(
+        IMAGE_SENDFILE_BACKEND="x-accel-redirect", IMAGE_SENDFILE_URL="/protected/"
+    )
+    def test_image_is_handed_off_to_front_server(self):
+        """
+        Test that the transfer is handed off to nginx when X-Accel-Redirect is configured
+        """
+        response = self.client.get(self.image.original_image.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response["X-Accel-Redirect"], f"/protected/{self.image.original_image.name}"
+        )
+        self.assertEqual(response.content, b"")
+
+    def test_image_has_caching_headers(self):
+        """
+        Test that owner images are sent with validators and a private Cache-Control
+        """
+        response = self.client.get(self.image.original_image.url)
+        self.assertIn("ETag", response)
+        self.assertIn("Last-Modified", response)
+        self.assertIn("private", response["Cache-Control"])
+
+    def test_image_not_modified(self):
+        """
+        Test that a matching If-None-Match is answered with 304 Not Modified
+        """
+        etag = self.client.get(self.image.original_image.url)["ETag"]
+        response = self.client.get(
+            self.image.original_image.url, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertFalse(response.content)
+
+    def test_expiring_image_max_age_bounded_by_live_time(self):
+        """
+        Test that expiring images are not cached longer than they live
+        """
+        expiring_image = ExpiringImage.objects.create(user=self.user, live_time=300)
+        expiring_image.image.save("test_image.jpg", self.image.original_image)
+        self.client.credentials()
+        response = self.client.get(expiring_image.image.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("public", response["Cache-Control"])
+        max_age = int(response["Cache-Control"].split("max-age=")[1].split(",")[0])
+        self.assertLessEqual(max_age, 300)
+
+    def test_image_range_request(self):
+        """
+        Test that a byte range is answered with 206 Partial Content
+        """
+        with open(self.image.original_image.path, "rb") as f:
+            image_data = f.read()
+        response = self.client.get(
+            self.image.original_image.url, HTTP_RANGE="bytes=10-19"
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(image_data)}")
+        self.assertEqual(b"".join(response.streaming_content), image_data[10:20])
+        response = self.client.get(self.image.original_image.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), image_data[-5:])
+
+    def test_image_range_not_satisfiable(self):
+        """
+        Test that a range starting after the end of the file is rejected
+        """
+        response = self.client.get(
+            self.image.original_image.url, HTTP_RANGE="bytes=100000000-"
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+
+    def test_invalid_image_range_is_ignored(self):
+        """
+        Test that the whole image is sent if the range ends before it starts
+        """
+        response = self.client.get(self.image.original_image.url, HTTP_RANGE="bytes=5-3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Range", response)
+
+    def test_image_range_ignored_if_changed(self):
+        """
+        Test that the whole image is sent if If-Range does not match the current ETag
+        """
+        response = self.client.get(
+            self.image.original_image.url,
+            HTTP_RANGE="bytes=10-19",
+            HTTP_IF_RANGE='"outdated"',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(IMAGE_THUMBNAIL_RENDERING="async")
+class ThumbnailJobTests(APITestCase):
+    def setUp(self):
+        """
+        Create a premium user
+        """
+        tier = Tier.objects.create(
+            name="Premium",
+            thumbnail_sizes=[400, 200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=tier
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+    def upload_image(self):
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        return self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+
+    def test_upload_image_queues_thumbnails(self):
+        """
+        Test that thumbnails are queued instead of being rendered during the upload
+        """
+        response = self.upload_image()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = ThumbnailJob.objects.get()
+        self.assertEqual(job.status, ThumbnailJob.PENDING)
+        self.assertEqual(
+            response.data["thumbnail_job"], reverse("thumbnail-job", args=[job.pk])
+        )
+        self.assertFalse(os.path.exists(f".{response.data['200px_thumbnail']}"))
+
+    def test_workers_render_queued_thumbnails(self):
+        """
+        Test that the workers render queued thumbnails and the job status reflects it
+        """
+        response = self.upload_image()
+        with ThreadPoolExecutor() as executor:
+            self.assertEqual(run_pending_jobs(executor, 10), 1)
+        self.assertTrue(os.path.exists(f".{response.data['400px_thumbnail']}"))
+        self.assertTrue(os.path.exists(f".{response.data['200px_thumbnail']}"))
+        job_response = self.client.get(response.data["thumbnail_job"])
+        self.assertEqual(job_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(job_response.data["status"], ThumbnailJob.DONE)
+        self.assertEqual(
+            job_response.data["thumbnails"]["200px_thumbnail"],
+            response.data["200px_thumbnail"],
+        )
+
+    def test_worker_command_drains_queue(self):
+        """
+        Test that the worker command renders queued thumbnails in worker processes
+        """
+        response = self.upload_image()
+        call_command(
+            "run_thumbnail_workers", "--once", "--processes", "1", stdout=StringIO()
+        )
+        self.assertEqual(ThumbnailJob.objects.get().status, ThumbnailJob.DONE)
+        self.assertTrue(os.path.exists(f".{response.data['200px_thumbnail']}"))
+
+    def test_job_of_other_user_is_not_found(self):
+        """
+        Test that users can not see the thumbnail jobs of other users
+        """
+        response = self.upload_image()
+        other_user = User.objects.create_user(username="other", password="other")
+        token = Token.objects.get(user=other_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        job_response = self.client.get(response.data["thumbnail_job"])
+        self.assertEqual(job_response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RenderThumbnailsTests(SimpleTestCase):
+    def setUp(self):
+        """
+        Copy the 1000x700 test image to a temporary directory
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.image_path = os.path.join(self.temp_dir, "test.jpg")
+        shutil.copy("images/test_images/test.jpg", self.image_path)
+
+    def test_render_multiple_heights(self):
+        """
+        Test that every requested height is rendered from one call, keeping the aspect ratio
+        """
+        thumbnail_paths = render_thumbnails(
+            self.image_path,
+            [ThumbnailSize(100), ThumbnailSize(500), ThumbnailSize(300)],
+        )
+        self.assertEqual(
+            [os.path.basename(path) for path in thumbnail_paths],
+            [
+                "test_500px_thumbnail.jpg",
+                "test_300px_thumbnail.jpg",
+                "test_100px_thumbnail.jpg",
+            ],
+        )
+        for path, size in zip(thumbnail_paths, [(714, 500), (429, 300), (143, 100)]):
+            with PILImage.open(path) as thumbnail:
+                self.assertEqual(thumbnail.size, size)
+
+    def test_render_does_not_upscale(self):
+        """
+        Test that heights larger than the image keep the original size
+        """
+        (thumbnail_path,) = render_thumbnails(self.image_path, [ThumbnailSize(1000)])
+        with PILImage.open(thumbnail_path) as thumbnail:
+            self.assertEqual(thumbnail.size, (1000, 700))
+
+    def test_render_width_and_format(self):
+        """
+        Test that sizes with a width fit in both dimensions and use their own format
+        """
+        (thumbnail_path,) = render_thumbnails(
+            self.image_path, [ThumbnailSize(300, width=200, format="png")]
+        )
+        self.assertEqual(
+            os.path.basename(thumbnail_path), "test_200x300px_thumbnail.png"
+        )
+        with PILImage.open(thumbnail_path) as thumbnail:
+            self.assertEqual(thumbnail.format, "PNG")
+            self.assertEqual(thumbnail.size, (200, 140))
+
+
+class LazyThumbnailTests(APITestCase):
+    def setUp(self):
+        """
+        Create a premium user and a temporary derivative cache
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings_override = override_settings(
+            IMAGE_THUMBNAIL_RENDERING="lazy", IMAGE_DERIVATIVE_CACHE_DIR=cache_dir
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        tier = Tier.objects.create(
+            name="Premium",
+            thumbnail_sizes=[400, 200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=tier
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        self.response = self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+
+    def test_upload_image_does_not_render_thumbnails(self):
+        """
+        Test that thumbnail links point to the original image with a size parameter
+        """
+        self.assertEqual(self.response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            self.response.data["200px_thumbnail"],
+            f"{self.response.data['original_image']}?h=200",
+        )
+        self.assertFalse(
+            os.path.exists(
+                f".{os.path.splitext(self.response.data['original_image'])[0]}_200px_thumbnail.jpg"
+            )
+        )
+
+    def test_thumbnail_is_rendered_once(self):
+        """
+        Test that the thumbnail is rendered on the first request and served from the cache afterwards
+        """
+        with mock.patch(
+            "images.derivatives.render_thumbnail_files", wraps=render_thumbnail_files
+        ) as render:
+            first_response = self.client.get(self.response.data["200px_thumbnail"])
+            second_response = self.client.get(self.response.data["200px_thumbnail"])
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(second_response.status_code, status.HTTP_200_OK)
+        with PILImage.open(
+            BytesIO(b"".join(second_response.streaming_content))
+        ) as thumbnail:
+            self.assertEqual(thumbnail.height, 200)
+
+    def test_concurrent_first_requests_render_once(self):
+        """
+        Test that concurrent first requests for the same thumbnail wait for a single render
+        """
+        image = Image.objects.get()
+        with mock.patch(
+            "images.derivatives.render_thumbnail_files", wraps=render_thumbnail_files
+        ) as render:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                paths = set(
+                    executor.map(
+                        lambda _: get_or_render_derivative(
+                            image.original_image.path, "ab" * 32, ThumbnailSize(100)
+                        ),
+                        range(8),
+                    )
+                )
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(len(paths), 1)
+        self.assertFalse(os.path.exists(f"{paths.pop()}.lock"))
+
+    def test_changed_encoder_options_are_rendered_again(self):
+        """
+        Test that derivatives are cached per encoder options, so changed options take effect
+        """
+        image = Image.objects.get()
+        path = get_or_render_derivative(
+            image.original_image.path, "cd" * 32, ThumbnailSize(100)
+        )
+        with override_settings(IMAGE_THUMBNAIL_ENCODERS={"jpeg": {"quality": 20}}):
+            low_quality_path = get_or_render_derivative(
+                image.original_image.path, "cd" * 32, ThumbnailSize(100)
+            )
+        self.assertNotEqual(path, low_quality_path)
+        self.assertLess(os.path.getsize(low_quality_path), os.path.getsize(path))
+        self.assertNotEqual(
+            get_or_render_derivative(
+                image.original_image.path, "cd" * 32, ThumbnailSize(100, quality=50)
+            ),
+            path,
+        )
+
+    def test_thumbnail_size_not_in_tier(self):
+        """
+        Test that only the thumbnail sizes of the user's tier can be requested
+        """
+        response = self.client.get(f"{self.response.data['original_image']}?h=123")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_thumbnail_of_corrupt_image(self):
+        """
+        Test that a thumbnail of an image with a corrupt body is rejected instead of failing
+        """
+        content = open("images/test_images/test.jpg", "rb").read()
+        image = SimpleUploadedFile(
+            name="test_image.jpg", content=content[:1000], content_type="image/jpg"
+        )
+        upload_response = self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+        self.assertEqual(upload_response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(upload_response.data["200px_thumbnail"])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "Image could not be decoded")
+
+
+@override_settings(
+    IMAGE_FILE_CACHE={
+        "BACKEND": "local",
+        "MAX_BYTES": 1024 * 1024,
+        "MAX_ITEM_BYTES": 512 * 1024,
+        "TTL": 60,
+    }
+)
+class FileCacheTests(APITestCase):
+    def setUp(self):
+        """
+        Create a basic admin user with one image
+        """
+        tier = Tier.objects.create(
+            name="Basic",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=tier, is_staff=True
+        )
+        self.image = Image.objects.create(
+            original_image=SimpleUploadedFile(
+                name="test_image.jpg",
+                content=open("images/test_images/test.jpg", "rb").read(),
+                content_type="image/jpg",
+            ),
+            user=self.user,
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+    def test_hot_image_is_served_from_memory(self):
+        """
+        Test that a cached image is served without looking the image up again
+        """
+        first_response = self.client.get(self.image.original_image.url)
+        with self.assertNumQueries(0):  # the token is cached too
+            second_response = self.client.get(self.image.original_image.url)
+        self.assertEqual(second_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(second_response.content, first_response.content)
+        self.assertEqual(second_response["ETag"], first_response["ETag"])
+        self.assertEqual(get_file_cache().stats()["hits"], 1)
+
+    def test_cached_image_is_revalidated(self):
+        """
+        Test that a cached image is dropped once its file changed
+        """
+        file_cache = LocalFileCache(1024 * 1024, 512 * 1024, ttl=0)
+        cached_file = file_cache.load("key", self.image.original_image.path)
+        os.utime(
+            self.image.original_image.path,
+            ns=(cached_file.mtime_ns + 10**9, cached_file.mtime_ns + 10**9),
+        )
+        self.assertIsNone(file_cache.get("key"))
+
+    def test_least_recently_used_images_are_evicted(self):
+        """
+        Test that the cache stays within its size by evicting the least recently used images
+        """
+        image_size = os.path.getsize(self.image.original_image.path)
+        file_cache = LocalFileCache(image_size * 2, image_size, ttl=60)
+        for key in ("first", "second"):
+            file_cache.load(key, self.image.original_image.path)
+        file_cache.get("first")
+        file_cache.load("third", self.image.original_image.path)
+        self.assertIsNotNone(file_cache.get("first"))
+        self.assertIsNone(file_cache.get("second"))
+        self.assertEqual(file_cache.stats()["evictions"], 1)
+        self.assertEqual(file_cache.stats()["bytes"], image_size * 2)
+
+    def test_cache_stats(self):
+        """
+        Test that cache statistics are available to admins
+        """
+        self.client.get(self.image.original_image.url)
+        response = self.client.get(reverse("image-file-cache-stats"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["misses"], 1)
+        self.assertEqual(response.data["items"], 1)
+
+
+class MetricsTests(APITestCase):
+    def setUp(self):
+        """
+        Create a basic admin user
+        """
+        tier = Tier.objects.create(
+            name="Basic",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=tier, is_staff=True
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        registry.clear()
+
+    def upload_image(self):
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        return self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+
+    def test_upload_stages_are_timed_per_tier(self):
+        """
+        Test that the stages of an upload are recorded with the user's tier
+        """
+        self.upload_image()
+        stages = {
+            dict(labels)["stage"]
+            for name, labels in registry.histograms
+            if dict(labels)["tier"] == "Basic"
+        }
+        self.assertTrue({"validate", "decode", "resize", "encode", "write", "db"} <= stages)
+        size = os.path.getsize("images/test_images/test.jpg")
+        self.assertEqual(
+            registry.counters[
+                (TRANSFERRED_BYTES, (("direction", "in"), ("tier", "Basic")))
+            ],
+            size,
+        )
+
+    @override_settings(
+        IMAGE_FILE_CACHE={
+            "BACKEND": "local",
+            "MAX_BYTES": 1024 * 1024,
+            "MAX_ITEM_BYTES": 512 * 1024,
+            "TTL": 60,
+        }
+    )
+    def test_sent_bytes_and_cache_lookups_are_counted(self):
+        """
+        Test that downloads count the bytes sent and the lookups in the file cache
+        """
+        response = self.upload_image()
+        self.client.get(response.data["original_image"])
+        self.client.get(response.data["original_image"])
+        size = os.path.getsize("images/test_images/test.jpg")
+        tier = ("tier", "Basic")
+        self.assertEqual(
+            registry.counters[(TRANSFERRED_BYTES, (("direction", "out"), tier))],
+            size * 2,
+        )
+        self.assertEqual(
+            registry.counters[
+                (CACHE_REQUESTS, (("cache", "file"), ("result", "hit"), tier))
+            ],
+            1,
+        )
+
+    def test_metrics_endpoint(self):
+        """
+        Test that the metrics are available to admins in the Prometheus text format
+        """
+        self.upload_image()
+        response = self.client.get(reverse("image-metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        content = response.content.decode()
+        self.assertIn("# TYPE image_stage_duration_seconds histogram", content)
+        self.assertIn(
+            'image_stage_duration_seconds_bucket{stage="resize",tier="Basic",le="+Inf"} 1',
+            content,
+        )
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get(reverse("image-metrics"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(IMAGE_METRICS_ENABLED=False)
+    def test_metrics_can_be_disabled(self):
+        """
+        Test that nothing is recorded when metrics are disabled
+        """
+        self.upload_image()
+        self.assertEqual(registry.histograms, {})
+        self.assertEqual(registry.counters, {})
+        response = self.client.get(reverse("image-metrics"))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class QueryBudgetTests(APITestCase):
+    """
+    Number of queries each endpoint is allowed to make, to keep latency flat as tables grow.
+    The token of the user is cached by the upload in setUp.
+    """
+
+    def setUp(self):
+        """
+        Create an enterprise user with one image and one expiring image
+        """
+        tier = Tier.objects.create(
+            name="Enterprise",
+            thumbnail_sizes=[400, 200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=True,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=tier
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        self.upload_response = self.upload_image()
+
+    def upload_image(self, file_name="test.jpg"):
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open(f"images/test_images/{file_name}", "rb").read(),
+            content_type="image/jpg",
+        )
+        return self.client.post(
+            reverse("image-view"),
+            {"original_image": image, "live_time": 300},
+            format="multipart",
+        )
+
+    def test_list_images(self):
+        with self.assertNumQueries(1):  # images
+            response = self.client.get(reverse("image-view"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_images_with_uncached_token(self):
+        get_token_cache().clear()
+        with self.assertNumQueries(2):  # token with user and tier, images
+            response = self.client.get(reverse("image-view"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_upload_image(self):
+        # image insert, thumbnails of the same content, thumbnails insert
+        with self.assertNumQueries(3):
+            response = self.upload_image()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    @override_settings(IMAGE_EXPIRING_LINKS="copy")
+    def test_upload_image_with_copied_expiring_link(self):
+        # image insert, thumbnails of the same content, thumbnails insert,
+        # expiring image insert and update
+        with self.assertNumQueries(5):
+            response = self.upload_image()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_get_image(self):
+        with self.assertNumQueries(1):  # image
+            response = self.client.get(self.upload_response.data["original_image"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_thumbnail(self):
+        with self.assertNumQueries(2):  # image, thumbnail
+            response = self.client.get(self.upload_response.data["200px_thumbnail"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_expiring_image(self):
+        self.client.credentials()
+        with self.assertNumQueries(0):  # signed links are verified without the database
+            response = self.client.get(self.upload_response.data["300s_expiring_link"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(IMAGE_EXPIRING_LINKS="copy")
+    def test_get_copied_expiring_image(self):
+        expiring_link = self.upload_image().data["300s_expiring_link"]
+        self.client.credentials()
+        with self.assertNumQueries(1):  # expiring image
+            response = self.client.get(expiring_link)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(IMAGE_THUMBNAIL_RENDERING="async")
+    def test_get_thumbnail_job(self):
+        job_url = self.upload_image("test2.jpg").data["thumbnail_job"]
+        with self.assertNumQueries(1):  # job with image
+            response = self.client.get(job_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ExpirySweepTests(APITestCase):
+    def setUp(self):
+        """
+        Create a user with one expired and one live expiring image
+        """
+        user = User.objects.create_user(username="test", password="test")
+        self.expired_image = ExpiringImage.objects.create(user=user, live_time=300)
+        self.expired_image.image.save(
+            "test_image.jpg", open("images/test_images/test.jpg", "rb")
+        )
+        ExpiringImage.objects.filter(pk=self.expired_image.pk).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.live_image = ExpiringImage.objects.create(user=user, live_time=300)
+        self.live_image.image.save(
+            "test_image.jpg", open("images/test_images/test.jpg", "rb")
+        )
+
+    def test_expired_image_is_not_deleted_on_read(self):
+        """
+        Test that reading an expired image only reports it as expired
+        """
+        response = self.client.get(self.expired_image.image.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data["error"], "Image has expired")
+        self.assertTrue(ExpiringImage.objects.filter(pk=self.expired_image.pk).exists())
+
+    def test_sweep_dry_run(self):
+        """
+        Test that a dry run reports expired images without deleting them
+        """
+        result = sweep_expired_images(dry_run=True)
+        self.assertEqual(result.deleted_images, 1)
+        self.assertEqual(result.reclaimed_bytes, 0)  # its content is shared with the live image
+        self.assertEqual(ExpiringImage.objects.count(), 2)
+
+    def test_sweep_deletes_expired_images(self):
+        """
+        Test that expired images and their files are deleted in batches
+        """
+        expired_path = self.expired_image.image.path
+        out = StringIO()
+        call_command("sweep_expiring_images", "--batch-size", "1", stdout=out)
+        self.assertIn("Deleted 1 expired images", out.getvalue())
+        self.assertFalse(os.path.exists(expired_path))
+        self.assertEqual(list(ExpiringImage.objects.all()), [self.live_image])
+        self.assertTrue(os.path.exists(self.live_image.image.path))
+
+    @override_settings(IMAGE_EXPIRY_SWEEP_INTERVAL=60)
+    def test_sweeper_is_only_started_by_servers(self):
+        """
+        Test that loading the app does not start the sweeper, but the server entry point does
+        """
+        with mock.patch("images.expiry.start_expiry_sweeper") as start:
+            apps.get_app_config("images").ready()
+            start.assert_not_called()
+            with mock.patch("images.expiry._server_sweeper", None):
+                start_server_expiry_sweeper()
+                start_server_expiry_sweeper()
+        start.assert_called_once_with(60)
+
+
+class SignedImageTests(APITestCase):
+    def setUp(self):
+        """
+        Create a user with one image and its 200px thumbnail
+        """
+        user = User.objects.create_user(username="test", password="test")
+        self.image = Image.objects.create(
+            original_image=SimpleUploadedFile(
+                name="test_image.jpg",
+                content=open("images/test_images/test.jpg", "rb").read(),
+                content_type="image/jpg",
+            ),
+            user=user,
+        )
+        render_thumbnails(self.image.original_image.path, [ThumbnailSize(200)])
+
+    def test_signed_link(self):
+        """
+        Test that a signed link serves the original image without copying it
+        """
+        response = self.client.get(signed_image_url(self.image, 300))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with open(self.image.original_image.path, "rb") as f:
+            self.assertEqual(b"".join(response.streaming_content), f.read())
+        self.assertEqual(ExpiringImage.objects.count(), 0)
+
+    def test_signed_link_to_thumbnail(self):
+        """
+        Test that a signed link can point to a thumbnail of the image
+        """
+        response = self.client.get(
+            signed_image_url(self.image, 300, ThumbnailSize(200))
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with PILImage.open(BytesIO(b"".join(response.streaming_content))) as image:
+            self.assertEqual(image.height, 200)
+
+    def test_tampered_link(self):
+        """
+        Test that changing any signed parameter invalidates the link
+        """
+        url = signed_image_url(self.image, 300)
+        expires = url.split("expires=")[1].split("&")[0]
+        response = self.client.get(
+            url.replace(f"expires={expires}", f"expires={int(expires) + 1000}")
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_expired_link(self):
+        """
+        Test that a link can not be used after it expired
+        """
+        with mock.patch("images.signing.time.time", return_value=0):
+            url = signed_image_url(self.image, 300)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data["error"], "Image has expired")
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+    def setUp(self):
+        """
+        Create a storage in a temporary directory
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.storage = ContentAddressedStorage(
+            blob_location=os.path.join(directory, "blobs"),
+            location=os.path.join(directory, "media"),
+        )
+        with open("images/test_images/test.jpg", "rb") as f:
+            self.content = f.read()
+
+    def test_identical_files_share_a_blob(self):
+        """
+        Test that files with the same content are stored once, under their own names
+        """
+        first_name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        second_name = self.storage.save("2/images/b.jpg", BytesIO(self.content))
+        first_stat = os.stat(self.storage.path(first_name))
+        second_stat = os.stat(self.storage.path(second_name))
+        self.assertEqual(first_stat.st_ino, second_stat.st_ino)
+        self.assertEqual(first_stat.st_nlink, 3)  # two files and the blob
+        with self.storage.open(second_name) as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_reclaimable_size(self):
+        """
+        Test that deleting a file reclaims its size only when no other file shares its content
+        """
+        first_name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        second_name = self.storage.save("2/images/b.jpg", BytesIO(self.content))
+        self.assertEqual(self.storage.reclaimable_size(first_name), 0)
+        self.storage.delete(second_name)
+        self.assertEqual(self.storage.reclaimable_size(first_name), len(self.content))
+
+    def test_taken_name(self):
+        """
+        Test that saving under a taken name stores the file under a new name
+        """
+        first_name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        second_name = self.storage.save("1/images/a.jpg", BytesIO(b"other"))
+        self.assertNotEqual(first_name, second_name)
+        with self.storage.open(first_name) as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_deduplicate(self):
+        """
+        Test that a file written directly is moved into the blob store
+        """
+        name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        shutil.copy(self.storage.path(name), self.storage.path("1/images/b.jpg"))
+        self.storage.deduplicate("1/images/b.jpg")
+        self.assertEqual(
+            os.stat(self.storage.path(name)).st_ino,
+            os.stat(self.storage.path("1/images/b.jpg")).st_ino,
+        )
+
+    def test_collect_garbage(self):
+        """
+        Test that only the blobs of deleted files are collected
+        """
+        kept_name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        deleted_name = self.storage.save("1/images/b.jpg", BytesIO(b"other"))
+        self.storage.delete(deleted_name)
+        result = self.storage.collect_garbage(dry_run=True)
+        self.assertEqual(result.deleted_blobs, 1)
+        self.assertEqual(result.reclaimed_bytes, len(b"other"))
+        self.storage.collect_garbage()
+        self.assertEqual(self.storage.collect_garbage().deleted_blobs, 0)
+        with self.storage.open(kept_name) as f:
+            self.assertEqual(f.read(), self.content)
+
+
+class RemoteStorage(Storage):
+    """
+    Storage without local paths, keeping its files in a FileSystemStorage.
+    """
+
+    def __init__(self, location: str):
+        self.files = FileSystemStorage(location=location)
+        self.opened_names: list[str] = []
+
+    def _open(self, name, mode="rb"):
+        self.opened_names.append(name)
+        return self.files.open(name, mode)
+
+    def _save(self, name, content):
+        return self.files.save(name, content)
+
+    def exists(self, name):
+        return self.files.exists(name)
+
+    def delete(self, name):
+        self.files.delete(name)
+
+    def get_modified_time(self, name):
+        return self.files.get_modified_time(name)
+
+
+class RemoteStorageTests(SimpleTestCase):
+    def setUp(self):
+        """
+        Create a remote storage holding an image, and a directory for local copies
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_dir = os.path.join(directory, "cache")
+        self.storage = RemoteStorage(os.path.join(directory, "remote"))
+        with open("images/test_images/test.jpg", "rb") as f:
+            self.content = f.read()
+        self.storage.save("1/images/a.jpg", BytesIO(self.content))
+
+    def test_local_storage(self):
+        """
+        Test that files of local storages are used in place
+        """
+        storage = FileSystemStorage(location=self.cache_dir)
+        self.assertTrue(is_local(storage))
+        self.assertEqual(local_file_path(storage, "1/images/a.jpg"), storage.path("1/images/a.jpg"))
+
+    def test_remote_file_is_copied_once(self):
+        """
+        Test that remote files are copied on their first use, with their modification time
+        """
+        self.assertFalse(is_local(self.storage))
+        with override_settings(IMAGE_REMOTE_CACHE_DIR=self.cache_dir):
+            path = local_file_path(self.storage, "1/images/a.jpg")
+            self.assertEqual(local_file_path(self.storage, "1/images/a.jpg"), path)
+        self.assertEqual(path, os.path.join(self.cache_dir, "1/images/a.jpg"))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(
+            int(os.stat(path).st_mtime),
+            int(self.storage.get_modified_time("1/images/a.jpg").timestamp()),
+        )
+        self.assertEqual(self.storage.opened_names, ["1/images/a.jpg"])
+
+    def test_missing_remote_file(self):
+        """
+        Test that the local path of a missing remote file does not exist
+        """
+        with override_settings(IMAGE_REMOTE_CACHE_DIR=self.cache_dir):
+            path = local_file_path(self.storage, "1/images/missing.jpg")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def test_render_stored_thumbnails(self):
+        """
+        Test that thumbnails of remote images are rendered locally and uploaded
+        """
+        with override_settings(
+            IMAGE_STORAGE_BACKEND="images.tests.RemoteStorage",
+            IMAGE_STORAGE_OPTIONS={"location": self.storage.files.location},
+            IMAGE_REMOTE_CACHE_DIR=self.cache_dir,
+        ):
+            names = render_stored_thumbnails("1/images/a.jpg", [ThumbnailSize(100)])
+        self.assertEqual(names, ["1/images/a_100px_thumbnail.jpg"])
+        with PILImage.open(self.storage.files.path(names[0])) as thumbnail:
+            self.assertEqual(thumbnail.height, 100)
+
+
+@unittest.skipUnless(boto3 and mock_aws, "boto3 and moto are not installed")
+class S3ImageStorageTests(SimpleTestCase):
+    def setUp(self):
+        """
+        Create a storage in a mocked S3 bucket
+        """
+        aws_mock = mock_aws()
+        aws_mock.start()
+        self.addCleanup(aws_mock.stop)
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="images")
+        self.storage = S3ImageStorage(
+            bucket_name="images", location="media", region_name="us-east-1"
+        )
+        with open("images/test_images/test.jpg", "rb") as f:
+            self.content = f.read()
+
+    def test_save_and_open(self):
+        """
+        Test that saved files can be read back, from any position
+        """
+        name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        self.assertEqual(name, "1/images/a.jpg")
+        self.assertFalse(is_local(self.storage))
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), len(self.content))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), self.content)
+            f.seek(100)
+            self.assertEqual(f.read(10), self.content[100:110])
+            f.seek(0, os.SEEK_END)
+            self.assertEqual(f.read(), b"")
+
+    def test_taken_name(self):
+        """
+        Test that saving under a taken name stores the file under a new name
+        """
+        first_name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        second_name = self.storage.save("1/images/a.jpg", BytesIO(b"other"))
+        self.assertNotEqual(first_name, second_name)
+        self.assertEqual(self.storage.listdir("1/images")[1], ["a.jpg", os.path.basename(second_name)])
+
+    def test_delete(self):
+        """
+        Test that deleted files no longer exist and can not be opened
+        """
+        name = self.storage.save("1/images/a.jpg", BytesIO(self.content))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(name).read()
+
+
+class DeduplicatedUploadTests(APITestCase):
+    def setUp(self):
+        """
+        Create a premium user and upload one image
+        """
+        tier = Tier.objects.create(
+            name="Premium",
+            thumbnail_sizes=[400, 200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        user = User.objects.create_user(username="test", password="test", tier=tier)
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        self.first_response = self.upload_image()
+
+    def upload_image(self):
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        return self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+
+    def test_upload_stores_content_hash(self):
+        """
+        Test that the hash of the content is stored at upload
+        """
+        image = Image.objects.get()
+        self.assertEqual(len(image.content_hash), 64)
+
+    def test_thumbnails_are_reused(self):
+        """
+        Test that thumbnails of an identical image are linked instead of rendered
+        """
+        with mock.patch("images.processing.render_stored_thumbnails") as render:
+            response = self.upload_image()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        render.assert_not_called()
+        first_image, second_image = Image.objects.order_by("pk")
+        self.assertEqual(second_image.thumbnails.count(), 2)
+        for first_thumbnail, second_thumbnail in zip(
+            first_image.thumbnails.order_by("height"),
+            second_image.thumbnails.order_by("height"),
+        ):
+            self.assertNotEqual(first_thumbnail.thumbnail, second_thumbnail.thumbnail)
+            self.assertEqual(
+                os.stat(first_thumbnail.thumbnail.path).st_ino,
+                os.stat(second_thumbnail.thumbnail.path).st_ino,
+            )
+        self.assertEqual(
+            os.stat(first_image.original_image.path).st_ino,
+            os.stat(second_image.original_image.path).st_ino,
+        )
+        response = self.client.get(response.data["200px_thumbnail"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ChunkedUploadTests(APITestCase):
+    def setUp(self):
+        """
+        Create a premium user and start a chunked upload
+        """
+        tier = Tier.objects.create(
+            name="Premium",
+            thumbnail_sizes=[400, 200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        user = User.objects.create_user(username="test", password="test", tier=tier)
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir)
+        settings_override = override_settings(IMAGE_UPLOAD_DIR=upload_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        with open("images/test_images/test.jpg", "rb") as f:
+            self.content = f.read()
+        response = self.client.post(
+            reverse("image-upload"),
+            {"file_name": "test_image.jpg", "size": len(self.content)},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.upload_url = response.data["upload"]
+
+    def send_chunk(self, offset, chunk):
+        return self.client.put(
+            self.upload_url,
+            chunk,
+            content_type="application/octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def send_all_chunks(self, chunk_size=1000):
+        for offset in range(0, len(self.content), chunk_size):
+            response = self.send_chunk(
+                offset, self.content[offset : offset + chunk_size]
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def finalize(self, checksum):
+        return self.client.post(f"{self.upload_url}finalize/", {"checksum": checksum})
+
+    def test_unsupported_format(self):
+        """
+        Test that uploads of unsupported formats are rejected before any chunk is sent
+        """
+        response = self.client.post(
+            reverse("image-upload"), {"file_name": "test.bmp", "size": 100}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_resume_upload(self):
+        """
+        Test that an interrupted upload resumes from the offset reported by the server
+        """
+        self.send_chunk(0, self.content[:1000])
+        response = self.send_chunk(0, self.content[:1000])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.get(self.upload_url)
+        self.assertEqual(response.data["offset"], 1000)
+        response = self.send_chunk(1000, self.content[1000:])
+        self.assertEqual(response.data["offset"], len(self.content))
+
+    def test_chunk_exceeding_size(self):
+        """
+        Test that a chunk past the announced size is rejected
+        """
+        response = self.send_chunk(0, self.content + b"extra")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ImageUpload.objects.get().offset, 0)
+
+    def test_finalize_incomplete_upload(self):
+        """
+        Test that an upload can not be finalized before all of its bytes are received
+        """
+        self.send_chunk(0, self.content[:1000])
+        response = self.finalize(hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_finalize_with_wrong_checksum(self):
+        """
+        Test that a corrupted upload is discarded
+        """
+        self.send_all_chunks()
+        response = self.finalize(hashlib.sha256(b"other").hexdigest())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ImageUpload.objects.exists())
+        self.assertFalse(Image.objects.exists())
+
+    def test_finalize_upload(self):
+        """
+        Test that a finalized upload is stored as an image and thumbnailed
+        """
+        self.send_all_chunks()
+        upload = ImageUpload.objects.get()
+        response = self.finalize(hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn("200px_thumbnail", response.data)
+        image = Image.objects.get()
+        self.assertEqual(image.content_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(image.thumbnails.count(), 2)
+        with open(image.original_image.path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(upload.partial_file_path))
+        self.assertFalse(ImageUpload.objects.exists())
+
+    def test_finalize_corrupt_upload(self):
+        """
+        Test that a finalized upload with a corrupt body is rejected and deleted
+        """
+        self.content = self.content[:1000]
+        ImageUpload.objects.update(size=len(self.content))
+        self.send_all_chunks()
+        response = self.finalize(hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "Image could not be decoded")
+        self.assertFalse(Image.objects.exists())
+        self.assertFalse(ImageUpload.objects.exists())
+
+
+@mock.patch("images.views.get_batch_executor", lambda jobs: ThreadPoolExecutor(2))
+class BatchUploadTests(APITestCase):
+    def setUp(self):
+        """
+        Create a premium user
+        """
+        tier = Tier.objects.create(
+            name="Premium",
+            thumbnail_sizes=[400, 200],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        user = User.objects.create_user(username="test", password="test", tier=tier)
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        self.contents = {}
+        for file_name in ["test.jpg", "test2.jpg", "bmp-test.bmp"]:
+            with open(f"images/test_images/{file_name}", "rb") as f:
+                self.contents[file_name] = f.read()
+
+    def test_multipart_batch(self):
+        """
+        Test that every image of the batch is stored and thumbnailed, with a result per image
+        """
+        response = self.client.post(
+            reverse("image-batch"),
+            {
+                "images": [
+                    SimpleUploadedFile(file_name, content)
+                    for file_name, content in self.contents.items()
+                ]
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.data["results"]
+        self.assertEqual(
+            [result["status"] for result in results],
+            [
+                status.HTTP_201_CREATED,
+                status.HTTP_201_CREATED,
+                status.HTTP_400_BAD_REQUEST,
+            ],
+        )
+        self.assertIn("200px_thumbnail", results[0])
+        self.assertEqual(results[2]["error"], "Image format not supported")
+        self.assertEqual(Image.objects.count(), 2)
+        self.assertEqual(Thumbnail.objects.count(), 4)
+        self.assertEqual(
+            set(ThumbnailJob.objects.values_list("status", flat=True)),
+            {ThumbnailJob.DONE},
+        )
+
+    def test_worker_stages_are_timed_per_tier(self):
+        """
+        Test that the stages timed in the workers are recorded by the request, with the user's tier
+        """
+        registry.clear()
+        self.client.post(
+            reverse("image-batch"),
+            {"images": [SimpleUploadedFile("test.jpg", self.contents["test.jpg"])]},
+            format="multipart",
+        )
+        stages = {
+            dict(labels)["stage"]
+            for name, labels in registry.histograms
+            if dict(labels)["tier"] == "Premium"
+        }
+        self.assertTrue({"decode", "resize", "encode"} <= stages)
+
+    def test_executor_spawns_processes(self):
+        """
+        Test that the batch executor spawns its processes, which render jobs with Django set up
+        """
+        image = Image.objects.create(
+            user=User.objects.get(),
+            original_image=SimpleUploadedFile("test.jpg", self.contents["test.jpg"]),
+        )
+        with get_batch_executor(1) as executor:
+            self.assertEqual(executor._mp_context.get_start_method(), "spawn")
+            names, samples = executor.submit(
+                render_job, image.original_image.name, [ThumbnailSize(100)]
+            ).result()
+        self.assertEqual(names, [thumbnail_name(image.original_image.name, ThumbnailSize(100))])
+        self.assertIn(("stage", "decode"), [labels[0] for _, _, labels, _ in samples])
+
+    def test_zip_archive(self):
+        """
+        Test that the images of a zip archive are processed
+        """
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            zip_file.writestr("catalog/a.jpg", self.contents["test.jpg"])
+            zip_file.writestr("catalog/b.jpg", self.contents["test2.jpg"])
+        response = self.client.post(
+            reverse("image-batch"),
+            {"archive": SimpleUploadedFile("catalog.zip", archive.getvalue())},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(
+            [result["file_name"] for result in response.data["results"]],
+            ["a.jpg", "b.jpg"],
+        )
+        self.assertEqual(Image.objects.count(), 2)
+
+    def test_tar_archive(self):
+        """
+        Test that the images of a compressed tar archive are processed
+        """
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar_file:
+            content = self.contents["test.jpg"]
+            member = tarfile.TarInfo("a.jpg")
+            member.size = len(content)
+            tar_file.addfile(member, BytesIO(content))
+        response = self.client.post(
+            reverse("image-batch"),
+            {"archive": SimpleUploadedFile("catalog.tar.gz", archive.getvalue())},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data["results"][0]["status"], status.HTTP_201_CREATED)
+        self.assertEqual(Image.objects.get().thumbnails.count(), 2)
+
+    @override_settings(IMAGE_BATCH_MAX_FILES=1)
+    def test_batch_limit(self):
+        """
+        Test that images past the batch limit are rejected
+        """
+        response = self.client.post(
+            reverse("image-batch"),
+            {
+                "images": [
+                    SimpleUploadedFile("a.jpg", self.contents["test.jpg"]),
+                    SimpleUploadedFile("b.jpg", self.contents["test2.jpg"]),
+                ]
+            },
+            format="multipart",
+        )
+        self.assertEqual(
+            response.data["results"][1]["status"], status.HTTP_400_BAD_REQUEST
+        )
+        self.assertEqual(Image.objects.count(), 1)
+
+    @override_settings(IMAGE_BATCH_MAX_FILES=1)
+    def test_archive_past_batch_limit_is_not_read(self):
+        """
+        Test that the members of an archive past the batch limit are not extracted
+        """
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            for file_name in ["a.jpg", "b.jpg", "c.jpg"]:
+                zip_file.writestr(file_name, self.contents["test.jpg"])
+        with mock.patch("images.batch._spool", wraps=_spool) as spool:
+            response = self.client.post(
+                reverse("image-batch"),
+                {"archive": SimpleUploadedFile("catalog.zip", archive.getvalue())},
+                format="multipart",
+            )
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [status.HTTP_201_CREATED, status.HTTP_400_BAD_REQUEST],
+        )
+        self.assertEqual(spool.call_count, 2)
+
+    @override_settings(IMAGE_UPLOAD_MAX_SIZE=1000)
+    def test_oversized_archive_member(self):
+        """
+        Test that archive members larger than IMAGE_UPLOAD_MAX_SIZE are rejected without being extracted
+        """
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("bomb.jpg", bytes(10**6))
+        with mock.patch("images.batch._spool", wraps=_spool) as spool:
+            response = self.client.post(
+                reverse("image-batch"),
+                {"archive": SimpleUploadedFile("catalog.zip", archive.getvalue())},
+                format="multipart",
+            )
+        self.assertEqual(response.data["results"][0]["error"], "Image is too large")
+        spool.assert_not_called()
+
+    def test_archive_size_limit(self):
+        """
+        Test that a batch stops at the first member taking the archive past IMAGE_BATCH_MAX_ARCHIVE_SIZE
+        """
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar_file:
+            for file_name in ["a.jpg", "b.jpg"]:
+                member = tarfile.TarInfo(file_name)
+                member.size = len(self.contents["test.jpg"])
+                tar_file.addfile(member, BytesIO(self.contents["test.jpg"]))
+        with override_settings(IMAGE_BATCH_MAX_ARCHIVE_SIZE=len(self.contents["test.jpg"]) + 1):
+            response = self.client.post(
+                reverse("image-batch"),
+                {"archive": SimpleUploadedFile("catalog.tar.gz", archive.getvalue())},
+                format="multipart",
+            )
+        results = response.data["results"]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]["file_name"], "catalog.tar.gz")
+        self.assertEqual(results[1]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_corrupt_image_in_batch(self):
+        """
+        Test that an image of the batch with a corrupt body is rejected and deleted
+        """
+        response = self.client.post(
+            reverse("image-batch"),
+            {
+                "images": [
+                    SimpleUploadedFile("a.jpg", self.contents["test.jpg"]),
+                    SimpleUploadedFile("b.jpg", self.contents["test2.jpg"][:1000]),
+                ]
+            },
+            format="multipart",
+        )
+        results = response.data["results"]
+        self.assertEqual(results[0]["status"], status.HTTP_201_CREATED)
+        self.assertEqual(
+            results[1],
+            {"file_name": "b.jpg", "error": "Image could not be decoded", "status": status.HTTP_400_BAD_REQUEST},
+        )
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_empty_batch(self):
+        """
+        Test that a batch without images is rejected
+        """
+        response = self.client.post(reverse("image-batch"), {}, format="multipart")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ImageHeaderValidationTests(SimpleTestCase):
+    def image_file(self, image_format, size=(300, 200)):
+        f = BytesIO()
+        PILImage.new("RGB", size).save(f, image_format)
+        f.seek(0)
+        return f
+
+    def test_read_jpeg_header(self):
+        """
+        Test that the dimensions of a JPEG are read past its EXIF and other segments
+        """
+        with open("images/test_images/test.jpg", "rb") as f:
+            header = read_image_header(f)
+        with PILImage.open("images/test_images/test.jpg") as image:
+            self.assertEqual((header.width, header.height), image.size)
+        self.assertEqual(header.format, "jpeg")
+
+    def test_read_png_header(self):
+        header = read_image_header(self.image_file("png"))
+        self.assertEqual(tuple(header), ("png", 300, 200))
+
+    def test_unsupported_format(self):
+        with open("images/test_images/bmp-test.bmp", "rb") as f:
+            with self.assertRaisesMessage(ValueError, "Image format not supported"):
+                read_image_header(f)
+
+    def test_truncated_image(self):
+        """
+        Test that a JPEG cut before its frame header is rejected
+        """
+        with open("images/test_images/test.jpg", "rb") as f:
+            truncated_file = BytesIO(f.read(20))
+        with self.assertRaisesMessage(ValueError, "Upload a valid image"):
+            read_image_header(truncated_file)
+
+    def test_extension_must_match_format(self):
+        with self.assertRaisesMessage(ValueError, "Image format not supported"):
+            validate_image_header(self.image_file("png"), "image.jpg")
+
+    @override_settings(IMAGE_MAX_PIXELS=300 * 200 - 1)
+    def test_decompression_bomb(self):
+        """
+        Test that images decoding to too many pixels are rejected from their header
+        """
+        with self.assertRaisesMessage(ValueError, "Image is too large"):
+            validate_image_header(self.image_file("jpeg"), "image.jpg")
+
+    def test_file_is_rewound(self):
+        f = self.image_file("jpeg")
+        validate_image_header(f, "image.jpeg")
+        self.assertEqual(f.tell(), 0)
+
+
+class UploadValidationTests(APITestCase):
+    def setUp(self):
+        """
+        Create a basic user
+        """
+        tier = Tier.objects.create(
+            name="Basic",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        user = User.objects.create_user(username="test", password="test", tier=tier)
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+    @override_settings(IMAGE_MAX_DIMENSION=100)
+    def test_oversized_image_is_not_stored(self):
+        """
+        Test that an oversized image is rejected before it is written or decoded
+        """
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        with mock.patch("PIL.Image.open") as open_image:
+            response = self.client.post(
+                reverse("image-view"), {"original_image": image}, format="multipart"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "Image is too large")
+        open_image.assert_not_called()
+        self.assertFalse(Image.objects.exists())
+
+
+class OutputFormatTests(APITestCase):
+    def setUp(self):
+        """
+        Create a user whose tier converts thumbnails to PNG for clients accepting it
+        """
+        tier = Tier.objects.create(
+            name="Custom",
+            thumbnail_sizes=[200],
+            output_formats=["png"],
+            presence_of_original_file_link=True,
+            ability_to_fetch_expiring_link=False,
+        )
+        user = User.objects.create_user(username="test", password="test", tier=tier)
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings_override = override_settings(IMAGE_DERIVATIVE_CACHE_DIR=cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        image = SimpleUploadedFile(
+            name="test_image.jpg",
+            content=open("images/test_images/test.jpg", "rb").read(),
+            content_type="image/jpg",
+        )
+        self.upload_response = self.client.post(
+            reverse("image-view"), {"original_image": image}, format="multipart"
+        )
+
+    def test_negotiate_format(self):
+        self.assertEqual(
+            negotiate_format("image/avif,image/webp,*/*;q=0.8", ["avif", "webp"]),
+            "avif",
+        )
+        self.assertEqual(
+            negotiate_format("image/avif;q=0,image/webp", ["avif", "webp"]), "webp"
+        )
+        self.assertIsNone(negotiate_format("image/*,*/*", ["webp"]))
+
+    def test_progressive_jpeg(self):
+        """
+        Test that JPEG thumbnails are saved with the configured encoder options
+        """
+        thumbnail = Thumbnail.objects.get()
+        with PILImage.open(thumbnail.thumbnail.path) as image:
+            self.assertFalse(image.info.get("progressive"))  # not by default, it is slower
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "thumbnail.jpg")
+        encoders = {"jpeg": {"quality": 82, "progressive": True, "optimize": True}}
+        with override_settings(IMAGE_THUMBNAIL_ENCODERS=encoders):
+            render_thumbnail_files(thumbnail.image.original_image.path, {ThumbnailSize(100): path})
+        with PILImage.open(path) as image:
+            self.assertTrue(image.info.get("progressive"))
+
+    def test_thumbnail_in_accepted_format(self):
+        """
+        Test that a thumbnail is converted to an output format the client accepts
+        """
+        response = self.client.get(
+            self.upload_response.data["200px_thumbnail"],
+            HTTP_ACCEPT="image/png,image/*;q=0.8",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("Accept", response["Vary"])
+        with PILImage.open(BytesIO(b"".join(response.streaming_content))) as image:
+            self.assertEqual((image.format, image.height), ("PNG", 200))
+
+    def test_thumbnail_in_stored_format(self):
+        """
+        Test that clients not listing an output format get the stored thumbnail
+        """
+        response = self.client.get(
+            self.upload_response.data["200px_thumbnail"], HTTP_ACCEPT="image/*"
+        )
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("Accept", response["Vary"])
+
+    def test_original_is_not_converted(self):
+        response = self.client.get(
+            self.upload_response.data["original_image"], HTTP_ACCEPT="image/png"
+        )
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+
+    @unittest.skipUnless(can_encode("webp"), "Pillow is built without WebP support")
+    def test_webp_thumbnail(self):
+        Tier.objects.update(output_formats=["webp"])
+        response = self.client.get(
+            self.upload_response.data["200px_thumbnail"], HTTP_ACCEPT="image/webp"
+        )
+        self.assertEqual(response["Content-Type"], "image/webp")
+
+
+class MediaLayoutTests(APITestCase):
+    def setUp(self):
+        """
+        Create a user with an image and its 200px thumbnail, and an expiring image,
+        stored before the sharded layout
+        """
+        self.user = User.objects.create_user(username="test", password="test")
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        storage = get_image_storage()
+        file_name = f"legacy_{uuid.uuid4().hex}.jpg"
+        with open("images/test_images/test.jpg", "rb") as f:
+            self.content = f.read()
+        self.legacy_name = storage.save(f"{self.user.pk}/images/{file_name}", BytesIO(self.content))
+        self.image = Image.objects.create(user=self.user, original_image=self.legacy_name)
+        self.legacy_thumbnail_name = thumbnail_name(self.legacy_name, ThumbnailSize(200))
+        storage.save(self.legacy_thumbnail_name, BytesIO(b"thumbnail"))
+        self.thumbnail = Thumbnail.objects.create(
+            image=self.image, thumbnail=self.legacy_thumbnail_name, height=200
+        )
+        self.legacy_expiring_name = storage.save(
+            f"expiring-images/{file_name}", BytesIO(self.content)
+        )
+        self.expiring_image = ExpiringImage.objects.create(
+            user=self.user, image=self.legacy_expiring_name, live_time=300
+        )
+
+    def test_new_files_are_sharded(self):
+        """
+        Test that new images are stored in directories named by the hash of their names
+        """
+        image = Image.objects.create(
+            user=self.user,
+            original_image=SimpleUploadedFile("photo.jpg", self.content, "image/jpeg"),
+        )
+        self.assertRegex(
+            image.original_image.name, rf"^{self.user.pk}/images/[0-9a-f]{{2}}/[0-9a-f]{{2}}/photo"
+        )
+        response = self.client.get(image.original_image.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_relocate_media_files(self):
+        """
+        Test that files are moved into the sharded layout, and their old links keep working
+        """
+        out = StringIO()
+        call_command("relocate_media_files", "--batch-size", "1", stdout=out)
+        self.assertIn("Moved 1 images and 1 expiring images, skipped 0 images", out.getvalue())
+        self.image.refresh_from_db()
+        self.thumbnail.refresh_from_db()
+        self.expiring_image.refresh_from_db()
+        self.assertRegex(self.image.original_image.name, r"/images/[0-9a-f]{2}/[0-9a-f]{2}/legacy_")
+        self.assertEqual(
+            self.thumbnail.thumbnail.name,
+            thumbnail_name(self.image.original_image.name, ThumbnailSize(200)),
+        )
+        self.assertRegex(self.expiring_image.image.name, r"^expiring-images/[0-9a-f]{2}/[0-9a-f]{2}/")
+        storage = get_image_storage()
+        self.assertFalse(storage.exists(self.legacy_name))
+        self.assertFalse(storage.exists(self.legacy_thumbnail_name))
+        with storage.open(self.image.original_image.name) as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(MovedFile.objects.count(), 3)
+        for legacy_name in (self.legacy_name, self.legacy_thumbnail_name, self.legacy_expiring_name):
+            response = self.client.get(f"/media/{legacy_name}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK, legacy_name)
+
+        out = StringIO()
+        call_command("relocate_media_files", stdout=out)
+        self.assertIn("Moved 0 images and 0 expiring images", out.getvalue())
+
+    def test_dry_run(self):
+        """
+        Test that a dry run reports the files to move without moving them
+        """
+        out = StringIO()
+        call_command("relocate_media_files", "--dry-run", stdout=out)
+        self.assertIn("Would move 1 images and 1 expiring images", out.getvalue())
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.original_image.name, self.legacy_name)
+        self.assertTrue(get_image_storage().exists(self.legacy_name))
+
+    def test_image_with_pending_thumbnails_is_skipped(self):
+        """
+        Test that images whose thumbnails are being rendered are left for a later run
+        """
+        ThumbnailJob.objects.create(image=self.image, sizes=[100])
+        out = StringIO()
+        call_command("relocate_media_files", stdout=out)
+        self.assertIn("Moved 0 images and 1 expiring images, skipped 1 images", out.getvalue())
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.original_image.name, self.legacy_name)
+
+
+class AsyncMediaAccessTests(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a user with one image and one expiring image
+        """
+        self.user = User.objects.create_user(username="test", password="test")
+        self.token = Token.objects.get(user=self.user)
+        with open("images/test_images/test.jpg", "rb") as f:
+            self.content = f.read()
+        self.image = Image.objects.create(
+            user=self.user,
+            original_image=SimpleUploadedFile("test_image.jpg", self.content, "image/jpeg"),
+        )
+        self.expiring_image = ExpiringImage.objects.create(user=self.user, live_time=300)
+        self.expiring_image.image.save("test_image.jpg", BytesIO(self.content))
+        self.factory = RequestFactory()
+
+    async def get_image(self, **extra):
+        _, _, file_name = self.image.original_image.name.split("/", 2)
+        request = self.factory.get(
+            self.image.original_image.url,
+            HTTP_AUTHORIZATION=f"Token {self.token.key}",
+            **extra,
+        )
+        return await async_image_access(request, user_pk=self.user.pk, file_name=file_name)
+
+    async def test_image_is_streamed_asynchronously(self):
+        """
+        Test that images are streamed from an async iterator
+        """
+        response = await self.get_image()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        chunks = [chunk async for chunk in response.async_streaming_content]
+        self.assertEqual(b"".join(chunks), self.content)
+
+    async def test_not_modified(self):
+        """
+        Test that conditional requests are answered like by the sync view
+        """
+        response = await self.get_image()
+        response = await self.get_image(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(hasattr(response, "async_streaming_content"))
+
+    async def test_expiring_image(self):
+        """
+        Test that expiring images are served, and missing ones are not found
+        """
+        _, file_name = self.expiring_image.image.name.split("/", 1)
+        response = await async_expiring_image_access(self.factory.get("/"), file_name=file_name)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = await async_expiring_image_access(self.factory.get("/"), file_name="missing.jpg")
+        response.render()
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_handler_sends_async_stream(self):
+        """
+        Test that the ASGI handler sends the chunks of the async iterator
+        """
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        response = await self.get_image()
+        await StreamingASGIHandler().send_response(response, send)
+        self.assertEqual(messages[0]["status"], status.HTTP_200_OK)
+        self.assertIn((b"Content-Type", b"image/jpeg"), messages[0]["headers"])
+        self.assertEqual(b"".join(message.get("body", b"") for message in messages[1:]), self.content)
+        self.assertFalse(messages[-1].get("more_body", False))
+
+    async def test_lookups_run_concurrently(self):
+        """
+        Test that concurrent lookups are not serialized on a single thread
+        """
+        barrier = threading.Barrier(2, timeout=5)
+
+        def view(request):
+            barrier.wait()  # raises BrokenBarrierError if the lookups run one at a time
+            return HttpResponse(b"ok")
+
+        async_view = async_media_view(view)
+        responses = await asyncio.gather(
+            async_view(self.factory.get("/")), async_view(self.factory.get("/"))
+        )
+        self.assertEqual([response.status_code for response in responses], [200, 200])
@@ -0,0 +1,239 @@
+import os
+from typing import Sequence
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.files import File
+from PIL import Image as PILImage
+
+from users.models import THUMBNAIL_FORMATS, ThumbnailSize
+from .metrics import timed
+from .models import Image, Thumbnail
+from .storage import get_image_storage, is_local, local_file_path
+
+try:  # AVIF encoder for Pillow versions without one built in
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Images are first reduced (JPEGs while decoding, using draft mode) to the smallest
+# scale that is still this many times larger than the thumbnail, like Image.thumbnail() does.
+REDUCING_GAP = 2.0
+
+
+def thumbnail_name(file_name: str, size: ThumbnailSize) -> str:
+    """
+    Returns the name (or path, or url) of the thumbnail of the given file.
+    """
+    file_root, file_extension = os.path.splitext(file_name)
+    if size.format is not None:
+        file_extension = THUMBNAIL_FORMATS[size.format]
+    return f"{file_root}_{size.label}_thumbnail{file_extension}"
+
+
+def derivative_url(file_url: str, size: ThumbnailSize) -> str:
+    """
+    Returns the url of the thumbnail rendered on its first request.
+    """
+    query = {"h": size.height}
+    if size.width is not None:
+        query["w"] = size.width
+    return f"{file_url}?{urlencode(query)}"
+
+
+def thumbnail_urls(image_instance: Image, sizes: Sequence[ThumbnailSize]) -> dict:
+    """
+    Returns the thumbnail urls of the image, keyed like in the upload response.
+    """
+    original_image_url = image_instance.original_image.url
+    if settings.IMAGE_THUMBNAIL_RENDERING == "lazy":
+        return {
+            f"{size.label}_thumbnail": derivative_url(original_image_url, size)
+            for size in sizes
+        }
+    return {
+        f"{size.label}_thumbnail": thumbnail_name(original_image_url, size)
+        for size in sizes
+    }
+
+
+def record_thumbnails(image_instance: Image, sizes: Sequence[ThumbnailSize]) -> None:
+    """
+    Stores the rendered thumbnails of the image in the database.
+    """
+    Thumbnail.objects.bulk_create(
+        [
+            Thumbnail(
+                image=image_instance,
+                thumbnail=thumbnail_name(image_instance.original_image.name, size),
+                height=size.height,
+                width=size.width,
+            )
+            for size in sizes
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def reuse_thumbnails(image_instance: Image, sizes: Sequence[ThumbnailSize]) -> Sequence[ThumbnailSize]:
+    """
+    Links the thumbnails already rendered for images with the same content to the image,
+    and stores them in the database. Returns the sizes that still have to be rendered.
+    """
+    storage = image_instance.original_image.storage
+    if not image_instance.content_hash or not hasattr(storage, "link"):
+        return sizes
+    existing_names = list(
+        Thumbnail.objects.filter(image__content_hash=image_instance.content_hash)
+        .exclude(image=image_instance)
+        .values_list("thumbnail", flat=True)
+    )
+    name = image_instance.original_image.name
+    file_root = os.path.splitext(name)[0]
+    reused_sizes = []
+    for size in sizes:
+        suffix = thumbnail_name(name, size)[len(file_root) :]
+        for existing_name in existing_names:
+            if existing_name.endswith(suffix):
+                try:
+                    storage.link(existing_name, thumbnail_name(name, size))
+                except OSError:  # deleted meanwhile, or the name is taken
+                    continue
+                reused_sizes.append(size)
+                break
+    if reused_sizes:
+        record_thumbnails(image_instance, reused_sizes)
+    return [size for size in sizes if size not in reused_sizes]
+
+
+def deduplicate_thumbnails(image_instance: Image, sizes: Sequence[ThumbnailSize]) -> None:
+    """
+    Moves the rendered thumbnails of the image into the blob store, if the storage has one.
+    """
+    storage = image_instance.original_image.storage
+    if not hasattr(storage, "deduplicate"):
+        return
+    with timed("write"):
+        for size in sizes:
+            storage.deduplicate(thumbnail_name(image_instance.original_image.name, size))
+
+
+def thumbnail_size(image_size: tuple[int, int], size: ThumbnailSize) -> tuple[int, int]:
+    """
+    Returns the dimensions of the thumbnail, fitting it in the given height
+    (and width, if set) while keeping the aspect ratio. Images are never upscaled.
+    """
+    width, height = image_size
+    scale = size.height / height
+    if size.width is not None:
+        scale = min(scale, size.width / width)
+    if scale >= 1:
+        return image_size
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def encoder_options(thumbnail_path: str, size: ThumbnailSize) -> tuple[str, dict]:
+    """
+    Returns the format of the thumbnail (of the size, or of its file extension) and its
+    encoder options: those of IMAGE_THUMBNAIL_ENCODERS, and the quality of the size, if it is set.
+    """
+    file_extension = os.path.splitext(thumbnail_path)[1]
+    image_format = size.format or PILImage.registered_extensions()[file_extension.lower()].lower()
+    options = dict(settings.IMAGE_THUMBNAIL_ENCODERS.get(image_format, {}))
+    if size.quality is not None:
+        options["quality"] = size.quality
+    return image_format, options
+
+
+def save_thumbnail(thumbnail: PILImage.Image, thumbnail_path: str, size: ThumbnailSize) -> None:
+    """
+    Saves the thumbnail with the format and encoder options of encoder_options().
+    The file is replaced atomically, so files sharing its content (hard links) are left intact.
+    Raises ValueError if the thumbnail can not be encoded (e.g. Pillow has no encoder for its format).
+    """
+    file_extension = os.path.splitext(thumbnail_path)[1]
+    image_format, options = encoder_options(thumbnail_path, size)
+    if image_format == "jpeg" and thumbnail.mode not in ("RGB", "L", "CMYK"):
+        thumbnail = thumbnail.convert("RGB")
+    temporary_path = f"{thumbnail_path}.{os.getpid()}.tmp{file_extension}"
+    try:
+        with timed("encode"):
+            try:
+                thumbnail.save(temporary_path, image_format.upper(), **options)
+            except (KeyError, OSError):  # no encoder for the format, or it failed
+                raise ValueError(f"Thumbnail could not be encoded as {image_format}")
+        with timed("write"):
+            os.replace(temporary_path, thumbnail_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def render_thumbnail_files(original_image_path: str, thumbnail_paths: dict) -> None:
+    """
+    Renders the thumbnails of the image to the given paths, keyed by their sizes.
+    The image is decoded once (JPEGs directly at a reduced scale, using draft mode),
+    and each thumbnail is resized from the nearest larger one.
+    Does not touch the database, so it can be run in a worker process.
+    Raises ValueError if the image can not be decoded (e.g. a valid header with a corrupt body).
+    """
+    if not thumbnail_paths:
+        return
+    try:
+        image = PILImage.open(original_image_path)
+    except PILImage.UnidentifiedImageError:
+        raise ValueError("Image could not be decoded")
+    with image:
+        with timed("decode"):
+            dimensions = {size: thumbnail_size(image.size, size) for size in thumbnail_paths}
+            sizes = sorted(dimensions, key=lambda size: dimensions[size][1], reverse=True)
+            draft_width, draft_height = dimensions[sizes[0]]
+            image.draft(
+                image.mode,
+                (int(draft_width * REDUCING_GAP), int(draft_height * REDUCING_GAP)),
+            )
+            try:
+                image.load()
+            except OSError:  # truncated or corrupt data
+                raise ValueError("Image could not be decoded")
+        thumbnail = image
+        for size in sizes:
+            if dimensions[size] != thumbnail.size:
+                with timed("resize"):
+                    thumbnail = thumbnail.resize(
+                        dimensions[size],
+                        PILImage.Resampling.BICUBIC,
+                        reducing_gap=REDUCING_GAP,
+                    )
+            save_thumbnail(thumbnail, thumbnail_paths[size], size)
+
+
+def render_thumbnails(original_image_path: str, sizes: Sequence[ThumbnailSize]) -> list[str]:
+    """
+    Renders the thumbnails of the image next to it, returns their paths by decreasing height.
+    """
+    sizes = sorted(sizes, key=lambda size: (size.height, size.width or 0), reverse=True)
+    thumbnail_paths = {
+        size: thumbnail_name(original_image_path, size) for size in sizes
+    }
+    render_thumbnail_files(original_image_path, thumbnail_paths)
+    return list(thumbnail_paths.values())
+
+
+def render_stored_thumbnails(original_image_name: str, sizes: Sequence[ThumbnailSize]) -> list[str]:
+    """
+    Renders the thumbnails of the stored image, returns their names by decreasing height.
+    On remote storages, the image is rendered from its local copy and the thumbnails are uploaded.
+    """
+    storage = get_image_storage()
+    thumbnail_paths = render_thumbnails(local_file_path(storage, original_image_name), sizes)
+    thumbnail_names = [
+        thumbnail_name(original_image_name, size)
+        for size in sorted(sizes, key=lambda size: (size.height, size.width or 0), reverse=True)
+    ]
+    if not is_local(storage):
+        for thumbnail_path, name in zip(thumbnail_paths, thumbnail_names):
+            storage.delete(name)
+            with open(thumbnail_path, "rb") as f:
+                storage.save(name, File(f))
+    return thumbnail_names
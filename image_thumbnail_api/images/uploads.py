@@ -0,0 +1,32 @@
+import os
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import ImageUpload
+
+
+def delete_upload(upload: ImageUpload) -> None:
+    """
+    Deletes the upload and its partial file.
+    """
+    try:
+        os.remove(upload.partial_file_path)
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+
+def delete_stale_uploads(timeout: int) -> int:
+    """
+    Deletes uploads that have not received a chunk for timeout seconds.
+    Returns the number of deleted uploads.
+    """
+    stale_uploads = ImageUpload.objects.filter(
+        updated_at__lt=timezone.now() - timedelta(seconds=timeout)
+    )
+    deleted_uploads = 0
+    for upload in stale_uploads.iterator():
+        delete_upload(upload)
+        deleted_uploads += 1
+    return deleted_uploads
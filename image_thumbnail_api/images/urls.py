@@ -1,7 +1,31 @@
 from django.urls import path
 
-from images.views import ImageView
+from images.views import (
+    ImageBatchView,
+    ImageFileCacheStats,
+    ImageMetrics,
+    ImageUploadDetail,
+    ImageUploadFinalize,
+    ImageUploadView,
+    ImageView,
+    ThumbnailJobView,
+)
 
 urlpatterns = [
     path("", ImageView.as_view(), name="image-view"),
+    path("batch/", ImageBatchView.as_view(), name="image-batch"),
+    path("uploads/", ImageUploadView.as_view(), name="image-upload"),
+    path(
+        "uploads/<int:upload_pk>/",
+        ImageUploadDetail.as_view(),
+        name="image-upload-detail",
+    ),
+    path(
+        "uploads/<int:upload_pk>/finalize/",
+        ImageUploadFinalize.as_view(),
+        name="image-upload-finalize",
+    ),
+    path("jobs/<int:job_pk>/", ThumbnailJobView.as_view(), name="thumbnail-job"),
+    path("cache-stats/", ImageFileCacheStats.as_view(), name="image-file-cache-stats"),
+    path("metrics/", ImageMetrics.as_view(), name="image-metrics"),
 ]
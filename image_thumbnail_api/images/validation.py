@@ -0,0 +1,118 @@
+import os
+import struct
+from typing import NamedTuple
+
+from django.conf import settings
+
+FORMAT_EXTENSIONS = {"jpeg": (".jpg", ".jpeg"), "png": (".png",)}
+SUPPORTED_EXTENSIONS = [
+    extension for extensions in FORMAT_EXTENSIONS.values() for extension in extensions
+]
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+# start of frame markers, which carry the dimensions (DHT, JPG and DAC share the range)
+JPEG_SOF_MARKERS = {
+    0xC0,
+    0xC1,
+    0xC2,
+    0xC3,
+    0xC5,
+    0xC6,
+    0xC7,
+    0xC9,
+    0xCA,
+    0xCB,
+    0xCD,
+    0xCE,
+    0xCF,
+}
+# markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+
+
+class ImageHeader(NamedTuple):
+    format: str
+    width: int
+    height: int
+
+
+def _read(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Upload a valid image")
+    return data
+
+
+def _read_png_dimensions(f) -> tuple[int, int]:
+    """
+    Reads the dimensions from the IHDR chunk, which must follow the signature.
+    """
+    _, chunk_type, width, height = struct.unpack(">I4sII", _read(f, 16))
+    if chunk_type != b"IHDR":
+        raise ValueError("Upload a valid image")
+    return width, height
+
+
+def _read_jpeg_dimensions(f) -> tuple[int, int]:
+    """
+    Skips from marker to marker until the start of frame, without reading entropy-coded data.
+    """
+    f.seek(2)
+    while True:
+        if _read(f, 1) != b"\xff":
+            raise ValueError("Upload a valid image")
+        marker = _read(f, 1)[0]
+        while marker == 0xFF:  # fill bytes
+            marker = _read(f, 1)[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if (
+            marker == 0xD9 or marker == 0xDA
+        ):  # end of image, or start of scan before any frame
+            raise ValueError("Upload a valid image")
+        (length,) = struct.unpack(">H", _read(f, 2))
+        if length < 2:
+            raise ValueError("Upload a valid image")
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack(">BHH", _read(f, 5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_header(f) -> ImageHeader:
+    """
+    Returns the format and dimensions of the image, read from its first bytes
+    without decoding it. Raises ValueError if it is not a valid JPEG or PNG image.
+    """
+    f.seek(0)
+    signature = f.read(len(PNG_SIGNATURE))
+    if signature == PNG_SIGNATURE:
+        image_format = "png"
+        width, height = _read_png_dimensions(f)
+    elif signature.startswith(JPEG_SIGNATURE):
+        image_format = "jpeg"
+        width, height = _read_jpeg_dimensions(f)
+    else:
+        raise ValueError("Image format not supported")
+    if width == 0 or height == 0:
+        raise ValueError("Upload a valid image")
+    return ImageHeader(image_format, width, height)
+
+
+def validate_image_header(f, file_name: str) -> ImageHeader:
+    """
+    Checks that the file is a JPEG or PNG image named after its format, and that
+    decoding it would not take more than IMAGE_MAX_PIXELS pixels (e.g. a decompression bomb).
+    Only the header is read, and the file is rewound. Raises ValueError otherwise.
+    """
+    header = read_image_header(f)
+    f.seek(0)
+    if os.path.splitext(file_name)[1].lower() not in FORMAT_EXTENSIONS[header.format]:
+        raise ValueError("Image format not supported")
+    if (
+        header.width * header.height > settings.IMAGE_MAX_PIXELS
+        or max(header.width, header.height) > settings.IMAGE_MAX_DIMENSION
+    ):
+        raise ValueError("Image is too large")
+    return header
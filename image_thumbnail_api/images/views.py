@@ -1,20 +1,55 @@
+import fcntl
 import os
-from datetime import datetime
-from typing import Callable
+import time
+from typing import Callable, Sequence
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.http import HttpResponse
+from django.db import close_old_connections
+from django.http import HttpRequest, HttpResponse
+from django.http.response import HttpResponseBase
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from rest_framework import status
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.core.exceptions import ObjectDoesNotExist
 
-from .models import Image, ExpiringImage
-from .serializer import ImageSerializer
-from PIL import Image as PILImage
+from .batch import get_batch_executor, iter_archive, store_image
+from .cache import CachedFile, get_file_cache
+from .delivery import (
+    FileContentNegotiation,
+    negotiate_format,
+    send_content,
+    send_file,
+    stream_async,
+)
+from .derivatives import compute_content_hash, get_or_render_derivative, hash_chunks
+from .metrics import count_bytes, registry, timed
+from .models import Image, ExpiringImage, ImageUpload, Thumbnail, ThumbnailJob
+from .pagination import CreatedAtCursorPagination
+from .processing import (
+    discard_image,
+    get_live_time,
+    link_processing,
+    queue_thumbnails,
+    tier_processing,
+    user_tier,
+)
+from .relocation import moved_name
+from .signing import signed_file_name, verify_signature
+from .storage import LocalFile, get_image_storage, local_file_path
+from .thumbnails import thumbnail_urls
+from .uploads import delete_upload
+from .validation import SUPPORTED_EXTENSIONS, validate_image_header
+from .workers import process_jobs
+from .serializer import ImageListSerializer, ImageSerializer, ThumbnailJobSerializer
+from users.authentication import TierTokenAuthentication
+from users.models import THUMBNAIL_FORMATS, ThumbnailSize, can_encode
 
 
 class ImageAccess(APIView):
@@ -23,7 +58,8 @@ class ImageAccess(APIView):
     Only the owner of the image can access the image, if it exists.
     """
 
-    authentication_classes = [TokenAuthentication]
+    content_negotiation_class = FileContentNegotiation
+    authentication_classes = [TierTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def __authorize_user(self, request: Request, user_pk: str) -> AbstractUser | bool:
@@ -32,235 +68,694 @@ class ImageAccess(APIView):
             return user
         return False
 
-    def __get_file_path(self, request: Request, file_name: str) -> str:
-        user = request.user
+    def __get_file_path(self, request: Request, file_name: str, output_format: str | None) -> str | Response:
+        """
+        Returns the path of the user's original image or thumbnail, or an empty string.
+        Thumbnails are converted to the output format, if it is set.
+        Files moved into the sharded layout are still found under their old names.
+        """
+        name = f"{request.user.id}/images/{file_name}"
+        file_path = self.__get_stored_file_path(request, name, output_format)
+        if not file_path:
+            new_name = moved_name(name)
+            if new_name is not None:
+                file_path = self.__get_stored_file_path(request, new_name, output_format)
+        return file_path
+
+    def __get_stored_file_path(self, request: Request, name: str, output_format: str | None) -> str | Response:
+        try:
+            image = Image.objects.get(original_image=name)
+            return local_file_path(image.original_image.storage, image.original_image.name)
+        except ObjectDoesNotExist:
+            pass
         try:
-            image = Image.objects.get(original_image=f"{user.id}/images/{file_name}")
-            file_path = os.path.join(
-                os.path.dirname(image.original_image.path), file_name
+            thumbnail = Thumbnail.objects.select_related("image").get(
+                thumbnail=name, image__user=request.user
             )
         except ObjectDoesNotExist:
-            file_path = self.__find_other_matching_file(request, file_name)
-        return file_path
+            return ""
+        if output_format is None or thumbnail.thumbnail.name.endswith(
+            THUMBNAIL_FORMATS[output_format]
+        ):
+            return local_file_path(thumbnail.thumbnail.storage, thumbnail.thumbnail.name)
+        return self.__get_derivative(
+            thumbnail.image,
+            ThumbnailSize(thumbnail.height, thumbnail.width, output_format),
+        )
 
-    def __find_other_matching_file(self, request: Request, file_name: str) -> str:
-        user = request.user
-        images_dir = os.listdir(os.path.join(f"{os.getcwd()}/media/{user.id}/images/"))
-        file_path = ""
-        for img_file in images_dir:
-            if img_file == file_name:
-                file_path = os.path.join(
-                    f"{os.getcwd()}/media/{user.id}/images/{img_file}"
-                )
-        return file_path
+    def __get_output_format(self, request: Request) -> str | None:
+        """
+        Returns the format thumbnails should be converted to: the first output format
+        of the user's tier accepted by the client (and supported by the local Pillow).
+        """
+        tier = user_tier(request)
+        if tier is None:
+            return None
+        output_formats = [
+            image_format
+            for image_format in tier.output_formats
+            if can_encode(image_format)
+        ]
+        return negotiate_format(request.META.get("HTTP_ACCEPT", ""), output_formats)
+
+    def __send_cached_file(self, request: Request, cached_file: CachedFile) -> HttpResponseBase:
+        return send_content(
+            request,
+            cached_file.content,
+            cached_file.content_type,
+            cached_file.etag,
+            cached_file.last_modified,
+            private=True,
+            max_age=settings.IMAGE_CACHE_MAX_AGE,
+        )
 
-    def __handle_open_file(self, file_path: str) -> HttpResponse | Response:
+    def __handle_open_file(self, request: Request, file_path: str, cache_key: str) -> HttpResponseBase:
         if os.path.exists(file_path):
-            with open(file_path, "rb") as f:
-                image_data = f.read()
-                return HttpResponse(image_data, content_type="image/jpeg")
+            file_cache = get_file_cache()
+            if file_cache is not None:
+                cached_file = file_cache.load(cache_key, file_path)
+                if cached_file is not None:
+                    return self.__send_cached_file(request, cached_file)
+            return send_file(
+                request,
+                file_path,
+                private=True,
+                max_age=settings.IMAGE_CACHE_MAX_AGE,
+            )
         return Response({"error": "Image not found"}, status=status.HTTP_404_NOT_FOUND)
 
-    def get(self, request: Request, user_pk: str, file_name: str) -> Response:
+    def __get_requested_size(self, request: Request) -> ThumbnailSize | None:
+        """
+        Returns the thumbnail size of the user's tier requested with the h (and w) query parameters.
+        """
+        tier = user_tier(request)
+        if tier is None:
+            return None
+        height = request.query_params.get("h")
+        width = request.query_params.get("w")
+        for size in tier.get_thumbnail_sizes():
+            if str(size.height) == height and (
+                (size.width is None and width is None) or str(size.width) == width
+            ):
+                return size
+        return None
+
+    def __get_derivative_path(self, request: Request, file_name: str, output_format: str | None) -> str | Response:
+        """
+        Returns the path of the requested thumbnail, rendering it on its first request.
+        """
+        size = self.__get_requested_size(request)
+        if size is None:
+            return Response(
+                {"error": "Thumbnail size not available"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        name = f"{request.user.id}/images/{file_name}"
+        try:
+            image = Image.objects.get(original_image=name)
+        except ObjectDoesNotExist:
+            try:
+                image = Image.objects.get(original_image=moved_name(name))
+            except ObjectDoesNotExist:
+                return Response(
+                    {"error": "Image not found"}, status=status.HTTP_404_NOT_FOUND
+                )
+        if output_format is not None:
+            size = size._replace(format=output_format)
+        return self.__get_derivative(image, size)
+
+    def __get_derivative(self, image: Image, size: ThumbnailSize) -> str | Response:
+        """
+        Returns the path of the thumbnail in the derivative cache, rendering it on its first request.
+        Returns an error response if the original image can not be rendered.
+        """
+        original_image_path = local_file_path(
+            image.original_image.storage, image.original_image.name
+        )
+        if not image.content_hash:
+            image.content_hash = compute_content_hash(original_image_path)
+            image.save(update_fields=["content_hash"])
+        try:
+            return get_or_render_derivative(original_image_path, image.content_hash, size)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    def get(self, request: Request, user_pk: str, file_name: str) -> HttpResponseBase:
         if not self.__authorize_user(request, user_pk):
             return Response(
                 {"error": "You do not have access to this image"},
                 status=status.HTTP_403_FORBIDDEN,
             )
-        file_path = self.__get_file_path(request, file_name)
-        return self.__handle_open_file(file_path)
+        tier = user_tier(request)
+        negotiates_format = tier is not None and bool(tier.output_formats)
+        output_format = self.__get_output_format(request) if negotiates_format else None
+        cache_key = f"{user_pk}/{file_name}"
+        if "h" in request.query_params:
+            cache_key += f"?h={request.query_params['h']}&w={request.query_params.get('w', '')}"
+        if output_format is not None:
+            cache_key += f";{output_format}"
+        file_cache = get_file_cache()
+        cached_file = file_cache.get(cache_key) if file_cache is not None else None
+        if cached_file is not None:
+            response = self.__send_cached_file(request, cached_file)
+        elif "h" in request.query_params:
+            file_path = self.__get_derivative_path(request, file_name, output_format)
+            if isinstance(file_path, Response):
+                return file_path
+            response = self.__handle_open_file(request, file_path, cache_key)
+        else:
+            file_path = self.__get_file_path(request, file_name, output_format)
+            if isinstance(file_path, Response):
+                return file_path
+            response = self.__handle_open_file(request, file_path, cache_key)
+        if negotiates_format:
+            patch_vary_headers(response, ("Accept",))
+        return response
 
 
 class ExpiringImageAccess(APIView):
     """
     Expiring image access management.
     Anyone can access the image can access the image, if it exists and it's not expired.
+    Expired images are deleted by the sweep_expiring_images command.
     """
 
+    content_negotiation_class = FileContentNegotiation
+
+    def __get_remaining_live_time(self, image: ExpiringImage) -> int:
+        return int((image.expires_at - timezone.now()).total_seconds())
+
     def __handle_image_is_expired(self, image: ExpiringImage) -> bool:
-        current_time_in_seconds = int(datetime.now().timestamp())
-        image_time_in_seconds = int(image.created_at.timestamp())
-        if current_time_in_seconds - image_time_in_seconds > int(image.live_time):
+        if image.expires_at <= timezone.now():
             return True
         return False
 
-    def __handle_open_file(self, file_path: str) -> HttpResponse | Response:
+    def __handle_open_file(self, request: Request, image: ExpiringImage, file_path: str) -> HttpResponseBase:
         if os.path.exists(file_path):
-            with open(file_path, "rb") as f:
-                image_data = f.read()
-                return HttpResponse(image_data, content_type="image/jpeg")
+            return send_file(
+                request,
+                file_path,
+                public=True,
+                max_age=min(
+                    self.__get_remaining_live_time(image), settings.IMAGE_CACHE_MAX_AGE
+                ),
+            )
         return Response({"error": "Image not found"}, status=status.HTTP_404_NOT_FOUND)
 
-    def get(self, request: Request, file_name: str) -> Response | Callable:
+    def get(self, request: Request, file_name: str) -> HttpResponseBase:
+        name = f"expiring-images/{file_name}"
         try:
-            image = ExpiringImage.objects.get(image=f"expiring-images/{file_name}")
+            image = ExpiringImage.objects.get(image=name)
         except ObjectDoesNotExist:
+            try:
+                image = ExpiringImage.objects.get(image=moved_name(name))
+            except ObjectDoesNotExist:
+                return Response(
+                    {"error": "Image does not exist"}, status=status.HTTP_404_NOT_FOUND
+                )
+        if self.__handle_image_is_expired(image):
             return Response(
-                {"error": "Image does not exist"}, status=status.HTTP_404_NOT_FOUND
+                {"error": "Image has expired"}, status=status.HTTP_404_NOT_FOUND
             )
-        if self.__handle_image_is_expired(image):
-            image.delete()
+        file_path = local_file_path(image.image.storage, image.image.name)
+        return self.__handle_open_file(request, image, file_path)
+
+
+class SignedImageAccess(APIView):
+    """
+    Signed image access management.
+    Anyone can access the image with a valid signature, until the link expires.
+    Links are verified without touching the database.
+    """
+
+    content_negotiation_class = FileContentNegotiation
+    authentication_classes: list = []
+
+    def __get_requested_size(self, request: Request) -> ThumbnailSize | None:
+        if "h" not in request.query_params:
+            return None
+        return ThumbnailSize(
+            int(request.query_params["h"]),
+            int(request.query_params["w"]) if "w" in request.query_params else None,
+            request.query_params.get("f"),
+        )
+
+    def get(self, request: Request, user_pk: int, file_name: str) -> HttpResponseBase:
+        try:
+            image_pk = int(request.query_params["image"])
+            expires = int(request.query_params["expires"])
+            signature = request.query_params["signature"]
+            size = self.__get_requested_size(request)
+        except (KeyError, ValueError):
+            return Response(
+                {"error": "Invalid link"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        name = f"{user_pk}/images/{file_name}"
+        if not verify_signature(image_pk, name, expires, size, signature):
+            return Response(
+                {"error": "Invalid signature"}, status=status.HTTP_403_FORBIDDEN
+            )
+        remaining_live_time = expires - int(time.time())
+        if remaining_live_time <= 0:
             return Response(
                 {"error": "Image has expired"}, status=status.HTTP_404_NOT_FOUND
             )
-        file_path = os.path.join(os.path.dirname(image.image.path), file_name)
-        return self.__handle_open_file(file_path)
+        storage = get_image_storage()
+        signed_name = f"{user_pk}/images/{signed_file_name(file_name, size)}"
+        file_path = local_file_path(storage, signed_name)
+        if not os.path.exists(file_path):
+            new_name = moved_name(signed_name)
+            if new_name is not None:
+                file_path = local_file_path(storage, new_name)
+        if not os.path.exists(file_path):
+            return Response(
+                {"error": "Image not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return send_file(
+            request,
+            file_path,
+            public=True,
+            max_age=min(remaining_live_time, settings.IMAGE_CACHE_MAX_AGE),
+        )
+
+
+def async_media_view(view: Callable) -> Callable:
+    """
+    Returns an async variant of the media view, for ASGI deployments.
+    The file is looked up by the view in a thread of the executor, so concurrent lookups
+    run in parallel instead of queueing on the single thread-sensitive thread, and streamed
+    without blocking the event loop, so slow downloads do not hold a thread each.
+    """
+
+    def look_up(request: HttpRequest, *args, **kwargs) -> HttpResponseBase:
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            # The executor threads are not closed by the request_finished signal
+            close_old_connections()
+
+    async def async_view(request: HttpRequest, *args, **kwargs) -> HttpResponseBase:
+        response = await sync_to_async(look_up, thread_sensitive=False)(request, *args, **kwargs)
+        return stream_async(response)
+
+    return async_view
+
+
+async_image_access = async_media_view(ImageAccess.as_view())
+async_expiring_image_access = async_media_view(ExpiringImageAccess.as_view())
+async_signed_image_access = async_media_view(SignedImageAccess.as_view())
 
 
 class ImageView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [TierTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.options = {
-            "Basic": self.__basic_tier_processing,
-            "Premium": self.__premium_tier_processing,
-            "Enterprise": self.__enterprise_tier_processing,
-        }
+    def get(self, request: Request) -> Response:
+        """
+        Lists the user's images, oldest first, one page at a time.
+        """
+        fields = None
+        if "fields" in request.query_params:
+            fields = request.query_params["fields"].split(",")
+            unknown_fields = set(fields) - set(ImageListSerializer.Meta.fields)
+            if unknown_fields:
+                return Response(
+                    {"error": f"Unknown fields: {', '.join(sorted(unknown_fields))}"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+        images = Image.objects.filter(user_id=request.user.id)
+        if fields is not None and "thumbnails" in fields:
+            images = images.prefetch_related("thumbnails")
+        paginator = CreatedAtCursorPagination()
+        page = paginator.paginate_queryset(images, request, view=self)
+        if not page:
+            return Response({"No images found"}, status=status.HTTP_404_NOT_FOUND)
+        tier = user_tier(request)
+        serializer = ImageListSerializer(
+            page,
+            many=True,
+            fields=fields,
+            context={"thumbnail_sizes": tier.get_thumbnail_sizes() if tier else ()},
+        )
+        return paginator.get_paginated_response(serializer.data)
 
-    def __file_processing(self, request: Request, image_instance: Image, image: PILImage, size: int) -> tuple:
+    def post(self, request: Request) -> Response | Callable:
         """
-        Processes image, returns file url and file extension.
+        Uploads the image and processes it according to the user's tier.
         """
-        original_image_url = image_instance.original_image.url
-        file_url, file_extension = os.path.splitext(original_image_url)
-        image.thumbnail((image.width, size))
-        image.save(f".{file_url}_{size}px_thumbnail{file_extension}")
-        return file_url, file_extension
+        user = request.user
+        image_instance = Image(user=user)
+        serializer = ImageSerializer(image_instance, data=request.data)
+        with timed("validate"):
+            is_valid = serializer.is_valid()
+        if is_valid:
+            uploaded_file = serializer.validated_data["original_image"]
+            count_bytes("in", uploaded_file.size)
+            try:
+                with timed("validate"):
+                    validate_image_header(uploaded_file, uploaded_file.name)
+                live_time = get_live_time(request)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer.save(content_hash=hash_chunks(uploaded_file.chunks()))
+            return tier_processing(request, image_instance, live_time)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
 
-    def __basic_tier_processing(self, request: Request, image_instance: Image, image: PILImage) -> Response:
+class ImageBatchView(APIView):
+    """
+    Batch uploads.
+    Many images are sent in one request, as multipart "images" files and/or a zip or tar "archive",
+    and processed like regular uploads, with their thumbnails rendered in parallel by a pool of processes.
+    Returns the result of each image, in order.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def __iter_files(self, request: Request):
+        yield from request.FILES.getlist("images")
+        if "archive" in request.FILES:
+            yield from iter_archive(request.FILES["archive"])
+
+    def __store_images(self, request: Request) -> list[tuple[dict, Image | None]]:
         """
-        Basic tier processing.
+        Validates and stores the images one at a time, returns their results and instances.
+        Stops at the first file past IMAGE_BATCH_MAX_FILES, or at an invalid archive
+        (which rejects the whole batch if no image was read before it).
         """
-        file_url, file_extension = self.__file_processing(
-            request, image_instance, image, 200
-        )
-        data = {
-            "200px_thumbnail": f"{file_url}_200px_thumbnail{file_extension}",
-            "success": "Image uploaded successfully",
-        }
-        return Response(data, status=status.HTTP_201_CREATED)
+        items: list[tuple[dict, Image | None]] = []
+        files = self.__iter_files(request)
+        while True:
+            try:
+                f = next(files, None)
+            except ValueError as e:
+                if not items:
+                    raise
+                result = {
+                    "file_name": request.FILES["archive"].name,
+                    "error": str(e),
+                    "status": status.HTTP_400_BAD_REQUEST,
+                }
+                items.append((result, None))
+                break
+            if f is None:
+                break
+            result = {"file_name": f.name}
+            image_instance = None
+            with f:
+                if len(items) >= settings.IMAGE_BATCH_MAX_FILES:
+                    result["error"] = f"Batches are limited to {settings.IMAGE_BATCH_MAX_FILES} images"
+                else:
+                    try:
+                        image_instance = store_image(request.user, f)
+                    except ValueError as e:
+                        result["error"] = str(e)
+            result["status"] = status.HTTP_400_BAD_REQUEST if image_instance is None else status.HTTP_201_CREATED
+            items.append((result, image_instance))
+            if len(items) > settings.IMAGE_BATCH_MAX_FILES:
+                break
+        return items
 
-    def __premium_tier_processing(self, request: Request, image_instance: Image, image: PILImage) -> Response:
+    def __thumbnail_processing(self, items: list[tuple[dict, Image | None]], sizes: Sequence[ThumbnailSize]) -> None:
         """
-        Premium tier processing.
+        Renders the thumbnails of all stored images in the pool of processes
+        (or queues them in async mode, or leaves them to their first request in lazy mode).
         """
-        file_url, file_extension = self.__file_processing(
-            request, image_instance, image, 400
-        )
-        file_url, file_extension = self.__file_processing(
-            request, image_instance, image, 200
+        jobs = []
+        for result, image_instance in items:
+            if image_instance is None:
+                continue
+            result.update(thumbnail_urls(image_instance, sizes))
+            if settings.IMAGE_THUMBNAIL_RENDERING == "lazy":
+                continue
+            job = queue_thumbnails(image_instance, sizes)
+            if job is None:
+                continue
+            if settings.IMAGE_THUMBNAIL_RENDERING == "async":
+                result["thumbnail_job"] = reverse("thumbnail-job", args=[job.pk])
+                result["status"] = status.HTTP_202_ACCEPTED
+            else:
+                jobs.append((result, job))
+        if not jobs:
+            return
+        with get_batch_executor(len(jobs)) as executor:
+            errors = process_jobs(executor, [job for _, job in jobs])
+        for result, job in jobs:
+            if isinstance(errors.get(job.pk), ValueError):  # the image could not be decoded
+                discard_image(job.image)
+                file_name = result["file_name"]
+                result.clear()
+                result.update(file_name=file_name, error=job.error, status=status.HTTP_400_BAD_REQUEST)
+            elif job.status == ThumbnailJob.FAILED:
+                result["error"] = f"Thumbnail rendering failed: {job.error}"
+                result["status"] = status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    def post(self, request: Request) -> Response:
+        try:
+            live_time = get_live_time(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            items = self.__store_images(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not items:
+            return Response(
+                {"error": "No images or archive field"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        tier = user_tier(request)
+        self.__thumbnail_processing(items, tier.get_thumbnail_sizes() if tier else ())
+        for result, image_instance in items:
+            if image_instance is not None and "error" not in result:
+                result.update(link_processing(image_instance, live_time))
+        return Response(
+            {"results": [result for result, _ in items]},
+            status=status.HTTP_207_MULTI_STATUS,
         )
-        data = {
-            "400px_thumbnail": f"{file_url}_400px_thumbnail{file_extension}",
-            "200px_thumbnail": f"{file_url}_200px_thumbnail{file_extension}",
-            "original_image": image_instance.original_image.url,
-            "success": "Image uploaded successfully",
-        }
-        return Response(data, status=status.HTTP_201_CREATED)
-
-    def __enterprise_tier_processing(self, request: Request, image_instance: Image, image: PILImage) -> Response:
+
+
+class ImageUploadView(APIView):
+    """
+    Chunked upload management.
+    Uploads are started here, their chunks are sent to the upload url, and they are
+    finalized into an image once every byte has been received.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request: Request) -> Response:
         """
-        Enterprise tier processing.
+        Starts a chunked upload of a file of the given name and size.
         """
         try:
-            live_time = request.data["live_time"]
-        except KeyError:
+            file_name = os.path.basename(str(request.data["file_name"]))
+            size = int(request.data["size"])
+        except (KeyError, ValueError):
             return Response(
-                {"error": "No live_time field"}, status=status.HTTP_400_BAD_REQUEST
+                {"error": "file_name and size fields are required"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-        if int(live_time) < 300 or int(live_time) > 3000:
+        if os.path.splitext(file_name)[1].lower() not in SUPPORTED_EXTENSIONS:
             return Response(
-                {"error": "Live time must be between 300 and 3000 seconds"},
+                {"error": "Image format not supported"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        original_image_url = image_instance.original_image.url
-        file_url, file_extension = self.__file_processing(
-            request, image_instance, image, 400
-        )
-        file_url, file_extension = self.__file_processing(
-            request, image_instance, image, 200
-        )
-        file_name = os.path.splitext(os.path.basename(original_image_url))[0]
-        expiring_image = ExpiringImage.objects.create(
-            user=request.user, live_time=live_time
+        if size <= 0 or size > settings.IMAGE_UPLOAD_MAX_SIZE:
+            return Response(
+                {"error": f"Size must be between 1 and {settings.IMAGE_UPLOAD_MAX_SIZE} bytes"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        upload = ImageUpload.objects.create(
+            user=request.user, file_name=file_name, size=size
         )
-        expiring_image.image.save(
-            f"{file_name}{file_extension}", image_instance.original_image
+        os.makedirs(settings.IMAGE_UPLOAD_DIR, exist_ok=True)
+        open(upload.partial_file_path, "wb").close()
+        return Response(
+            {
+                "upload": reverse("image-upload-detail", args=[upload.pk]),
+                "offset": upload.offset,
+                "size": upload.size,
+            },
+            status=status.HTTP_201_CREATED,
         )
-        data = {
-            "400px_thumbnail": f"{file_url}_400px_thumbnail{file_extension}",
-            "200px_thumbnail": f"{file_url}_200px_thumbnail{file_extension}",
-            "original_image": original_image_url,
-            f"{live_time}s_expiring_link": expiring_image.image.url,
-            "success": "Image uploaded successfully",
-        }
-        return Response(data, status=status.HTTP_201_CREATED)
-
-    def __default_tier_processing(self, request: Request, image_instance: Image, image: PILImage) -> Response:
+
+
+class ImageUploadDetail(APIView):
+    """
+    Chunks of a chunked upload.
+    Only the user who started the upload can send its chunks, in order:
+    each chunk is a PUT of raw bytes with the Upload-Offset header set to the number
+    of bytes already received, which GET returns when an upload has to be resumed.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def __upload_status(self, upload: ImageUpload, status_code: int = status.HTTP_200_OK) -> Response:
+        return Response({"offset": upload.offset, "size": upload.size}, status=status_code)
+
+    def __write_chunk(self, request: Request, upload: ImageUpload, f) -> Response | None:
         """
-        Default tier processing. (for arbitrary tiers)
+        Appends the request body to the partial file, which is locked by the caller.
         """
-        user = request.user
-        file_url, file_extension = self.__file_processing(
-            request, image_instance, image, user.tier.thumbnail_height
-        )
-        file_name = os.path.basename(file_url)
-        data = {
-            f"{str(user.tier.thumbnail_height)}px_thumbnail": f"{file_url}_{str(user.tier.thumbnail_height)}px_thumbnail{file_extension}"
-        }
-        if user.tier.presence_of_original_file_link:
-            data["original_image"] = image_instance.original_image.url
-        if user.tier.ability_to_fetch_expiring_link:
-            try:
-                live_time = request.data["live_time"]
-            except KeyError:
-                return Response(
-                    {"error": "No live_time field"}, status=status.HTTP_400_BAD_REQUEST
-                )
-            if int(live_time) < 300 or int(live_time) > 3000:
+        f.seek(upload.offset)
+        stream = request.stream
+        while stream is not None:
+            chunk = stream.read(settings.IMAGE_STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if f.tell() + len(chunk) > upload.size:
+                f.truncate(upload.offset)
                 return Response(
-                    {"error": "Live time must be between 300 and 3000 seconds"},
+                    {"error": "Chunk exceeds the size of the upload"},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            expiring_image = ExpiringImage.objects.create(
-                user=user, live_time=live_time
-            )
-            expiring_image.image.save(
-                f"{file_name}{file_extension}", image_instance.original_image
+            f.write(chunk)
+        f.truncate()
+        count_bytes("in", f.tell() - upload.offset)
+        upload.offset = f.tell()
+        upload.save(update_fields=["offset", "updated_at"])
+        return None
+
+    def get(self, request: Request, upload_pk: int) -> Response:
+        try:
+            upload = ImageUpload.objects.get(pk=upload_pk, user=request.user)
+        except ObjectDoesNotExist:
+            return Response({"error": "Upload does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        return self.__upload_status(upload)
+
+    def put(self, request: Request, upload_pk: int) -> Response:
+        try:
+            offset = int(request.META["HTTP_UPLOAD_OFFSET"])
+        except (KeyError, ValueError):
+            return Response(
+                {"error": "Upload-Offset header is required"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            data[f"{live_time}s_expiring_link"] = expiring_image.image.url
-        data["success"] = "Image uploaded successfully"
-        return Response(data, status=status.HTTP_201_CREATED)
+        try:
+            upload = ImageUpload.objects.get(pk=upload_pk, user=request.user)
+        except ObjectDoesNotExist:
+            return Response({"error": "Upload does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        with open(upload.partial_file_path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # chunks of an upload are written one at a time
+            upload.refresh_from_db(fields=["offset"])
+            if offset != upload.offset:
+                return self.__upload_status(upload, status.HTTP_409_CONFLICT)
+            response = self.__write_chunk(request, upload, f)
+        return response or self.__upload_status(upload)
 
-    def get(self, request: Request) -> Response:
+    def delete(self, request: Request, upload_pk: int) -> Response:
         """
-        Lists all images.
+        Aborts the upload.
         """
-        images = Image.objects.filter(user_id=request.user.id)
-        if images:
-            serializer = ImageSerializer(images, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        return Response({"No images found"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            upload = ImageUpload.objects.get(pk=upload_pk, user=request.user)
+        except ObjectDoesNotExist:
+            return Response({"error": "Upload does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        delete_upload(upload)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
-    def post(self, request: Request) -> Response | Callable:
-        """
-        Calls the appropriate tier processing method and returns the response.
-        """
-        user = request.user
-        image_instance = Image(user=user)
-        serializer = ImageSerializer(image_instance, data=request.data)
-        if serializer.is_valid():
-            serializer.save()
-            image_format = os.path.splitext(image_instance.original_image.url)[1]
-            if image_format not in [".jpg", ".jpeg", ".png"]:
-                image_instance.delete()
-                return Response(
-                    {"error": "Image format not supported"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-            original_image_path = image_instance.original_image.path
-            with PILImage.open(original_image_path) as image:
-                return self.options.get(user.tier.name, self.__default_tier_processing)(request, image_instance, image)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class ImageUploadFinalize(APIView):
+    """
+    Completion of a chunked upload.
+    The received file is checked against the SHA-256 checksum sent by the client,
+    moved into the image storage and processed like a regular upload.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request: Request, upload_pk: int) -> Response:
+        try:
+            upload = ImageUpload.objects.get(pk=upload_pk, user=request.user)
+        except ObjectDoesNotExist:
+            return Response({"error": "Upload does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        if upload.offset != upload.size:
+            return Response(
+                {"error": "Upload is incomplete", "offset": upload.offset, "size": upload.size},
+                status=status.HTTP_409_CONFLICT,
+            )
+        try:
+            live_time = get_live_time(request)
+        except ValueError as e:  # the upload is kept, so finalizing can be retried
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        content_hash = compute_content_hash(upload.partial_file_path)
+        if str(request.data.get("checksum", "")).lower() != content_hash:
+            delete_upload(upload)
+            return Response(
+                {"error": "Checksum does not match"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            with open(upload.partial_file_path, "rb") as f:
+                validate_image_header(f, upload.file_name)
+        except ValueError as e:
+            delete_upload(upload)
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        image_instance = Image(user=request.user, content_hash=content_hash)
+        with LocalFile(upload.partial_file_path, content_hash) as f:
+            image_instance.original_image.save(upload.file_name, f)
+        delete_upload(upload)
+        return tier_processing(request, image_instance, live_time)
+
+
+class ThumbnailJobView(APIView):
+    """
+    Thumbnail generation status.
+    Only the owner of the image can see the status of its thumbnails.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request: Request, job_pk: int) -> Response:
+        try:
+            job = ThumbnailJob.objects.select_related("image").get(
+                pk=job_pk, image__user=request.user
+            )
+        except ObjectDoesNotExist:
+            return Response(
+                {"error": "Thumbnail job does not exist"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        serializer = ThumbnailJobSerializer(job)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class ImageFileCacheStats(APIView):
+    """
+    Statistics of the cache of hot files, for admins.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request: Request) -> Response:
+        file_cache = get_file_cache()
+        if file_cache is None:
+            return Response(
+                {"error": "File cache is disabled"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(file_cache.stats(), status=status.HTTP_200_OK)
+
+
+class ImageMetrics(APIView):
+    """
+    Stage timings, transferred bytes and cache lookups of this process,
+    in the Prometheus text format, for admins.
+    """
+
+    authentication_classes = [TierTokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request: Request) -> HttpResponse | Response:
+        if not settings.IMAGE_METRICS_ENABLED:
+            return Response(
+                {"error": "Metrics are disabled"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return HttpResponse(
+            registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
@@ -0,0 +1,100 @@
+from concurrent.futures import Executor
+from datetime import timedelta
+from typing import Sequence
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from users.models import ThumbnailSize
+from .metrics import collect_samples, record_samples
+from .models import ThumbnailJob
+from .thumbnails import (
+    deduplicate_thumbnails,
+    record_thumbnails,
+    render_stored_thumbnails,
+)
+
+
+def requeue_stale_jobs(timeout: int) -> int:
+    """
+    Puts jobs that have been running for longer than timeout seconds (e.g. because
+    their worker was killed) back into the queue. Returns the number of requeued jobs.
+    """
+    return ThumbnailJob.objects.filter(
+        status=ThumbnailJob.RUNNING,
+        updated_at__lt=timezone.now() - timedelta(seconds=timeout),
+    ).update(status=ThumbnailJob.PENDING, updated_at=timezone.now())
+
+
+def claim_jobs(limit: int) -> list[ThumbnailJob]:
+    """
+    Marks up to limit pending jobs as running and returns them.
+    A job is only returned to the worker that managed to change its status,
+    so several workers can share the queue.
+    """
+    claimed_jobs = []
+    pending_jobs = ThumbnailJob.objects.filter(status=ThumbnailJob.PENDING).order_by(
+        "created_at"
+    )
+    for job in pending_jobs.select_related("image")[:limit]:
+        claimed = ThumbnailJob.objects.filter(
+            pk=job.pk, status=ThumbnailJob.PENDING
+        ).update(status=ThumbnailJob.RUNNING, updated_at=timezone.now())
+        if claimed:
+            job.status = ThumbnailJob.RUNNING
+            claimed_jobs.append(job)
+    return claimed_jobs
+
+
+def render_job(original_image_name: str, sizes: Sequence[ThumbnailSize]) -> tuple[list[str], list]:
+    """
+    Renders the thumbnails of a job in a worker, returns their names and the metrics
+    samples recorded meanwhile, which would be lost with the worker process.
+    """
+    with collect_samples() as samples:
+        thumbnail_names = render_stored_thumbnails(original_image_name, sizes)
+    return thumbnail_names, samples
+
+
+def process_jobs(executor: Executor, jobs: list[ThumbnailJob]) -> dict[int, Exception]:
+    """
+    Renders the thumbnails of the jobs in the executor and stores the results
+    (and the metrics recorded by the workers).
+    Returns the errors of the failed jobs, by job id.
+    """
+    errors = {}
+    futures = [
+        (
+            job,
+            executor.submit(
+                render_job,
+                job.image.original_image.name,
+                job.get_thumbnail_sizes(),
+            ),
+        )
+        for job in jobs
+    ]
+    for job, future in futures:
+        try:
+            _, samples = future.result()
+        except Exception as e:
+            job.status = ThumbnailJob.FAILED
+            job.error = str(e)
+            errors[job.pk] = e
+        else:
+            record_samples(samples)
+            deduplicate_thumbnails(job.image, job.get_thumbnail_sizes())
+            record_thumbnails(job.image, job.get_thumbnail_sizes())
+            job.status = ThumbnailJob.DONE
+        job.save(update_fields=["status", "error", "updated_at"])
+    return errors
+
+
+def run_pending_jobs(executor: Executor, batch_size: int) -> int:
+    """
+    Processes one batch of pending jobs, returns the number of processed jobs.
+    """
+    close_old_connections()
+    jobs = claim_jobs(batch_size)
+    process_jobs(executor, jobs)
+    return len(jobs)
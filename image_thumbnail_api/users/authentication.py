@@ -0,0 +1,151 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import Tier, User
+
+
+class TokenCache:
+    """
+    Per-process LRU cache of authenticated tokens (with their user and tier), bounded by
+    the number of tokens. Entries are dropped when their token, user or tier changes in
+    this process, and expire after the TTL, which bounds how long changes made by other
+    processes go unnoticed.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.__entries: OrderedDict[str, tuple[Token, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: str) -> Token | None:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            token, expires_at = entry
+            if time.monotonic() > expires_at:
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return token
+
+    def set(self, key: str, token: Token) -> None:
+        with self.__lock:
+            self.__entries[key] = (token, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def delete_user(self, user_pk: int) -> None:
+        with self.__lock:
+            for key, (token, _expires_at) in list(self.__entries.items()):
+                if token.user_id == user_pk:
+                    del self.__entries[key]
+
+    def delete_tier(self, tier_pk: int) -> None:
+        with self.__lock:
+            for key, (token, _expires_at) in list(self.__entries.items()):
+                if token.user.tier_id == tier_pk:
+                    del self.__entries[key]
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+_token_cache: TokenCache | None = None
+
+
+def get_token_cache() -> TokenCache | None:
+    """
+    Returns the cache of authenticated tokens, or None if TOKEN_CACHE_TTL disables it.
+    """
+    global _token_cache
+    if not settings.TOKEN_CACHE_TTL:
+        return None
+    if _token_cache is None:
+        _token_cache = TokenCache(settings.TOKEN_CACHE_MAX_ENTRIES, settings.TOKEN_CACHE_TTL)
+    return _token_cache
+
+
+@receiver(setting_changed)
+def reset_token_cache(sender, setting=None, **kwargs):
+    """
+    Rebuild the cache of authenticated tokens when its settings change
+    """
+    global _token_cache
+    if setting in ("TOKEN_CACHE_TTL", "TOKEN_CACHE_MAX_ENTRIES"):
+        _token_cache = None
+
+
+@receiver([post_save, post_delete], sender=Token)
+def clear_cached_token(sender, instance=None, **kwargs):
+    """
+    Drop the cached token when it changes or is deleted
+    """
+    if _token_cache is not None:
+        _token_cache.delete(instance.key)
+
+
+@receiver([post_save, post_delete], sender=User)
+def clear_cached_user_tokens(sender, instance=None, **kwargs):
+    """
+    Drop the cached tokens of the user when the user changes or is deleted
+    """
+    if _token_cache is not None:
+        _token_cache.delete_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Tier)
+def clear_cached_tier_tokens(sender, instance=None, **kwargs):
+    """
+    Drop the cached tokens of the tier's users when the tier changes or is deleted
+    """
+    if _token_cache is not None:
+        _token_cache.delete_tier(instance.pk)
+
+
+class TierTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that loads the user's tier in the same query as the user,
+    and keeps authenticated tokens in a cache, so that most requests make no query at all.
+    """
+
+    def authenticate_credentials(self, key):
+        token_cache = get_token_cache()
+        token = token_cache.get(key) if token_cache is not None else None
+        if token is None:
+            model = self.get_model()
+            try:
+                token = model.objects.select_related("user__tier").get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_("Invalid token."))
+            if token_cache is not None:
+                token_cache.set(key, token)
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+
+        # each request gets its own copies, so changes made by views are not shared
+        token = copy.copy(token)
+        token.user = copy.copy(token.user)
+        return (token.user, token)
@@ -0,0 +1,53 @@
+# Generated by Django 4.0.5 on 2026-10-18 18:10
+
+from django.db import migrations, models
+import users.models
+
+BUILTIN_TIER_THUMBNAIL_SIZES = {
+    "Basic": [200],
+    "Premium": [400, 200],
+    "Enterprise": [400, 200],
+}
+
+
+def thumbnail_height_to_sizes(apps, schema_editor):
+    Tier = apps.get_model("users", "Tier")
+    for tier in Tier.objects.all():
+        if tier.name in BUILTIN_TIER_THUMBNAIL_SIZES:
+            tier.thumbnail_sizes = BUILTIN_TIER_THUMBNAIL_SIZES[tier.name]
+        elif tier.thumbnail_height is not None:
+            tier.thumbnail_sizes = [tier.thumbnail_height]
+        tier.save(update_fields=["thumbnail_sizes"])
+
+
+def thumbnail_sizes_to_height(apps, schema_editor):
+    Tier = apps.get_model("users", "Tier")
+    for tier in Tier.objects.exclude(name__in=BUILTIN_TIER_THUMBNAIL_SIZES):
+        for size in tier.thumbnail_sizes:
+            tier.thumbnail_height = size["height"] if isinstance(size, dict) else size
+            tier.save(update_fields=["thumbnail_height"])
+            break
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0003_alter_tier_thumbnail_height"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tier",
+            name="thumbnail_sizes",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                validators=[users.models.validate_thumbnail_sizes],
+            ),
+        ),
+        migrations.RunPython(thumbnail_height_to_sizes, thumbnail_sizes_to_height),
+        migrations.RemoveField(
+            model_name="tier",
+            name="thumbnail_height",
+        ),
+    ]
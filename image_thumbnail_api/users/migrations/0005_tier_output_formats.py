@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-18 18:06
+
+from django.db import migrations, models
+import users.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0004_tier_thumbnail_sizes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tier",
+            name="output_formats",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                validators=[users.models.validate_output_formats],
+            ),
+        ),
+    ]
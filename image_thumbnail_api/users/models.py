@@ -1,10 +1,97 @@
+import copy
+from typing import NamedTuple
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from PIL import Image as PILImage
 from rest_framework.authtoken.models import Token
 
+THUMBNAIL_FORMATS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "avif": ".avif"}
+
+
+def can_encode(image_format: str) -> bool:
+    """
+    Returns True if the local Pillow can save images in the format, e.g. "webp".
+    """
+    PILImage.init()
+    return image_format.upper() in PILImage.SAVE
+
+
+class ThumbnailSize(NamedTuple):
+    """
+    Size and output settings of one of the thumbnails a tier comes with.
+    Stored in Tier.thumbnail_sizes either as a plain height, e.g. 200,
+    or as an object, e.g. {"height": 200, "width": 300, "format": "webp", "quality": 80}.
+    """
+
+    height: int
+    width: int | None = None
+    format: str | None = None
+    quality: int | None = None
+
+    @classmethod
+    def from_json(cls, value: int | dict) -> "ThumbnailSize":
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(value)
+
+    def to_json(self) -> int | dict:
+        if self == ThumbnailSize(self.height):
+            return self.height
+        return {key: value for key, value in self._asdict().items() if value is not None}
+
+    @property
+    def label(self) -> str:
+        """
+        Name of the size used in thumbnail file names and response fields, e.g. "200px".
+        """
+        if self.width:
+            return f"{self.width}x{self.height}px"
+        return f"{self.height}px"
+
+
+def validate_thumbnail_sizes(value: list) -> None:
+    """
+    Validates the thumbnail sizes of a tier.
+    """
+    if not isinstance(value, list):
+        raise ValidationError("Thumbnail sizes must be a list")
+    labels = set()
+    for item in value:
+        try:
+            size = ThumbnailSize.from_json(item)
+        except TypeError:
+            raise ValidationError(f"Invalid thumbnail size: {item}")
+        for dimension in (size.height, size.width):
+            if dimension is not None and (type(dimension) is not int or dimension < 1):
+                raise ValidationError(f"Invalid thumbnail dimension: {dimension}")
+        if size.format is not None and size.format not in THUMBNAIL_FORMATS:
+            raise ValidationError(f"Unsupported thumbnail format: {size.format}")
+        if size.format is not None and not can_encode(size.format):
+            raise ValidationError(f"Pillow can not encode the thumbnail format: {size.format}")
+        if size.quality is not None and (
+            type(size.quality) is not int or not 1 <= size.quality <= 100
+        ):
+            raise ValidationError("Thumbnail quality must be between 1 and 100")
+        if size.label in labels:
+            raise ValidationError(f"Duplicate thumbnail size: {size.label}")
+        labels.add(size.label)
+
+
+def validate_output_formats(value: list) -> None:
+    """
+    Validates the formats thumbnails of a tier can be negotiated to.
+    """
+    if not isinstance(value, list):
+        raise ValidationError("Output formats must be a list")
+    for item in value:
+        if item not in THUMBNAIL_FORMATS:
+            raise ValidationError(f"Unsupported thumbnail format: {item}")
+
 
 class User(AbstractUser):
     """
@@ -25,15 +112,33 @@ class Tier(models.Model):
     """
 
     name = models.CharField(max_length=255)
-    thumbnail_height = models.IntegerField(
-        null=True, blank=True
-    )  # can be null for built-in tiers
+    thumbnail_sizes = models.JSONField(
+        default=list, blank=True, validators=[validate_thumbnail_sizes]
+    )
+    # formats thumbnails are converted to for clients that accept them, by preference
+    output_formats = models.JSONField(
+        default=list, blank=True, validators=[validate_output_formats]
+    )
     presence_of_original_file_link = models.BooleanField()
     ability_to_fetch_expiring_link = models.BooleanField()
 
     def __str__(self):
         return self.name
 
+    def get_thumbnail_sizes(self) -> tuple[ThumbnailSize, ...]:
+        """
+        Returns the thumbnail sizes of the tier, parsed once per instance
+        (and again whenever its thumbnail_sizes change).
+        """
+        parsed = self.__dict__.get("_parsed_thumbnail_sizes")
+        if parsed is None or parsed[0] != self.thumbnail_sizes:
+            parsed = (
+                copy.deepcopy(self.thumbnail_sizes),
+                tuple(ThumbnailSize.from_json(item) for item in self.thumbnail_sizes),
+            )
+            self._parsed_thumbnail_sizes = parsed
+        return parsed[1]
+
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
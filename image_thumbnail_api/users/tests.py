@@ -0,0 +1,201 @@
+from unittest import mock
+
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from users.authentication import TierTokenAuthentication, get_token_cache
+from users.models import Tier, ThumbnailSize, User
+
+
+class TierTests(TestCase):
+    def test_thumbnail_sizes(self):
+        """
+        Test that plain heights and objects are both parsed into thumbnail sizes
+        """
+        tier = Tier.objects.create(
+            name="Custom",
+            thumbnail_sizes=[200, {"height": 400, "width": 300, "format": "webp"}],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.assertEqual(
+            tier.get_thumbnail_sizes(),
+            (ThumbnailSize(200), ThumbnailSize(400, width=300, format="webp")),
+        )
+        self.assertEqual(
+            [size.to_json() for size in tier.get_thumbnail_sizes()],
+            tier.thumbnail_sizes,
+        )
+
+    def test_thumbnail_sizes_cache_is_cleared_on_save(self):
+        """
+        Test that changed thumbnail sizes are picked up after the tier is saved
+        """
+        tier = Tier.objects.create(
+            name="Custom",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.assertEqual(tier.get_thumbnail_sizes(), (ThumbnailSize(200),))
+        tier.thumbnail_sizes = [300]
+        tier.save()
+        self.assertEqual(
+            Tier.objects.get(pk=tier.pk).get_thumbnail_sizes(), (ThumbnailSize(300),)
+        )
+
+    def test_thumbnail_sizes_updated_without_signals(self):
+        """
+        Test that thumbnail sizes changed by a queryset update are picked up once the tier is reloaded
+        """
+        tier = Tier.objects.create(
+            name="Custom",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.assertEqual(tier.get_thumbnail_sizes(), (ThumbnailSize(200),))
+        Tier.objects.filter(pk=tier.pk).update(thumbnail_sizes=[300])
+        tier.refresh_from_db()
+        self.assertEqual(tier.get_thumbnail_sizes(), (ThumbnailSize(300),))
+        self.assertEqual(
+            Tier.objects.get(pk=tier.pk).get_thumbnail_sizes(), (ThumbnailSize(300),)
+        )
+
+    def test_invalid_thumbnail_sizes(self):
+        """
+        Test that invalid thumbnail sizes are rejected
+        """
+        for thumbnail_sizes in (
+            200,
+            [0],
+            ["200"],
+            [{"width": 200}],
+            [{"height": 200, "format": "bmp"}],
+            [{"height": 200, "quality": 101}],
+            [200, {"height": 200}],
+        ):
+            tier = Tier(
+                name="Custom",
+                thumbnail_sizes=thumbnail_sizes,
+                presence_of_original_file_link=False,
+                ability_to_fetch_expiring_link=False,
+            )
+            with self.assertRaises(ValidationError, msg=thumbnail_sizes):
+                tier.full_clean()
+
+    def test_thumbnail_format_without_encoder(self):
+        """
+        Test that thumbnail formats the local Pillow can not encode are rejected
+        """
+        tier = Tier(
+            name="Custom",
+            thumbnail_sizes=[{"height": 200, "format": "webp"}],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        with mock.patch("users.models.can_encode", return_value=False):
+            with self.assertRaises(ValidationError):
+                tier.full_clean()
+        with mock.patch("users.models.can_encode", return_value=True):
+            tier.full_clean()
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        """
+        Create a user with a tier, and authenticate their token once
+        """
+        self.tier = Tier.objects.create(
+            name="Basic",
+            thumbnail_sizes=[200],
+            presence_of_original_file_link=False,
+            ability_to_fetch_expiring_link=False,
+        )
+        self.user = User.objects.create_user(
+            username="test", password="test", tier=self.tier
+        )
+        self.key = Token.objects.get(user=self.user).key
+        self.authentication = TierTokenAuthentication()
+        get_token_cache().clear()
+        self.authentication.authenticate_credentials(self.key)
+
+    def test_cached_token_is_authenticated_without_queries(self):
+        """
+        Test that a cached token is authenticated with its user and tier, without queries
+        """
+        with self.assertNumQueries(0):
+            user, token = self.authentication.authenticate_credentials(self.key)
+            self.assertEqual(user.tier.name, "Basic")
+        self.assertEqual(user, self.user)
+        self.assertEqual(token.key, self.key)
+
+    def test_each_request_gets_its_own_user(self):
+        """
+        Test that changes made to the user of one request are not seen by others
+        """
+        user, _ = self.authentication.authenticate_credentials(self.key)
+        user.username = "changed"
+        user, _ = self.authentication.authenticate_credentials(self.key)
+        self.assertEqual(user.username, "test")
+
+    def test_deleted_token_is_rejected(self):
+        """
+        Test that a deleted token is dropped from the cache
+        """
+        Token.objects.filter(user=self.user).get().delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.key)
+
+    def test_inactive_user_is_rejected(self):
+        """
+        Test that the tokens of a deactivated user are dropped from the cache
+        """
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.key)
+
+    def test_changed_tier_is_reloaded(self):
+        """
+        Test that the tokens of a tier's users are dropped from the cache when the tier changes
+        """
+        self.tier.name = "Premium"
+        self.tier.save()
+        user, _ = self.authentication.authenticate_credentials(self.key)
+        self.assertEqual(user.tier.name, "Premium")
+
+    @override_settings(TOKEN_CACHE_TTL=60, TOKEN_CACHE_MAX_ENTRIES=1)
+    def test_least_recently_used_tokens_are_evicted(self):
+        """
+        Test that the cache stays within its number of tokens
+        """
+        other_user = User.objects.create_user(
+            username="other", password="test", tier=self.tier
+        )
+        self.authentication.authenticate_credentials(self.key)
+        self.authentication.authenticate_credentials(
+            Token.objects.get(user=other_user).key
+        )
+        self.assertEqual(len(get_token_cache()), 1)
+        with self.assertNumQueries(1):
+            self.authentication.authenticate_credentials(self.key)
+
+    def test_expired_tokens_are_reloaded(self):
+        """
+        Test that cached tokens are loaded again once they are older than the TTL
+        """
+        with mock.patch("users.authentication.time.monotonic", return_value=10**9):
+            with self.assertNumQueries(1):
+                self.authentication.authenticate_credentials(self.key)
+
+    @override_settings(TOKEN_CACHE_TTL=None)
+    def test_cache_can_be_disabled(self):
+        """
+        Test that every authentication queries the token when the cache is disabled
+        """
+        self.assertIsNone(get_token_cache())
+        with self.assertNumQueries(1):
+            self.authentication.authenticate_credentials(self.key)